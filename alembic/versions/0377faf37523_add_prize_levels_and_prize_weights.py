@@ -0,0 +1,48 @@
+"""add-prize-levels-and-prize-weights
+
+Revision ID: 0377faf37523
+Revises: 097f01af790a
+Create Date: 2026-10-19 13:41:09.204733
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0377faf37523'
+down_revision = '097f01af790a'
+branch_labels = None
+depends_on = None
+
+# define prize levels table to add to db
+prize_levels_table = sa.table('prize_levels', sa.column('level', sa.Integer), sa.column('min_points', sa.Integer))
+
+def upgrade() -> None:
+    # points a winner needs for each prize level (were hard coded as 5 and 15)
+    op.create_table('prize_levels',
+    sa.Column('level', sa.Integer(), nullable=False),
+    sa.Column('min_points', sa.Integer(), nullable=False),
+    sa.CheckConstraint('min_points >= 0', name='ck_prize_levels_min_points'),
+    sa.PrimaryKeyConstraint('level'),
+    sa.UniqueConstraint('min_points')
+    )
+    op.bulk_insert(prize_levels_table,
+    [
+        {"level": 1, "min_points": 0},
+        {"level": 2, "min_points": 5},
+        {"level": 3, "min_points": 15}
+    ])
+    # prizes are picked with a chance by weight, prizes with a quantity are only picked while some are left
+    op.add_column('prizes', sa.Column('weight', sa.Integer(), server_default=sa.text('1'), nullable=False))
+    op.add_column('prizes', sa.Column('quantity', sa.Integer(), nullable=True))
+    op.create_check_constraint('ck_prizes_weight', 'prizes', 'weight > 0')
+    op.create_check_constraint('ck_prizes_quantity', 'prizes', 'quantity >= 0')
+
+
+def downgrade() -> None:
+    op.drop_constraint('ck_prizes_quantity', 'prizes', type_='check')
+    op.drop_constraint('ck_prizes_weight', 'prizes', type_='check')
+    op.drop_column('prizes', 'quantity')
+    op.drop_column('prizes', 'weight')
+    op.drop_table('prize_levels')
@@ -0,0 +1,45 @@
+"""unique-student-points-and-idempotency-keys
+
+Revision ID: 097f01af790a
+Revises: d019e5e9a599
+Create Date: 2026-10-19 13:02:41.530917
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '097f01af790a'
+down_revision = 'd019e5e9a599'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # duplicate points from retried requests are removed (the first one is kept), the rollup trigger takes them off too
+    op.execute("""
+        DELETE FROM student_points sp USING student_points first
+        WHERE sp.user_id = first.user_id AND sp.event_time_id = first.event_time_id AND sp.id > first.id
+    """)
+    # a student has one point per event time, point entry inserts with ON CONFLICT on it
+    op.create_unique_constraint('uq_student_points_user_id_event_time_id', 'student_points', ['user_id', 'event_time_id'])
+    # responses of requests sent with an Idempotency-Key, replayed when the client retries
+    op.create_table('idempotency_keys',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('key', sa.String(), nullable=False),
+    sa.Column('fingerprint', sa.String(), nullable=False),
+    sa.Column('status_code', sa.Integer(), nullable=True),
+    sa.Column('response', postgresql.JSONB(astext_type=sa.Text()), nullable=True),
+    sa.Column('created_at', sa.TIMESTAMP(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('user_id', 'key')
+    )
+    op.create_index('ix_idempotency_keys_created_at', 'idempotency_keys', ['created_at'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_idempotency_keys_created_at', table_name='idempotency_keys')
+    op.drop_table('idempotency_keys')
+    op.drop_constraint('uq_student_points_user_id_event_time_id', 'student_points', type_='unique')
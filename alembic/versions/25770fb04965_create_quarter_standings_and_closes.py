@@ -0,0 +1,88 @@
+"""create-quarter-standings-and-closes
+
+Revision ID: 25770fb04965
+Revises: 0377faf37523
+Create Date: 2026-10-19 14:22:37.610215
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '25770fb04965'
+down_revision = '0377faf37523'
+branch_labels = None
+depends_on = None
+
+versions_table = sa.table('table_versions',
+    sa.column('table_name', sa.String), sa.column('version', sa.BigInteger))
+
+# standings are frozen when a quarter range is closed, changing a row is an error
+immutable_function = """
+    CREATE FUNCTION quarter_standings_immutable() RETURNS trigger AS $$
+    BEGIN
+        RAISE EXCEPTION 'quarter standings of a closed quarter range can''t be changed';
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+# final standings of every quarter range that already ended, from the point rollups (same ranks as /user-points)
+backfill_standings = """
+    INSERT INTO quarter_standings (quarter_range_id, user_id, points, rank, percentile)
+    SELECT totals.quarter_range_id, totals.user_id, totals.points,
+        rank() OVER (PARTITION BY totals.quarter_range_id ORDER BY totals.points DESC),
+        round((rank() OVER (PARTITION BY totals.quarter_range_id ORDER BY totals.points) - 1) * 100.0
+            / count(*) OVER (PARTITION BY totals.quarter_range_id), 1)
+    FROM (SELECT r.quarter_range_id, r.user_id, sum(r.points) AS points FROM student_point_rollups r
+        JOIN "quarter-ranges" qr ON qr.id = r.quarter_range_id WHERE qr.end_range <= now()
+        GROUP BY r.quarter_range_id, r.user_id) totals
+"""
+
+# ended quarter ranges are closed without picking winners again, admins already picked them
+backfill_closes = """
+    INSERT INTO quarter_closes (quarter_range_id, participants)
+    SELECT qr.id, count(s.user_id) FROM "quarter-ranges" qr
+    LEFT JOIN quarter_standings s ON s.quarter_range_id = qr.id
+    WHERE qr.end_range <= now() GROUP BY qr.id
+"""
+
+def upgrade() -> None:
+    op.create_table('quarter_standings',
+    sa.Column('quarter_range_id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('points', sa.Integer(), nullable=False),
+    sa.Column('rank', sa.Integer(), nullable=False),
+    sa.Column('percentile', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['quarter_range_id'], ['quarter-ranges.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('quarter_range_id', 'user_id')
+    )
+    # pages of a closed leaderboard are read in rank order
+    op.create_index('ix_quarter_standings_quarter_range_id_rank', 'quarter_standings', ['quarter_range_id', 'rank', 'user_id'])
+    op.create_index(op.f('ix_quarter_standings_user_id'), 'quarter_standings', ['user_id'])
+    op.execute(immutable_function)
+    op.execute("""
+        CREATE TRIGGER quarter_standings_immutable BEFORE UPDATE ON quarter_standings
+        FOR EACH ROW EXECUTE FUNCTION quarter_standings_immutable()
+    """)
+    op.create_table('quarter_closes',
+    sa.Column('quarter_range_id', sa.Integer(), nullable=False),
+    sa.Column('closed_at', sa.TIMESTAMP(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.Column('participants', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['quarter_range_id'], ['quarter-ranges.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('quarter_range_id')
+    )
+    op.execute(backfill_standings)
+    op.execute(backfill_closes)
+    op.bulk_insert(versions_table, [{'table_name': 'quarter_standings', 'version': 0}])
+
+
+def downgrade() -> None:
+    op.execute("DELETE FROM table_versions WHERE table_name = 'quarter_standings'")
+    op.drop_table('quarter_closes')
+    op.execute("DROP TRIGGER quarter_standings_immutable ON quarter_standings")
+    op.execute("DROP FUNCTION quarter_standings_immutable()")
+    op.drop_index(op.f('ix_quarter_standings_user_id'), table_name='quarter_standings')
+    op.drop_index('ix_quarter_standings_quarter_range_id_rank', table_name='quarter_standings')
+    op.drop_table('quarter_standings')
@@ -0,0 +1,86 @@
+"""soft-delete-and-deletion-jobs
+
+Revision ID: 2a232f61d1b6
+Revises: 25770fb04965
+Create Date: 2026-10-19 15:03:18.442907
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2a232f61d1b6'
+down_revision = '25770fb04965'
+branch_labels = None
+depends_on = None
+
+# tables whose rows are hidden right away when deleted and removed by a deletion job
+soft_delete_tables = ['users', 'events', 'quarter-ranges']
+
+# indexes on the foreign keys that deletes cascade through (and the deletion jobs delete by)
+# student_points.user_id is the first column of uq_student_points_user_id_event_time_id
+foreign_key_indexes = [
+    ('ix_event_times_event_id', 'event_times', ['event_id']),
+    ('ix_event_times_quarter_range_id', 'event_times', ['quarter_range_id']),
+    ('ix_student_points_event_time_id', 'student_points', ['event_time_id']),
+    ('ix_student_winners_user_id', 'student_winners', ['user_id']),
+    ('ix_student_winners_quarter_range_id', 'student_winners', ['quarter_range_id']),
+    ('ix_student_winners_prize_id', 'student_winners', ['prize_id']),
+    ('ix_user_steps_user_id', 'user_steps', ['user_id']),
+    ('ix_quarter_ranges_quarter_id', 'quarter-ranges', ['quarter_id']),
+]
+
+def upgrade() -> None:
+    for table in soft_delete_tables:
+        op.add_column(table, sa.Column('deleted_at', sa.TIMESTAMP(timezone=True), nullable=True))
+    # usernames and event names only have to be unique among the rows that aren't deleted,
+    # so a name can be used again while the deletion job of the old row is running
+    op.create_index('uq_users_username', 'users', ['username'], unique=True, postgresql_where=sa.text('deleted_at IS NULL'))
+    op.drop_constraint('users_username_key', 'users', type_='unique')
+    op.create_index('uq_events_name', 'events', ['name'], unique=True, postgresql_where=sa.text('deleted_at IS NULL'))
+    op.drop_constraint('events_name_key', 'events', type_='unique')
+    # same for quarter ranges, a deleted range doesn't block a new one over the same dates
+    op.drop_constraint('quarter_ranges_no_overlap', 'quarter-ranges')
+    op.execute(
+        'ALTER TABLE "quarter-ranges" ADD CONSTRAINT quarter_ranges_no_overlap '
+        "EXCLUDE USING gist (tstzrange(start_range, end_range, '[]') WITH &&) WHERE (deleted_at IS NULL)"
+    )
+    op.create_table('deletion_jobs',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('table_name', sa.String(), nullable=False),
+    sa.Column('record_id', sa.Integer(), nullable=False),
+    sa.Column('status', sa.String(), server_default='pending', nullable=False),
+    sa.Column('deleted_rows', sa.BigInteger(), server_default=sa.text('0'), nullable=False),
+    sa.Column('error', sa.String(), nullable=True),
+    sa.Column('created_at', sa.TIMESTAMP(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.Column('updated_at', sa.TIMESTAMP(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.Column('finished_at', sa.TIMESTAMP(timezone=True), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    # jobs that still have to run (or be tried again) are claimed in id order
+    op.create_index('ix_deletion_jobs_unfinished', 'deletion_jobs', ['id'], postgresql_where=sa.text("status <> 'done'"))
+    # built without locking the tables for writes (point entry keeps working while they build)
+    with op.get_context().autocommit_block():
+        for name, table, columns in foreign_key_indexes:
+            op.create_index(name, table, columns, postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, _ in reversed(foreign_key_indexes):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True)
+    op.drop_index('ix_deletion_jobs_unfinished', table_name='deletion_jobs')
+    op.drop_table('deletion_jobs')
+    op.create_unique_constraint('events_name_key', 'events', ['name'])
+    op.drop_index('uq_events_name', table_name='events')
+    op.create_unique_constraint('users_username_key', 'users', ['username'])
+    op.drop_index('uq_users_username', table_name='users')
+    # fails if a deleted quarter range overlaps one that isn't deleted
+    op.drop_constraint('quarter_ranges_no_overlap', 'quarter-ranges')
+    op.execute(
+        'ALTER TABLE "quarter-ranges" ADD CONSTRAINT quarter_ranges_no_overlap '
+        "EXCLUDE USING gist (tstzrange(start_range, end_range, '[]') WITH &&)"
+    )
+    for table in soft_delete_tables:
+        op.drop_column(table, 'deleted_at')
@@ -0,0 +1,29 @@
+"""exclude-overlapping-quarter-ranges
+
+Revision ID: 3e8f1c2a9b47
+Revises: 9c8bf2b541e3
+Create Date: 2026-10-19 09:12:41.318205
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3e8f1c2a9b47'
+down_revision = '9c8bf2b541e3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # gist index on the range of each quarter range that rejects any overlapping range
+    # (bounds are inclusive like the old start/end checks). Fails if overlapping ranges already exist
+    op.execute(
+        'ALTER TABLE "quarter-ranges" ADD CONSTRAINT quarter_ranges_no_overlap '
+        "EXCLUDE USING gist (tstzrange(start_range, end_range, '[]') WITH &&)"
+    )
+
+
+def downgrade() -> None:
+    op.drop_constraint('quarter_ranges_no_overlap', 'quarter-ranges')
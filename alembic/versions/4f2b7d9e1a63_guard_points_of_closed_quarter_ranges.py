@@ -0,0 +1,60 @@
+"""guard-points-of-closed-quarter-ranges
+
+Revision ID: 4f2b7d9e1a63
+Revises: 8eecbc3da0fd
+Create Date: 2026-10-19 18:02:14.275310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4f2b7d9e1a63'
+down_revision = '8eecbc3da0fd'
+branch_labels = None
+depends_on = None
+
+# points of a closed quarter range can't be added, moved or deleted, its standings are frozen.
+# the quarter range row is locked (key share) before quarter_closes is read: a close in progress (it locks the row
+# for update) is waited for and then seen, and a close started later skips the quarter range until the point change
+# committed. moving points to the archive (app.archiving) and deletion jobs (app.deleting, they refreeze the
+# standings themselves) aren't checked
+guard_function = """
+    CREATE FUNCTION student_points_closed_guard() RETURNS trigger AS $$
+    DECLARE
+        v_quarter_range_id integer;
+    BEGIN
+        IF current_setting('app.archiving', true) = 'on' OR current_setting('app.deleting', true) = 'on' THEN
+            IF TG_OP = 'DELETE' THEN
+                RETURN OLD;
+            END IF;
+            RETURN NEW;
+        END IF;
+        FOR v_quarter_range_id IN
+            SELECT qr.id FROM "quarter-ranges" qr JOIN event_times et ON et.quarter_range_id = qr.id
+            WHERE (TG_OP <> 'DELETE' AND et.id = NEW.event_time_id) OR (TG_OP <> 'INSERT' AND et.id = OLD.event_time_id)
+            ORDER BY qr.id FOR KEY SHARE OF qr
+        LOOP
+            IF EXISTS (SELECT 1 FROM quarter_closes WHERE quarter_range_id = v_quarter_range_id) THEN
+                RAISE EXCEPTION 'Quarter range with id: % is closed, its points can''t be changed', v_quarter_range_id
+                    USING ERRCODE = 'object_not_in_prerequisite_state';
+            END IF;
+        END LOOP;
+        IF TG_OP = 'DELETE' THEN
+            RETURN OLD;
+        END IF;
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+def upgrade() -> None:
+    op.execute(guard_function)
+    op.execute('CREATE TRIGGER student_points_closed_guard BEFORE INSERT OR UPDATE OF user_id, event_time_id OR DELETE ON student_points '
+        'FOR EACH ROW EXECUTE FUNCTION student_points_closed_guard()')
+
+
+def downgrade() -> None:
+    op.execute('DROP TRIGGER student_points_closed_guard ON student_points')
+    op.execute('DROP FUNCTION student_points_closed_guard()')
@@ -0,0 +1,33 @@
+"""add-user-sort-indexes
+
+Revision ID: 6b2d94e7c1f0
+Revises: 3e8f1c2a9b47
+Create Date: 2026-10-19 10:03:27.845112
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6b2d94e7c1f0'
+down_revision = '3e8f1c2a9b47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # indexes for each sort column of the users list, id breaks ties (username is already unique)
+    op.create_index('ix_users_first_name_id', 'users', ['first_name', 'id'])
+    op.create_index('ix_users_last_name_id', 'users', ['last_name', 'id'])
+    op.create_index('ix_users_grade_id', 'users', ['grade', 'id'])
+    op.create_index('ix_users_role_type_id_id', 'users', ['role_type_id', 'id'])
+    op.create_index('ix_users_created_at_id', 'users', ['created_at', 'id'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_users_created_at_id', table_name='users')
+    op.drop_index('ix_users_role_type_id_id', table_name='users')
+    op.drop_index('ix_users_grade_id', table_name='users')
+    op.drop_index('ix_users_last_name_id', table_name='users')
+    op.drop_index('ix_users_first_name_id', table_name='users')
@@ -0,0 +1,151 @@
+"""create-student-points-archive
+
+Revision ID: 8eecbc3da0fd
+Revises: 2a232f61d1b6
+Create Date: 2026-10-19 16:11:45.902371
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8eecbc3da0fd'
+down_revision = '2a232f61d1b6'
+branch_labels = None
+depends_on = None
+
+# points moved to the archive keep their rollups, moving them (with app.archiving set) doesn't change the rollups
+student_points_function = """
+    CREATE OR REPLACE FUNCTION student_points_rollup() RETURNS trigger AS $$
+    DECLARE
+        v_quarter_range_id integer;
+        v_is_sport boolean;
+    BEGIN
+        IF current_setting('app.archiving', true) = 'on' THEN
+            RETURN NULL;
+        END IF;
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            SELECT et.quarter_range_id, e.is_sport INTO v_quarter_range_id, v_is_sport
+            FROM event_times et JOIN events e ON e.id = et.event_id WHERE et.id = OLD.event_time_id;
+            IF FOUND THEN
+                PERFORM adjust_point_rollup(v_quarter_range_id, OLD.user_id, v_is_sport, -1);
+            END IF;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            SELECT et.quarter_range_id, e.is_sport INTO v_quarter_range_id, v_is_sport
+            FROM event_times et JOIN events e ON e.id = et.event_id WHERE et.id = NEW.event_time_id;
+            IF FOUND THEN
+                PERFORM adjust_point_rollup(v_quarter_range_id, NEW.user_id, v_is_sport, 1);
+            END IF;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+# same as before but counts the archived points too
+event_times_function = """
+    CREATE OR REPLACE FUNCTION event_times_rollup() RETURNS trigger AS $$
+    DECLARE
+        v_old_is_sport boolean;
+        v_new_is_sport boolean;
+        v_row record;
+    BEGIN
+        SELECT is_sport INTO v_old_is_sport FROM events WHERE id = OLD.event_id;
+        IF NOT FOUND THEN
+            RETURN OLD;
+        END IF;
+        IF TG_OP = 'UPDATE' THEN
+            SELECT is_sport INTO v_new_is_sport FROM events WHERE id = NEW.event_id;
+            IF NEW.quarter_range_id = OLD.quarter_range_id AND v_new_is_sport = v_old_is_sport THEN
+                RETURN NEW;
+            END IF;
+        END IF;
+        FOR v_row IN SELECT user_id, count(*) AS points FROM all_student_points WHERE event_time_id = OLD.id GROUP BY user_id LOOP
+            PERFORM adjust_point_rollup(OLD.quarter_range_id, v_row.user_id, v_old_is_sport, -v_row.points::integer);
+            IF TG_OP = 'UPDATE' THEN
+                PERFORM adjust_point_rollup(NEW.quarter_range_id, v_row.user_id, v_new_is_sport, v_row.points::integer);
+            END IF;
+        END LOOP;
+        IF TG_OP = 'DELETE' THEN
+            RETURN OLD;
+        END IF;
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+events_function = """
+    CREATE OR REPLACE FUNCTION events_rollup() RETURNS trigger AS $$
+    DECLARE
+        v_row record;
+    BEGIN
+        IF TG_OP = 'UPDATE' AND NEW.is_sport = OLD.is_sport THEN
+            RETURN NEW;
+        END IF;
+        FOR v_row IN SELECT et.quarter_range_id, sp.user_id, count(*) AS points
+            FROM event_times et JOIN all_student_points sp ON sp.event_time_id = et.id
+            WHERE et.event_id = OLD.id GROUP BY et.quarter_range_id, sp.user_id LOOP
+            PERFORM adjust_point_rollup(v_row.quarter_range_id, v_row.user_id, OLD.is_sport, -v_row.points::integer);
+            IF TG_OP = 'UPDATE' THEN
+                PERFORM adjust_point_rollup(v_row.quarter_range_id, v_row.user_id, NEW.is_sport, v_row.points::integer);
+            END IF;
+        END LOOP;
+        IF TG_OP = 'DELETE' THEN
+            RETURN OLD;
+        END IF;
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+# functions of d019e5e9a599 for the downgrade
+previous_student_points_function = student_points_function.replace("""        IF current_setting('app.archiving', true) = 'on' THEN
+            RETURN NULL;
+        END IF;
+""", '')
+previous_event_times_function = event_times_function.replace('FROM all_student_points WHERE', 'FROM student_points WHERE')
+previous_events_function = events_function.replace('JOIN all_student_points sp', 'JOIN student_points sp')
+
+def upgrade() -> None:
+    # points of archived quarter ranges, same ids as they had in student_points
+    op.create_table('student_points_archive',
+    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('event_time_id', sa.Integer(), nullable=False),
+    sa.Column('archived_at', sa.TIMESTAMP(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.ForeignKeyConstraint(['event_time_id'], ['event_times.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('user_id', 'event_time_id', name='uq_student_points_archive_user_id_event_time_id')
+    )
+    op.create_index('ix_student_points_archive_event_time_id', 'student_points_archive', ['event_time_id'])
+    # when the points of a quarter range were moved to the archive
+    op.add_column('quarter_closes', sa.Column('archived_at', sa.TIMESTAMP(timezone=True), nullable=True))
+    op.execute("""
+        CREATE VIEW all_student_points AS
+        SELECT id, user_id, event_time_id FROM student_points
+        UNION ALL SELECT id, user_id, event_time_id FROM student_points_archive
+    """)
+    op.execute(student_points_function)
+    op.execute(event_times_function)
+    op.execute(events_function)
+    # archived points that are removed (with their user, event time or event) are taken out of the rollups
+    op.execute('CREATE TRIGGER student_points_archive_rollup AFTER UPDATE OR DELETE ON student_points_archive '
+        'FOR EACH ROW EXECUTE FUNCTION student_points_rollup()')
+
+
+def downgrade() -> None:
+    # archived points go back to student_points (their rollups were kept)
+    op.execute("SET LOCAL app.archiving = 'on'")
+    op.execute('INSERT INTO student_points (id, user_id, event_time_id) SELECT id, user_id, event_time_id FROM student_points_archive')
+    op.execute("SET LOCAL app.archiving = 'off'")
+    op.execute('DROP TRIGGER student_points_archive_rollup ON student_points_archive')
+    op.execute(previous_events_function)
+    op.execute(previous_event_times_function)
+    op.execute(previous_student_points_function)
+    op.execute('DROP VIEW all_student_points')
+    op.drop_column('quarter_closes', 'archived_at')
+    op.drop_index('ix_student_points_archive_event_time_id', table_name='student_points_archive')
+    op.drop_table('student_points_archive')
@@ -0,0 +1,68 @@
+"""add-updated-at-and-sync-tombstones
+
+Revision ID: a4c7e2f95d31
+Revises: 6b2d94e7c1f0
+Create Date: 2026-10-19 10:41:09.207733
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4c7e2f95d31'
+down_revision = '6b2d94e7c1f0'
+branch_labels = None
+depends_on = None
+
+# reference tables the frontend syncs with /sync
+sync_tables = ['events', 'prizes', 'quarters', 'quarter-ranges']
+
+def trigger_name(table: str, action: str):
+    return f'{table.replace("-", "_")}_{action}'
+
+def upgrade() -> None:
+    op.create_table('sync_tombstones',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('table_name', sa.String(), nullable=False),
+    sa.Column('record_id', sa.Integer(), nullable=False),
+    sa.Column('deleted_at', sa.TIMESTAMP(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_sync_tombstones_deleted_at', 'sync_tombstones', ['deleted_at'])
+    # triggers keep updated_at and the tombstones right for every write, including cascades
+    op.execute("""
+        CREATE FUNCTION set_updated_at() RETURNS trigger AS $$
+        BEGIN
+            NEW.updated_at = now();
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE FUNCTION record_sync_tombstone() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO sync_tombstones (table_name, record_id, deleted_at) VALUES (TG_TABLE_NAME, OLD.id, now());
+            RETURN OLD;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    for table in sync_tables:
+        op.add_column(table, sa.Column('updated_at', sa.TIMESTAMP(timezone=True), server_default=sa.text('now()'), nullable=False))
+        op.create_index(f'ix_{table}_updated_at', table, ['updated_at'])
+        op.execute(f'CREATE TRIGGER {trigger_name(table, "set_updated_at")} BEFORE UPDATE ON "{table}" '
+            'FOR EACH ROW EXECUTE FUNCTION set_updated_at()')
+        op.execute(f'CREATE TRIGGER {trigger_name(table, "sync_tombstone")} AFTER DELETE ON "{table}" '
+            'FOR EACH ROW EXECUTE FUNCTION record_sync_tombstone()')
+
+
+def downgrade() -> None:
+    for table in sync_tables:
+        op.execute(f'DROP TRIGGER {trigger_name(table, "sync_tombstone")} ON "{table}"')
+        op.execute(f'DROP TRIGGER {trigger_name(table, "set_updated_at")} ON "{table}"')
+        op.drop_index(f'ix_{table}_updated_at', table_name=table)
+        op.drop_column(table, 'updated_at')
+    op.execute('DROP FUNCTION record_sync_tombstone()')
+    op.execute('DROP FUNCTION set_updated_at()')
+    op.drop_index('ix_sync_tombstones_deleted_at', table_name='sync_tombstones')
+    op.drop_table('sync_tombstones')
@@ -0,0 +1,51 @@
+"""guard-event-times-of-closed-quarter-ranges
+
+Revision ID: b81e4c6d2f57
+Revises: 4f2b7d9e1a63
+Create Date: 2026-10-19 21:14:52.608193
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b81e4c6d2f57'
+down_revision = '4f2b7d9e1a63'
+branch_labels = None
+depends_on = None
+
+# an event time can't be moved out of or into a closed quarter range (or to another event in one), its rollup
+# trigger would move its points and the frozen standings (and archived points) of the closed quarter range would
+# no longer match them. the quarter ranges are locked the same way as by student_points_closed_guard
+guard_function = """
+    CREATE FUNCTION event_times_closed_guard() RETURNS trigger AS $$
+    DECLARE
+        v_quarter_range_id integer;
+    BEGIN
+        IF NEW.quarter_range_id IS NOT DISTINCT FROM OLD.quarter_range_id AND NEW.event_id IS NOT DISTINCT FROM OLD.event_id THEN
+            RETURN NEW;
+        END IF;
+        FOR v_quarter_range_id IN
+            SELECT qr.id FROM "quarter-ranges" qr WHERE qr.id IN (OLD.quarter_range_id, NEW.quarter_range_id)
+            ORDER BY qr.id FOR KEY SHARE OF qr
+        LOOP
+            IF EXISTS (SELECT 1 FROM quarter_closes WHERE quarter_range_id = v_quarter_range_id) THEN
+                RAISE EXCEPTION 'Quarter range with id: % is closed, its event times can''t be moved', v_quarter_range_id
+                    USING ERRCODE = 'object_not_in_prerequisite_state';
+            END IF;
+        END LOOP;
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+def upgrade() -> None:
+    op.execute(guard_function)
+    op.execute('CREATE TRIGGER event_times_closed_guard BEFORE UPDATE OF quarter_range_id, event_id ON event_times '
+        'FOR EACH ROW EXECUTE FUNCTION event_times_closed_guard()')
+
+
+def downgrade() -> None:
+    op.execute('DROP TRIGGER event_times_closed_guard ON event_times')
+    op.execute('DROP FUNCTION event_times_closed_guard()')
@@ -0,0 +1,167 @@
+"""create-student-point-rollups-table
+
+Revision ID: d019e5e9a599
+Revises: d15a8b3f6e92
+Create Date: 2026-10-19 12:08:37.114502
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd019e5e9a599'
+down_revision = 'd15a8b3f6e92'
+branch_labels = None
+depends_on = None
+
+# adds (or removes) points of a student in a quarter range, rows without points are removed
+adjust_function = """
+    CREATE FUNCTION adjust_point_rollup(p_quarter_range_id integer, p_user_id integer, p_is_sport boolean, p_points integer)
+    RETURNS void AS $$
+    BEGIN
+        IF p_points > 0 THEN
+            INSERT INTO student_point_rollups (quarter_range_id, user_id, is_sport, points)
+            VALUES (p_quarter_range_id, p_user_id, p_is_sport, p_points)
+            ON CONFLICT (quarter_range_id, user_id, is_sport) DO UPDATE SET points = student_point_rollups.points + EXCLUDED.points;
+        ELSIF p_points < 0 THEN
+            UPDATE student_point_rollups SET points = points + p_points
+            WHERE quarter_range_id = p_quarter_range_id AND user_id = p_user_id AND is_sport = p_is_sport;
+            DELETE FROM student_point_rollups
+            WHERE quarter_range_id = p_quarter_range_id AND user_id = p_user_id AND is_sport = p_is_sport AND points <= 0;
+        END IF;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+# a point counts for the quarter range of its event time and the is_sport of its event.
+# when a parent is deleted its before delete trigger removes all of its points, the cascaded
+# deletes of the children then can't find the parent and skip them
+student_points_function = """
+    CREATE FUNCTION student_points_rollup() RETURNS trigger AS $$
+    DECLARE
+        v_quarter_range_id integer;
+        v_is_sport boolean;
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            SELECT et.quarter_range_id, e.is_sport INTO v_quarter_range_id, v_is_sport
+            FROM event_times et JOIN events e ON e.id = et.event_id WHERE et.id = OLD.event_time_id;
+            IF FOUND THEN
+                PERFORM adjust_point_rollup(v_quarter_range_id, OLD.user_id, v_is_sport, -1);
+            END IF;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            SELECT et.quarter_range_id, e.is_sport INTO v_quarter_range_id, v_is_sport
+            FROM event_times et JOIN events e ON e.id = et.event_id WHERE et.id = NEW.event_time_id;
+            IF FOUND THEN
+                PERFORM adjust_point_rollup(v_quarter_range_id, NEW.user_id, v_is_sport, 1);
+            END IF;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+# moves the points of an event time when its quarter range or event changes, removes them when it is deleted
+event_times_function = """
+    CREATE FUNCTION event_times_rollup() RETURNS trigger AS $$
+    DECLARE
+        v_old_is_sport boolean;
+        v_new_is_sport boolean;
+        v_row record;
+    BEGIN
+        SELECT is_sport INTO v_old_is_sport FROM events WHERE id = OLD.event_id;
+        IF NOT FOUND THEN
+            RETURN OLD;
+        END IF;
+        IF TG_OP = 'UPDATE' THEN
+            SELECT is_sport INTO v_new_is_sport FROM events WHERE id = NEW.event_id;
+            IF NEW.quarter_range_id = OLD.quarter_range_id AND v_new_is_sport = v_old_is_sport THEN
+                RETURN NEW;
+            END IF;
+        END IF;
+        FOR v_row IN SELECT user_id, count(*) AS points FROM student_points WHERE event_time_id = OLD.id GROUP BY user_id LOOP
+            PERFORM adjust_point_rollup(OLD.quarter_range_id, v_row.user_id, v_old_is_sport, -v_row.points::integer);
+            IF TG_OP = 'UPDATE' THEN
+                PERFORM adjust_point_rollup(NEW.quarter_range_id, v_row.user_id, v_new_is_sport, v_row.points::integer);
+            END IF;
+        END LOOP;
+        IF TG_OP = 'DELETE' THEN
+            RETURN OLD;
+        END IF;
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+# moves the points of an event when is_sport changes, removes them when it is deleted
+events_function = """
+    CREATE FUNCTION events_rollup() RETURNS trigger AS $$
+    DECLARE
+        v_row record;
+    BEGIN
+        IF TG_OP = 'UPDATE' AND NEW.is_sport = OLD.is_sport THEN
+            RETURN NEW;
+        END IF;
+        FOR v_row IN SELECT et.quarter_range_id, sp.user_id, count(*) AS points
+            FROM event_times et JOIN student_points sp ON sp.event_time_id = et.id
+            WHERE et.event_id = OLD.id GROUP BY et.quarter_range_id, sp.user_id LOOP
+            PERFORM adjust_point_rollup(v_row.quarter_range_id, v_row.user_id, OLD.is_sport, -v_row.points::integer);
+            IF TG_OP = 'UPDATE' THEN
+                PERFORM adjust_point_rollup(v_row.quarter_range_id, v_row.user_id, NEW.is_sport, v_row.points::integer);
+            END IF;
+        END LOOP;
+        IF TG_OP = 'DELETE' THEN
+            RETURN OLD;
+        END IF;
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+def upgrade() -> None:
+    op.create_table('student_point_rollups',
+    sa.Column('quarter_range_id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('is_sport', sa.Boolean(), nullable=False),
+    sa.Column('points', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['quarter_range_id'], ['quarter-ranges.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('quarter_range_id', 'user_id', 'is_sport')
+    )
+    op.create_index('ix_student_point_rollups_user_id', 'student_point_rollups', ['user_id'])
+    op.execute(adjust_function)
+    op.execute(student_points_function)
+    op.execute(event_times_function)
+    op.execute(events_function)
+    op.execute('CREATE TRIGGER student_points_rollup AFTER INSERT OR UPDATE OR DELETE ON student_points '
+        'FOR EACH ROW EXECUTE FUNCTION student_points_rollup()')
+    op.execute('CREATE TRIGGER event_times_rollup_delete BEFORE DELETE ON event_times '
+        'FOR EACH ROW EXECUTE FUNCTION event_times_rollup()')
+    op.execute('CREATE TRIGGER event_times_rollup_update AFTER UPDATE OF event_id, quarter_range_id ON event_times '
+        'FOR EACH ROW EXECUTE FUNCTION event_times_rollup()')
+    op.execute('CREATE TRIGGER events_rollup_delete BEFORE DELETE ON events '
+        'FOR EACH ROW EXECUTE FUNCTION events_rollup()')
+    op.execute('CREATE TRIGGER events_rollup_update AFTER UPDATE OF is_sport ON events '
+        'FOR EACH ROW EXECUTE FUNCTION events_rollup()')
+    # rollups of the points already in the db
+    op.execute("""
+        INSERT INTO student_point_rollups (quarter_range_id, user_id, is_sport, points)
+        SELECT et.quarter_range_id, sp.user_id, e.is_sport, count(*)
+        FROM student_points sp JOIN event_times et ON et.id = sp.event_time_id JOIN events e ON e.id = et.event_id
+        GROUP BY et.quarter_range_id, sp.user_id, e.is_sport
+    """)
+
+
+def downgrade() -> None:
+    op.execute('DROP TRIGGER events_rollup_update ON events')
+    op.execute('DROP TRIGGER events_rollup_delete ON events')
+    op.execute('DROP TRIGGER event_times_rollup_update ON event_times')
+    op.execute('DROP TRIGGER event_times_rollup_delete ON event_times')
+    op.execute('DROP TRIGGER student_points_rollup ON student_points')
+    op.execute('DROP FUNCTION events_rollup()')
+    op.execute('DROP FUNCTION event_times_rollup()')
+    op.execute('DROP FUNCTION student_points_rollup()')
+    op.execute('DROP FUNCTION adjust_point_rollup(integer, integer, boolean, integer)')
+    op.drop_index('ix_student_point_rollups_user_id', table_name='student_point_rollups')
+    op.drop_table('student_point_rollups')
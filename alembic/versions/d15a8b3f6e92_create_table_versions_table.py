@@ -0,0 +1,34 @@
+"""create-table-versions-table
+
+Revision ID: d15a8b3f6e92
+Revises: a4c7e2f95d31
+Create Date: 2026-10-19 11:26:52.530418
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd15a8b3f6e92'
+down_revision = 'a4c7e2f95d31'
+branch_labels = None
+depends_on = None
+
+versions_table = sa.table('table_versions',
+    sa.column('table_name', sa.String), sa.column('version', sa.BigInteger))
+
+# tables that read endpoints make etags from
+versioned_tables = ['users', 'events', 'prizes', 'quarters', 'quarter-ranges', 'event_times', 'student_points', 'student_winners']
+
+def upgrade() -> None:
+    op.create_table('table_versions',
+    sa.Column('table_name', sa.String(), nullable=False),
+    sa.Column('version', sa.BigInteger(), server_default=sa.text('0'), nullable=False),
+    sa.PrimaryKeyConstraint('table_name')
+    )
+    op.bulk_insert(versions_table, [{'table_name': table, 'version': 0} for table in versioned_tables])
+
+
+def downgrade() -> None:
+    op.drop_table('table_versions')
@@ -0,0 +1,113 @@
+# production server for the api and maintenance commands
+# example: python -m app serve --port 8000 --workers 4
+# example: python -m app archive --min-age-days 30
+# workers, threadpool size and keep alive come from settings (WEB_CONCURRENCY, THREADPOOL_SIZE, KEEP_ALIVE_SECONDS)
+# unless they are passed in. uvloop is used when it is installed and httptools parses http
+import argparse
+import os
+import sys
+import tempfile
+from datetime import timedelta
+
+import uvicorn
+from uvicorn.supervisors import Multiprocess
+
+# cpus this process may run on (respects cpu affinity of containers)
+def cpu_count():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def event_loop():
+    try:
+        import uvloop  # noqa: F401
+        return 'uvloop'
+    except ImportError:
+        return 'asyncio'
+
+def http_parser():
+    try:
+        import httptools  # noqa: F401
+        return 'httptools'
+    except ImportError:
+        return 'h11'
+
+# uvicorn server that ends the live leaderboard streams as soon as the worker is asked to stop,
+# otherwise it waits for viewers that never disconnect before shutting down
+class Server(uvicorn.Server):
+    def handle_exit(self, sig, frame):
+        from app import leaderboard_stream
+        leaderboard_stream.hub.close_soon()
+        super().handle_exit(sig, frame)
+
+def serve(args):
+    # workers read their settings from the environment, so options passed in are set there first
+    if args.threads:
+        os.environ['THREADPOOL_SIZE'] = str(args.threads)
+    from app.config import settings
+    workers = args.workers or settings.web_concurrency or cpu_count()
+    keep_alive = args.keep_alive or settings.keep_alive_seconds
+    # every worker counts its own requests, they share them through the metrics directory so /metrics has all of them
+    if workers > 1:
+        from app import metrics
+        metrics_dir = settings.metrics_dir or tempfile.mkdtemp(prefix='app-metrics-')
+        metrics.clear_shared(metrics_dir)
+        os.environ['METRICS_DIR'] = metrics_dir
+
+    config = uvicorn.Config('app.main:app', host=args.host, port=args.port, workers=workers, loop=event_loop(),
+        http=http_parser(), lifespan='on', timeout_keep_alive=keep_alive, backlog=args.backlog,
+        limit_concurrency=args.limit_concurrency, limit_max_requests=args.limit_max_requests,
+        proxy_headers=True, forwarded_allow_ips=args.forwarded_allow_ips, access_log=not args.no_access_log,
+        log_level=args.log_level)
+    print(f'serving on {args.host}:{args.port} with {workers} workers, {settings.threadpool_size} threads each, '
+        f'{config.loop} loop, {config.http} http, {keep_alive}s keep alive')
+    server = Server(config=config)
+    if workers > 1:
+        Multiprocess(config, target=server.run, sockets=[config.bind_socket()]).run()
+    else:
+        server.run()
+    return 0
+
+# moves the points of closed quarter ranges to the archive table
+def archive(args):
+    from app import archive as point_archive
+    from app.database import SessionLocal
+    db = SessionLocal()
+    try:
+        moved = point_archive.archive(db, timedelta(days=args.min_age_days), args.quarter_range_id, args.batch_size)
+    finally:
+        db.close()
+    for quarter_range_id, points in moved.items():
+        print(f'quarter range {quarter_range_id}: archived {points} points')
+    if not moved:
+        print('no closed quarter ranges to archive')
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m app', description='Student point management system api')
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve_parser = commands.add_parser('serve', help='run the api with multiple workers')
+    serve_parser.add_argument('--host', default='0.0.0.0')
+    serve_parser.add_argument('--port', type=int, default=8000)
+    serve_parser.add_argument('--workers', type=int, default=0, help='worker processes (default WEB_CONCURRENCY or the number of cpus)')
+    serve_parser.add_argument('--threads', type=int, default=0, help='threads per worker for sync routes (default THREADPOOL_SIZE)')
+    serve_parser.add_argument('--keep-alive', type=int, default=0, help='seconds idle connections stay open (default KEEP_ALIVE_SECONDS)')
+    serve_parser.add_argument('--backlog', type=int, default=2048)
+    serve_parser.add_argument('--limit-concurrency', type=int, default=None, help='connections per worker before 503s are returned')
+    serve_parser.add_argument('--limit-max-requests', type=int, default=None, help='restart a worker after this many requests')
+    serve_parser.add_argument('--forwarded-allow-ips', default='127.0.0.1', help='proxies trusted for X-Forwarded-* headers')
+    serve_parser.add_argument('--log-level', default='info')
+    serve_parser.add_argument('--no-access-log', action='store_true')
+    archive_parser = commands.add_parser('archive', help='move the points of closed quarter ranges to the archive table')
+    archive_parser.add_argument('--min-age-days', type=int, default=30, help='only quarter ranges that ended at least this long ago')
+    archive_parser.add_argument('--quarter-range-id', type=int, default=None, help='only this quarter range (it must be closed)')
+    archive_parser.add_argument('--batch-size', type=int, default=5000, help='points moved per transaction')
+    args = parser.parse_args(argv)
+    if args.command == 'serve':
+        return serve(args)
+    if args.command == 'archive':
+        return archive(args)
+    return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,64 @@
+# moves the points of closed quarter ranges out of student_points into student_points_archive
+# student_points only keeps the points of quarter ranges that can still change, so it and its indexes stay small.
+# the points keep their ids, their rollups (app.archiving stops the rollup and guard triggers while they are moved) and the
+# frozen standings of the quarter range, so leaderboards, exports and winners don't need the archived rows.
+# lists that can include archived points read both tables (see point_table in routers/student_points.py)
+# example: python -m app archive --min-age-days 30
+import logging
+from datetime import timedelta
+from typing import Optional
+
+from sqlalchemy import text, update
+from sqlalchemy.orm import Session
+
+from . import models, quarter_calendar
+
+logger = logging.getLogger('app.archive')
+
+# points moved by one statement, each batch is its own transaction
+BATCH_SIZE = 5000
+
+# moves a batch of points of a quarter range to the archive
+move_statement = text("""
+    WITH moved AS (
+        DELETE FROM student_points WHERE id IN (SELECT sp.id FROM student_points sp JOIN event_times et ON et.id = sp.event_time_id
+            WHERE et.quarter_range_id = :quarter_range_id LIMIT :batch_size)
+        RETURNING id, user_id, event_time_id)
+    INSERT INTO student_points_archive (id, user_id, event_time_id) SELECT id, user_id, event_time_id FROM moved
+""")
+
+# closed quarter ranges that ended at least min_age ago and weren't archived yet
+def archivable(db: Session, min_age: timedelta):
+    rows = db.query(models.QuarterClose.quarter_range_id).join(models.Quarter_Range,
+        models.Quarter_Range.id == models.QuarterClose.quarter_range_id).filter(
+        models.QuarterClose.archived_at == None, models.Quarter_Range.deleted_at == None,
+        models.Quarter_Range.end_range <= quarter_calendar.now() - min_age).order_by(models.Quarter_Range.start_range).all()
+    return [row.quarter_range_id for row in rows]
+
+# archives the points of a closed quarter range, returns the number moved
+# points of a closed quarter range can't change (the guard trigger of student_points rejects them in the db), so
+# nothing is added behind the batches. lists read the archive of every closed quarter range, not only the archived
+# ones, so they don't wait for a mark either. the quarter range is marked archived with the last batch, an archive
+# that stopped part way is finished by the next run
+def archive_quarter_range(db: Session, quarter_range_id: int, batch_size: int = BATCH_SIZE):
+    total = 0
+    while True:
+        db.execute(text("SET LOCAL app.archiving = 'on'"))
+        moved = db.execute(move_statement, {'quarter_range_id': quarter_range_id, 'batch_size': batch_size}).rowcount
+        total += moved
+        if moved < batch_size:
+            break
+        db.commit()
+    db.execute(update(models.QuarterClose).where(models.QuarterClose.quarter_range_id == quarter_range_id).values(
+        archived_at=text('now()')), execution_options={'synchronize_session': False})
+    db.commit()
+    logger.info('archived %s points of quarter range %s', total, quarter_range_id)
+    return total
+
+# archives every closed quarter range that ended at least min_age ago (or the one passed in)
+def archive(db: Session, min_age: timedelta, quarter_range_id: Optional[int] = None, batch_size: int = BATCH_SIZE):
+    ids = archivable(db, min_age)
+    if quarter_range_id is not None:
+        ids = [id for id in ids if id == quarter_range_id]
+    db.rollback()
+    return {id: archive_quarter_range(db, id, batch_size) for id in ids}
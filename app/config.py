@@ -11,6 +11,36 @@ class Settings(BaseSettings):
     secret_key: str
     algorithm: str
     access_token_expire_minutes: int
+    # statements slower than this are logged and kept for admins (0 turns it off)
+    slow_query_threshold_ms: int = 500
+    # runs EXPLAIN (ANALYZE, BUFFERS) for slow select statements in the background
+    slow_query_explain: bool = False
+    # number of recent slow queries kept in memory
+    slow_query_log_size: int = 100
+    # connections kept open by each worker and extra ones allowed under load
+    # (sync routes run in the threadpool so threadpool_size should not be much more than both added up)
+    database_pool_size: int = 10
+    database_max_overflow: int = 30
+    # read replicas (comma separated postgresql:// urls) that leaderboards, lists, exports and steps read from
+    # when empty every session uses the primary
+    database_replica_urls: str = ''
+    # seconds a client reads from the primary after it wrote, so it sees its own writes while replicas catch up
+    replica_sticky_seconds: int = 10
+    # threads each worker runs sync routes and dependencies in
+    threadpool_size: int = 40
+    # worker processes of python -m app serve (0 uses the number of cpus)
+    web_concurrency: int = 0
+    # directory the workers share their request metrics in, so /metrics of any worker has the counts of all of them.
+    # python -m app serve uses a temporary directory when it is empty and runs more than one worker
+    metrics_dir: str = ''
+    # seconds an idle keep alive connection stays open
+    keep_alive_seconds: int = 5
+    # rows deleted by one statement of a deletion job (each batch is its own transaction)
+    deletion_batch_size: int = 1000
+    # runs deletion jobs on a background thread of each worker (false leaves them for deletion_jobs.run_pending)
+    deletion_jobs_in_background: bool = True
+    # seconds between checks for quarter ranges that ended and should be closed (0 turns it off)
+    quarter_close_check_seconds: int = 60
     # gets them from .env file
     class Config:
         env_file = ".env"
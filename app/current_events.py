@@ -0,0 +1,53 @@
+# in memory list of the event times happening now or soon (for kiosk check-in)
+# the event times that end after now and start in the next WINDOW are loaded with their event name, and the
+# ongoing ones are filtered in memory for every scan. the list is reloaded when the event times or events
+# version changes or when the window has passed
+import threading
+from datetime import timedelta
+
+from sqlalchemy.orm import Session
+
+from . import etag, models, quarter_calendar
+
+# event times starting this far ahead are loaded too, so the list only has to be reloaded once per window
+WINDOW = timedelta(hours=12)
+
+class CurrentEvents:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.event_times = []
+        self.version = None
+        self.loaded_until = None
+
+    # event times that end after now and start before the end of the window
+    def load(self, db: Session, version):
+        current_time = quarter_calendar.now()
+        until = current_time + WINDOW
+        event_times = db.query(models.EventTime.id, models.EventTime.event_id, models.EventTime.quarter_range_id,
+            models.EventTime.start_time, models.EventTime.end_time, models.Events.name).join(
+            models.Events, models.Events.id == models.EventTime.event_id).filter(
+            models.EventTime.end_time > current_time, models.EventTime.start_time < until, models.Events.deleted_at == None).order_by(
+            models.EventTime.start_time, models.EventTime.id).all()
+        with self.lock:
+            self.event_times = event_times
+            self.version = version
+            self.loaded_until = until
+        return event_times
+
+    # event times happening now
+    def ongoing(self, db: Session):
+        table_versions = etag.versions.get(db)
+        version = (table_versions.get(etag.EVENT_TIMES), table_versions.get(etag.EVENTS))
+        current_time = quarter_calendar.now()
+        with self.lock:
+            fresh = etag.is_current(self.version, version) and self.loaded_until is not None and current_time < self.loaded_until
+            event_times = self.event_times
+        if not fresh:
+            event_times = self.load(db, version)
+        return [e for e in event_times if e.start_time < current_time < e.end_time]
+
+events = CurrentEvents()
+
+# module function used by the routers
+def get_ongoing(db: Session):
+    return events.ongoing(db)
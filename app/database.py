@@ -1,17 +1,40 @@
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
 import psycopg2
 from psycopg2.extras import RealDictCursor
 import time
+import itertools
 from .config import settings
 
 # defines database url for app using config 
 SQLALCHEMY_DATABASE_URL = f'postgresql://{settings.database_username}:{settings.database_password}@{settings.database_hostname}:{settings.database_port}/{settings.database_name}'
 
 # connects to database and runs session
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind = engine)
+# pool is sized from settings so every worker has a known number of connections
+engine = create_engine(SQLALCHEMY_DATABASE_URL, pool_size=settings.database_pool_size, max_overflow=settings.database_max_overflow)
+# read replicas from settings (comma separated urls), each with its own pool
+replica_engines = [create_engine(url.strip(), pool_size=settings.database_pool_size, max_overflow=settings.database_max_overflow)
+    for url in settings.database_replica_urls.split(',') if url.strip()]
+# next replica to hand out
+replica_counter = itertools.count()
+
+# picks a replica round robin, None when there are none
+def choose_replica():
+    if not replica_engines:
+        return None
+    return replica_engines[next(replica_counter) % len(replica_engines)]
+
+# session that runs its statements on the replica in info['replica'] (set before its first query by read routes)
+# and on the primary otherwise. flushes always go to the primary
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, **kw):
+        replica = self.info.get('replica')
+        if replica is not None and not self._flushing:
+            return replica
+        return engine
+
+SessionLocal = sessionmaker(class_=RoutingSession, autocommit=False, autoflush=False, bind = engine)
 Base = declarative_base()
 
 # method for user to connect to the db
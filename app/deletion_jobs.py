@@ -0,0 +1,208 @@
+# deletes users, events and quarter ranges in the background
+# an admin delete hides the row (deleted_at) and adds a deletion job in the same transaction, so it returns right
+# away. the job deletes the children of the row in batches of deletion_batch_size rows, each batch in its own short
+# transaction so point entry never waits on a long delete, and then deletes the row itself (nothing is left to cascade).
+# jobs run on a background thread of the worker that added them. jobs of a worker that stopped and failed jobs are
+# picked up again by a background task of every worker that looks for them every RETRY_CHECK_SECONDS, and when a
+# worker starts or adds a job
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import func, text, update
+from sqlalchemy.orm import Session
+
+from . import etag, leaderboard_stream, models, quarter_close
+from .config import settings
+from .database import SessionLocal
+
+logger = logging.getLogger('app.deletion_jobs')
+
+# a running job whose progress wasn't updated for this long is taken over, a failed job is tried again after it
+STALE_SECONDS = 300
+# how often every worker looks for jobs to take over or try again
+RETRY_CHECK_SECONDS = 60
+
+# children deleted in batches before the row, in order (points before the event times they reference)
+# :id is the id of the row, :batch_size the rows deleted by one statement
+CHILD_DELETES = {
+    'events': [
+        'DELETE FROM student_points WHERE id IN (SELECT sp.id FROM student_points sp JOIN event_times et ON et.id = sp.event_time_id '
+        'WHERE et.event_id = :id LIMIT :batch_size)',
+        'DELETE FROM student_points_archive WHERE id IN (SELECT sp.id FROM student_points_archive sp JOIN event_times et ON et.id = sp.event_time_id '
+        'WHERE et.event_id = :id LIMIT :batch_size)',
+        'DELETE FROM event_times WHERE id IN (SELECT id FROM event_times WHERE event_id = :id LIMIT :batch_size)',
+    ],
+    'quarter-ranges': [
+        'DELETE FROM student_points WHERE id IN (SELECT sp.id FROM student_points sp JOIN event_times et ON et.id = sp.event_time_id '
+        'WHERE et.quarter_range_id = :id LIMIT :batch_size)',
+        'DELETE FROM student_points_archive WHERE id IN (SELECT sp.id FROM student_points_archive sp JOIN event_times et ON et.id = sp.event_time_id '
+        'WHERE et.quarter_range_id = :id LIMIT :batch_size)',
+        'DELETE FROM event_times WHERE id IN (SELECT id FROM event_times WHERE quarter_range_id = :id LIMIT :batch_size)',
+        'DELETE FROM student_winners WHERE id IN (SELECT id FROM student_winners WHERE quarter_range_id = :id LIMIT :batch_size)',
+        'DELETE FROM quarter_standings WHERE (quarter_range_id, user_id) IN (SELECT quarter_range_id, user_id FROM quarter_standings '
+        'WHERE quarter_range_id = :id LIMIT :batch_size)',
+    ],
+    'users': [
+        'DELETE FROM student_points WHERE id IN (SELECT id FROM student_points WHERE user_id = :id LIMIT :batch_size)',
+        'DELETE FROM student_points_archive WHERE id IN (SELECT id FROM student_points_archive WHERE user_id = :id LIMIT :batch_size)',
+        'DELETE FROM student_winners WHERE id IN (SELECT id FROM student_winners WHERE user_id = :id LIMIT :batch_size)',
+        'DELETE FROM user_steps WHERE id IN (SELECT id FROM user_steps WHERE user_id = :id LIMIT :batch_size)',
+        'DELETE FROM quarter_standings WHERE (quarter_range_id, user_id) IN (SELECT quarter_range_id, user_id FROM quarter_standings '
+        'WHERE user_id = :id LIMIT :batch_size)',
+        'DELETE FROM idempotency_keys WHERE (user_id, key) IN (SELECT user_id, key FROM idempotency_keys WHERE user_id = :id LIMIT :batch_size)',
+    ],
+}
+
+# the row itself, the rollups and quarter closes left cascade with it
+ROW_DELETES = {
+    'events': 'DELETE FROM events WHERE id = :id',
+    'quarter-ranges': 'DELETE FROM "quarter-ranges" WHERE id = :id',
+    'users': 'DELETE FROM users WHERE id = :id',
+}
+
+# closed quarter ranges whose frozen standings change when the points of the row go away, refrozen with every
+# batch of points. a deleted user's standings are refrozen without them when they are hidden, and a deleted
+# quarter range goes away with its standings
+CLOSED_QUARTER_RANGES = {
+    'events': 'SELECT DISTINCT et.quarter_range_id FROM event_times et JOIN quarter_closes qc ON qc.quarter_range_id = et.quarter_range_id '
+        'WHERE et.event_id = :id',
+}
+
+# table versions bumped by every batch, so etags change while the children go away
+BUMPED_TABLES = {
+    'events': [etag.EVENTS, etag.EVENT_TIMES, etag.STUDENT_POINTS],
+    'quarter-ranges': [etag.QUARTER_RANGES, etag.EVENT_TIMES, etag.STUDENT_POINTS, etag.STUDENT_WINNERS, etag.QUARTER_STANDINGS],
+    'users': [etag.USERS, etag.STUDENT_POINTS, etag.STUDENT_WINNERS, etag.QUARTER_STANDINGS],
+}
+
+# takes the oldest job that is pending (or running in a worker that stopped, or failed a while ago)
+claim_statement = text("""
+    UPDATE deletion_jobs SET status = 'running', error = NULL, updated_at = now()
+    WHERE id = (SELECT id FROM deletion_jobs
+        WHERE status = 'pending' OR (status IN ('running', 'failed') AND updated_at < now() - make_interval(secs => :stale_seconds))
+        ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED)
+    RETURNING id, table_name, record_id
+""")
+
+# lets the batches delete points of closed quarter ranges (the guard trigger of student_points skips them), the
+# standings are refrozen by the batch or were refrozen when the row was hidden
+deleting_statement = text("SET LOCAL app.deleting = 'on'")
+
+deletion_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='deletion-jobs')
+# set on shutdown, a running job stops after its current batch and is picked up again later
+stopping = threading.Event()
+
+# hides the row and adds its deletion job in one statement, the job is returned (no row when there is nothing to hide)
+SOFT_DELETES = {table_name: text(f"""
+    WITH hidden AS (UPDATE "{table_name}" SET deleted_at = now() WHERE id = :id AND deleted_at IS NULL RETURNING id)
+    INSERT INTO deletion_jobs (table_name, record_id) SELECT :table_name, id FROM hidden RETURNING *
+""") for table_name in ROW_DELETES}
+
+# hides the row and adds its deletion job, committed by the route with the rest of its transaction
+# returns the job, None when the row doesn't exist or is already hidden.
+# a hidden student leaves the frozen standings of the closed quarter ranges right away
+def soft_delete(db: Session, table_name: str, id: int):
+    job = db.execute(SOFT_DELETES[table_name], {'id': id, 'table_name': table_name}).first()
+    if job is not None and table_name == 'users':
+        quarter_close.refreeze(db, [r.quarter_range_id for r in db.query(models.QuarterStanding.quarter_range_id).filter(
+            models.QuarterStanding.user_id == id).all()])
+    return job
+
+# runs the pending jobs on the background thread, called after a route committed a job and on startup
+def wake():
+    if settings.deletion_jobs_in_background and not stopping.is_set():
+        deletion_executor.submit(run_pending)
+
+# runs jobs until none are left to claim
+def run_pending():
+    while not stopping.is_set():
+        db = SessionLocal()
+        try:
+            job = db.execute(claim_statement, {'stale_seconds': STALE_SECONDS}).first()
+            db.commit()
+            if job is None:
+                return
+            run_job(db, job)
+        except Exception:
+            logger.exception('could not run the deletion jobs')
+            return
+        finally:
+            db.close()
+
+def set_progress(db: Session, job_id: int, **values):
+    db.execute(update(models.DeletionJob).where(models.DeletionJob.id == job_id).values(updated_at=func.now(), **values),
+        execution_options={'synchronize_session': False})
+
+# deletes the children in batches and then the row, a failed job keeps its error until it is tried again
+def run_job(db: Session, job):
+    params = {'id': job.record_id, 'batch_size': settings.deletion_batch_size}
+    try:
+        closed_ids = []
+        if job.table_name in CLOSED_QUARTER_RANGES:
+            closed_ids = [row.quarter_range_id for row in db.execute(text(CLOSED_QUARTER_RANGES[job.table_name]), params)]
+        # the setting lasts until the transaction ends, it is set again after each commit. statements that deleted
+        # nothing have nothing to commit and the next one runs in the same transaction
+        deleting = False
+        for statement in CHILD_DELETES[job.table_name]:
+            while True:
+                if stopping.is_set():
+                    return
+                if not deleting:
+                    db.execute(deleting_statement)
+                    deleting = True
+                deleted = db.execute(text(statement), params).rowcount
+                if deleted:
+                    set_progress(db, job.id, deleted_rows=models.DeletionJob.deleted_rows + deleted)
+                    etag.bump(db, *BUMPED_TABLES[job.table_name])
+                    # the rollups changed with the points, the frozen standings follow in the same transaction
+                    if statement.startswith('DELETE FROM student_points'):
+                        quarter_close.refreeze(db, closed_ids)
+                    db.commit()
+                    deleting = False
+                if deleted < settings.deletion_batch_size:
+                    break
+        if not deleting:
+            db.execute(deleting_statement)
+        deleted = db.execute(text(ROW_DELETES[job.table_name]), params).rowcount
+        set_progress(db, job.id, deleted_rows=models.DeletionJob.deleted_rows + deleted, status='done', finished_at=func.now())
+        etag.bump(db, *BUMPED_TABLES[job.table_name])
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.exception('deletion job %s of %s %s failed', job.id, job.table_name, job.record_id)
+        set_progress(db, job.id, status='failed', error=str(e)[:500])
+        db.commit()
+        return
+    logger.info('deletion job %s removed %s %s', job.id, job.table_name, job.record_id)
+    # points were removed, live leaderboards reload
+    leaderboard_stream.reload()
+
+# looks for stale and failed jobs every RETRY_CHECK_SECONDS until cancelled, the jobs run on the background thread
+async def run():
+    while True:
+        await asyncio.sleep(RETRY_CHECK_SECONDS)
+        wake()
+
+task = None
+
+def start():
+    global task
+    if settings.deletion_jobs_in_background and task is None:
+        task = asyncio.get_running_loop().create_task(run())
+
+async def stop():
+    global task
+    if task is None:
+        return
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    task = None
+
+def shutdown():
+    stopping.set()
+    deletion_executor.shutdown(wait=True)
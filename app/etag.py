@@ -0,0 +1,235 @@
+# conditional GET for read endpoints
+# every mutation increments a version counter for the tables it changes, in the transaction that changes them.
+# read endpoints send an ETag made from the versions of the tables they read and the query params,
+# and answer 304 Not Modified before running their query when the client already has that ETag
+import hashlib
+import logging
+import threading
+
+from fastapi import Depends, Request, Response, status
+from sqlalchemy import event, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from . import models, oauth2
+from .database import SessionLocal, engine, get_db
+
+logger = logging.getLogger('app.etag')
+
+# versions are re-read from the db this often by a background thread of each worker so bumps from other workers are seen
+VERSION_CACHE_TTL_SECONDS = 1.0
+# name of the thread that re-reads the versions
+THREAD_NAME_PREFIX = 'table-versions'
+
+# tables that have a version counter
+USERS = 'users'
+EVENTS = 'events'
+PRIZES = 'prizes'
+QUARTERS = 'quarters'
+QUARTER_RANGES = 'quarter-ranges'
+EVENT_TIMES = 'event_times'
+STUDENT_POINTS = 'student_points'
+STUDENT_WINNERS = 'student_winners'
+QUARTER_STANDINGS = 'quarter_standings'
+
+# version of the points of one quarter range, bumped by point changes (its row is added by the first bump) instead of
+# STUDENT_POINTS so concurrent point writes of different quarter ranges don't wait for the lock of one row. caches of
+# one quarter range (the rank index) aren't reloaded by changes to the others. STUDENT_POINTS is only bumped by
+# changes of many points (deleted events, quarter ranges and users)
+def quarter_points(quarter_range_id: int):
+    return f'{STUDENT_POINTS}:{quarter_range_id}'
+
+# prefix of the versions of every quarter range's points
+QUARTER_POINTS_PREFIX = quarter_points('')
+
+# version of a table in an etag. the points version is STUDENT_POINTS plus the version of every quarter range's
+# points, every version only goes up so any point change gives a higher sum
+def etag_version(table_versions: dict, table: str):
+    if table != STUDENT_POINTS:
+        return table_versions.get(table, 0)
+    return table_versions.get(STUDENT_POINTS, 0) + sum(version for name, version in table_versions.items()
+        if name.startswith(QUARTER_POINTS_PREFIX))
+
+# raised by the conditional dependency, app returns 304 for it
+class NotModified(Exception):
+    def __init__(self, etag: str):
+        self.etag = etag
+
+async def not_modified_handler(request: Request, exc: NotModified):
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={'ETag': exc.etag, 'Cache-Control': 'private, no-cache'})
+
+# copy of the table_versions rows, read by requests without a query
+# kept per database (primary and each replica) so an etag is never made from versions newer than the data read.
+# a background thread re-reads the databases in use every VERSION_CACHE_TTL_SECONDS, a database is only read by a
+# request the first time it is used. the copy can be behind the db (bumps of other workers), so caches built from it
+# reload up to a poll late and a 304 re-reads the versions it is made from (read_versions).
+# versions only go up, a read that started before an increment can't undo it
+class VersionCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # engine -> versions
+        self.cached = {}
+        self.poller = None
+        self.stopping = threading.Event()
+
+    def get(self, db: Session):
+        bind = db.get_bind()
+        with self.lock:
+            versions = self.cached.get(bind)
+        if versions is None:
+            versions = self.load(bind)
+            self.start()
+        return versions
+
+    def load(self, bind):
+        table = models.TableVersion.__table__
+        with bind.connect() as connection:
+            versions = dict(connection.execute(select(table.c.table_name, table.c.version)).all())
+        return self.merge(bind, versions)
+
+    def merge(self, bind, versions: dict):
+        with self.lock:
+            merged = dict(self.cached.get(bind, {}))
+            for table, version in versions.items():
+                if version > merged.get(table, 0):
+                    merged[table] = version
+            self.cached[bind] = merged
+            return merged
+
+    def start(self):
+        with self.lock:
+            if self.poller is not None:
+                return
+            self.poller = threading.Thread(target=self.poll, name=f'{THREAD_NAME_PREFIX}-poll', daemon=True)
+        self.poller.start()
+
+    def poll(self):
+        while not self.stopping.wait(VERSION_CACHE_TTL_SECONDS):
+            with self.lock:
+                binds = list(self.cached)
+            for bind in binds:
+                try:
+                    self.load(bind)
+                except Exception:
+                    logger.exception('could not read the table versions of %s', bind.url.host)
+
+versions = VersionCache()
+
+# whether a cache loaded at the versions loaded (a tuple, None when it isn't loaded) has every change counted by
+# version. versions only go up, so a cache loaded from the primary stays current for a replica that is behind it
+# and requests routed to either don't reload it in turn
+def is_current(loaded, version):
+    return loaded is not None and all((old or 0) >= (new or 0) for old, new in zip(loaded, version))
+
+# increments the version of tables changed by the current transaction, adding the rows of tables that weren't bumped
+# before. called right before db.commit(), the version commits with the data so an etag is never made from an old
+# version and new data, also when the worker dies after the commit. the rows are locked until the commit, so it is the
+# last statement of the transaction. tables are locked in name order so two transactions can't deadlock on them
+# returns the new versions by table
+def bump(db: Session, *tables: str):
+    table = models.TableVersion.__table__
+    statement = insert(table).values([{'table_name': name, 'version': 1} for name in sorted(set(tables))])
+    statement = statement.on_conflict_do_update(index_elements=[table.c.table_name], set_={'version': table.c.version + 1})
+    new_versions = dict(db.execute(statement.returning(table.c.table_name, table.c.version)).all())
+    # kept with the (nested) transaction they ran in, a savepoint that is rolled back undoes them
+    transaction = db.get_nested_transaction() or db.get_transaction()
+    db.info.setdefault('bumped_versions', []).append((transaction, new_versions))
+    return new_versions
+
+# the versions of a commit go into the copy of the primary, caches of this worker reload right away
+@event.listens_for(SessionLocal, 'after_commit')
+def cache_after_commit(session):
+    for _, new_versions in session.info.pop('bumped_versions', []):
+        versions.merge(engine, new_versions)
+
+# forgets the versions bumped in the transaction (or savepoint) that was rolled back
+@event.listens_for(SessionLocal, 'after_soft_rollback')
+def clear_after_rollback(session, previous_transaction):
+    def rolled_back(transaction):
+        while transaction is not None:
+            if transaction is previous_transaction:
+                return True
+            transaction = transaction.parent
+        return False
+    bumped = [(transaction, new_versions) for transaction, new_versions in session.info.pop('bumped_versions', [])
+        if not rolled_back(transaction)]
+    if bumped:
+        session.info['bumped_versions'] = bumped
+
+# reads the versions of the tables from the db of the session (one primary key lookup), for a 304
+# the points versions of every quarter range are read with STUDENT_POINTS
+def read_versions(db: Session, tables):
+    table = models.TableVersion.__table__
+    condition = table.c.table_name.in_(sorted(set(tables)))
+    if STUDENT_POINTS in tables:
+        condition = condition | table.c.table_name.startswith(QUARTER_POINTS_PREFIX, autoescape=True)
+    rows = db.execute(select(table.c.table_name, table.c.version).where(condition)).all()
+    return versions.merge(db.get_bind(), dict(rows))
+
+# stops the version reads, on worker shutdown
+def shutdown():
+    versions.stopping.set()
+
+# whether users aren't deleted, looked up by id one user at a time and forgotten when the users version changes
+# a 304 only verifies the token, so the user of the token is looked up here instead of by get_current_user
+class ActiveUsers:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # user id -> not deleted
+        self.active = {}
+        self.version = None
+
+    def contains(self, db: Session, user_id: int, version):
+        version = (version,)
+        with self.lock:
+            if is_current(self.version, version) and user_id in self.active:
+                return self.active[user_id]
+        active = db.query(models.User.id).filter(models.User.id == user_id, models.User.deleted_at == None).first() is not None
+        with self.lock:
+            if not is_current(self.version, version):
+                self.active = {}
+                self.version = version
+            # a replica behind the cached version may not have its deletes yet
+            if self.version == version:
+                self.active[user_id] = active
+        return active
+
+active_users = ActiveUsers()
+
+# makes a weak etag from the route, query params, table versions and (for per user responses) the user
+def make_etag(request: Request, table_versions: dict, tables, user_id=None):
+    parts = [request.url.path, str(sorted(request.query_params.multi_items()))]
+    parts += [f'{table}={etag_version(table_versions, table)}' for table in tables]
+    if user_id is not None:
+        parts.append(f'user={user_id}')
+    return 'W/"' + hashlib.sha1('|'.join(parts).encode()).hexdigest()[:20] + '"'
+
+# checks if any etag in If-None-Match is the current one
+def etag_matches(if_none_match: str, etag: str):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    return etag in [tag.strip() for tag in if_none_match.split(',')]
+
+# dependency for read endpoints. add to the route with dependencies=[Depends(conditional(...))]
+# runs before the current user is loaded, the token is verified and a 304 is only sent to a user that isn't deleted
+# (from the in memory active users), other requests load the user with get_current_user
+def conditional(*tables: str, per_user: bool = False):
+    def check_etag(request: Request, response: Response, token: str = Depends(oauth2.oauth2_scheme), db: Session = Depends(get_db)):
+        token_data = oauth2.verify_access_token(token, oauth2.credentials_exception())
+        user_id = token_data.id if per_user else None
+        table_versions = versions.get(db)
+        etag = make_etag(request, table_versions, tables, user_id)
+        if_none_match = request.headers.get('if-none-match')
+        # the copy of the versions can be behind the db, the etag of a 304 is made from the versions in the db
+        if if_none_match:
+            table_versions = read_versions(db, [*tables, USERS])
+            etag = make_etag(request, table_versions, tables, user_id)
+        if etag_matches(if_none_match, etag):
+            if not active_users.contains(db, int(token_data.id), table_versions.get(USERS)):
+                raise oauth2.credentials_exception()
+            raise NotModified(etag)
+        response.headers['ETag'] = etag
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return check_etag
@@ -0,0 +1,72 @@
+# pages built straight from selected columns
+# list endpoints with nested schemas (student points -> event time -> event and quarter range -> quarter) spend most
+# of their time creating orm objects and validating them with orm_mode schemas. these routes select only the columns
+# they send, build the dicts of the page from the rows and return them with orjson.
+# the route keeps its response_model for the docs, the dicts have the same fields in the same order.
+# lite pages only have the own columns of each item and list the rows they reference once in included
+from typing import Optional, Set
+
+from fastapi import Response
+from fastapi.responses import ORJSONResponse
+from fastapi_pagination.api import resolve_params
+from sqlalchemy import func
+from sqlalchemy.orm import Query
+
+# referenced rows of a lite page (like json:api included), every row is listed once per page
+# fields are the item fields that are sent, rows referenced through a field that isn't sent are left out
+class Included:
+    def __init__(self, fields: Optional[Set[str]] = None):
+        self.fields = fields
+        self.tables = {}
+
+    # adds the row with the id to the table, make_row is only called the first time
+    def add(self, table: str, field: str, id, make_row):
+        if id is None or (self.fields is not None and field not in self.fields):
+            return
+        rows = self.tables.setdefault(table, {})
+        if id not in rows:
+            rows[id] = make_row()
+
+    def content(self):
+        return {table: list(rows.values()) for table, rows in self.tables.items()}
+
+# fields=id,user_id as a set, None for all fields
+def parse_fields(fields: str):
+    names = {name.strip() for name in fields.split(',') if name.strip()}
+    return names or None
+
+# runs the page query of a query paginated in the db, the total is counted by the same statement (count(*) over ())
+# a page past the end has no row to read the total from, it is counted with a second statement.
+# a total kept elsewhere (the participants of a closed quarter range) is passed in and nothing is counted
+def page_rows(query: Query, total: Optional[int] = None):
+    params = resolve_params()
+    raw_params = params.to_raw_params()
+    if total is not None:
+        return params, total, query.limit(raw_params.limit).offset(raw_params.offset).all()
+    rows = query.add_columns(func.count().over().label('page_total')).limit(raw_params.limit).offset(raw_params.offset).all()
+    if rows:
+        total = rows[0].page_total
+    elif raw_params.offset:
+        total = query.order_by(None).with_entities(func.count()).scalar()
+    else:
+        total = 0
+    return params, total, rows
+
+# paginates the query in the db and returns the page with to_item(row) for every row
+# response is the response of the route, its headers (like the etag) are copied to the page response
+def page_response(query: Query, to_item, response: Response, total: Optional[int] = None):
+    params, total, rows = page_rows(query, total)
+    content = {"items": [to_item(row._mapping) for row in rows], "total": total, "page": params.page, "size": params.size}
+    return ORJSONResponse(content, headers=dict(response.headers))
+
+# lite page, to_item(row, included) returns the item and adds the rows it references to included
+# only the item fields in fields (comma separated, empty for all) are sent
+def lite_page_response(query: Query, to_item, response: Response, fields: str = ''):
+    params, total, rows = page_rows(query)
+    names = parse_fields(fields)
+    included = Included(names)
+    items = [to_item(row._mapping, included) for row in rows]
+    if names is not None:
+        items = [{key: value for key, value in item.items() if key in names} for item in items]
+    content = {"items": items, "total": total, "page": params.page, "size": params.size, "included": included.content()}
+    return ORJSONResponse(content, headers=dict(response.headers))
@@ -0,0 +1,146 @@
+# idempotency keys for requests that clients retry (point entry from scanners on flaky wifi)
+# a request sent with an Idempotency-Key header claims the key in its own transaction and stores its response
+# with the change it made. a retry with the same key gets the stored response back without writing again,
+# a retry sent while the first request is still running waits on the claim until it commits.
+# recent responses are also kept in memory so retry storms are answered without the db
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from fastapi import HTTPException, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import event, func, text, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from . import models
+from .database import SessionLocal
+
+logger = logging.getLogger('app.idempotency')
+
+# stored responses are replayed for this long, then the key can be used again
+KEY_TTL = timedelta(days=1)
+# responses kept in memory by each worker
+CACHE_SIZE = 1024
+# expired keys are removed at most this often by each worker, this many per transaction
+CLEANUP_SECONDS = 600
+CLEANUP_BATCH_SIZE = 1000
+# longest key accepted
+MAX_KEY_LENGTH = 255
+# header set on replayed responses
+REPLAYED_HEADER = 'Idempotent-Replayed'
+
+# hash of the route and body of a request, a key can only be replayed for the same request
+def fingerprint(route: str, body) -> str:
+    return hashlib.sha1(f'{route}|{json.dumps(jsonable_encoder(body), sort_keys=True)}'.encode()).hexdigest()
+
+# lru of stored responses, (user id, key) -> (fingerprint, status code, content, stored at)
+# stored responses never change so every worker can keep its own copy
+class ResponseCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, user_id: int, key: str):
+        with self.lock:
+            entry = self.entries.get((user_id, key))
+            if entry is None:
+                return None
+            if time.monotonic() - entry[3] > KEY_TTL.total_seconds():
+                del self.entries[(user_id, key)]
+                return None
+            self.entries.move_to_end((user_id, key))
+            return entry
+
+    def put(self, user_id: int, key: str, key_fingerprint: str, status_code: int, content):
+        with self.lock:
+            self.entries[(user_id, key)] = (key_fingerprint, status_code, content, time.monotonic())
+            self.entries.move_to_end((user_id, key))
+            while len(self.entries) > CACHE_SIZE:
+                self.entries.popitem(last=False)
+
+responses = ResponseCache()
+cleanup_lock = threading.Lock()
+last_cleanup = 0.0
+cleanup_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='idempotency-cleanup')
+
+# a batch of expired keys, keys another worker is removing (or a request is claiming again) are skipped
+cleanup_statement = text("""
+    DELETE FROM idempotency_keys WHERE (user_id, key) IN (SELECT user_id, key FROM idempotency_keys
+        WHERE created_at < now() - make_interval(secs => :ttl_seconds) LIMIT :batch_size FOR UPDATE SKIP LOCKED)
+""")
+
+# the stored response, or 422 when the key was used for a different request
+def replay(key_fingerprint: str, stored_fingerprint: str, status_code: int, content):
+    if stored_fingerprint != key_fingerprint:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Idempotency-Key was already used for a different request")
+    return ORJSONResponse(content, status_code=status_code, headers={REPLAYED_HEADER: 'true'})
+
+# removes the expired keys in short transactions of their own
+def remove_expired():
+    db = SessionLocal()
+    try:
+        while True:
+            deleted = db.execute(cleanup_statement, {'ttl_seconds': KEY_TTL.total_seconds(), 'batch_size': CLEANUP_BATCH_SIZE}).rowcount
+            db.commit()
+            if deleted < CLEANUP_BATCH_SIZE:
+                return
+    except Exception:
+        logger.exception('could not remove expired idempotency keys')
+    finally:
+        db.close()
+
+# removes expired keys on a background thread, at most once every CLEANUP_SECONDS per worker
+# (not in the transaction of the request, where it would wait on other workers and be lost when the request fails)
+def cleanup():
+    global last_cleanup
+    with cleanup_lock:
+        if time.monotonic() - last_cleanup < CLEANUP_SECONDS:
+            return
+        last_cleanup = time.monotonic()
+    cleanup_executor.submit(remove_expired)
+
+# claims the key for the current transaction
+# returns None when the request should run, or the response of the request that already used the key
+def claim(db: Session, user_id: int, key: str, key_fingerprint: str):
+    if len(key) > MAX_KEY_LENGTH:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Idempotency-Key can't be longer than {MAX_KEY_LENGTH} characters")
+    entry = responses.get(user_id, key)
+    if entry is not None:
+        return replay(key_fingerprint, *entry[:3])
+    cleanup()
+    table = models.IdempotencyKey.__table__
+    # an expired key is claimed again, a key in use by a running request blocks until that request commits or rolls back
+    statement = insert(table).values(user_id=user_id, key=key, fingerprint=key_fingerprint).on_conflict_do_update(
+        index_elements=[table.c.user_id, table.c.key],
+        set_={'fingerprint': key_fingerprint, 'status_code': None, 'response': None, 'created_at': func.now()},
+        where=table.c.created_at < func.now() - KEY_TTL).returning(table.c.key)
+    if db.execute(statement).first() is not None:
+        return None
+    stored = db.query(models.IdempotencyKey).filter(models.IdempotencyKey.user_id == user_id, models.IdempotencyKey.key == key).first()
+    if stored is None or stored.status_code is None:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="A request with this Idempotency-Key is still running")
+    responses.put(user_id, key, stored.fingerprint, stored.status_code, stored.response)
+    return replay(key_fingerprint, stored.fingerprint, stored.status_code, stored.response)
+
+# stores the response of a claimed key, called before db.commit() so it is committed with the change
+def store(db: Session, user_id: int, key: str, key_fingerprint: str, status_code: int, content):
+    db.execute(update(models.IdempotencyKey).where(models.IdempotencyKey.user_id == user_id, models.IdempotencyKey.key == key).values(
+        status_code=status_code, response=content), execution_options={'synchronize_session': False})
+    db.info.setdefault('idempotent_responses', []).append((user_id, key, key_fingerprint, status_code, content))
+
+# responses are only cached once they are committed
+@event.listens_for(SessionLocal, 'after_commit')
+def cache_after_commit(session):
+    for response in session.info.pop('idempotent_responses', ()):
+        responses.put(*response)
+
+@event.listens_for(SessionLocal, 'after_rollback')
+def clear_after_rollback(session):
+    session.info.pop('idempotent_responses', None)
@@ -0,0 +1,318 @@
+# live leaderboard over server sent events
+# the hub keeps the standings of every quarter range that has viewers in memory. point changes from the
+# routers are applied once in the event loop and the rank changes are broadcast to every viewer of the
+# quarter range, so a point change costs one update no matter how many students are watching
+import asyncio
+import json
+from bisect import bisect_left, bisect_right, insort
+from typing import Dict, Set
+
+from anyio import to_thread
+from fastapi import Request
+from sqlalchemy import func, select
+
+from . import etag, models, quarter_close
+from .database import SessionLocal, choose_replica
+from .schemas.Users import UserPointOut
+
+# comment line sent when nothing happened so proxies and browsers keep the connection open
+HEARTBEAT_SECONDS = 15
+# standings are reloaded this often while they have viewers so changes made by other workers are picked up
+RESYNC_SECONDS = 60
+# messages kept for a slow viewer, when full the viewer gets a new snapshot instead of the backlog
+CLIENT_BUFFER_SIZE = 64
+
+# user data sent with each leaderboard entry
+def user_entry(user):
+    return UserPointOut.from_orm(user).dict()
+
+# points per student of a quarter range (same totals as the /leaderboards query), from the frozen standings
+# when the quarter range is closed (its points may be archived), with the points version of the quarter range
+# read from a replica, the viewers are kept up to date with the changes published by the routers. the version and
+# the points are read in one snapshot, the changes published with a higher version aren't in the points
+def load_standings(quarter_range_id: int):
+    db = SessionLocal(info={'replica': choose_replica()})
+    try:
+        db.connection(execution_options={'isolation_level': 'REPEATABLE READ'})
+        table = models.TableVersion.__table__
+        version = db.execute(select(table.c.version).where(table.c.table_name == etag.quarter_points(quarter_range_id))).scalar() or 0
+        if quarter_close.get_participants(db, quarter_range_id) is not None:
+            rows = db.query(models.User, models.QuarterStanding.points.label("points")).join(
+                models.QuarterStanding, models.QuarterStanding.user_id == models.User.id).filter(
+                models.QuarterStanding.quarter_range_id == quarter_range_id, models.User.deleted_at == None).all()
+            return {row.User.id: (user_entry(row.User), row.points) for row in rows}, version
+        rows = db.query(models.User, func.count(models.StudentPoint.id).label("points")).join(
+            models.StudentPoint, models.StudentPoint.user_id == models.User.id
+        ).join(models.EventTime, models.EventTime.id == models.StudentPoint.event_time_id).join(
+            models.Events, (models.Events.id == models.EventTime.event_id) & (models.Events.deleted_at == None)).join(
+            models.Quarter_Range, (models.Quarter_Range.id == models.EventTime.quarter_range_id) & (models.Quarter_Range.deleted_at == None)).filter(
+            models.EventTime.quarter_range_id == quarter_range_id, models.User.deleted_at == None
+        ).group_by(models.User.id).all()
+        return {row.User.id: (user_entry(row.User), row.points) for row in rows}, version
+    finally:
+        db.close()
+
+# formats a server sent event
+def sse(event: str, data: dict):
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+# points and ranks of the students of one quarter range
+# students with the same points share a rank (1, 2, 2, 4), ranks are looked up with bisect in the sorted points
+# the same way as quarter_ranks.RankIndex so a point change only moves the students it passes
+class Standings:
+    def __init__(self, rows: dict, version: int):
+        self.load(rows, version)
+
+    # version is the points version of the quarter range the rows were read at
+    def load(self, rows: dict, version: int):
+        self.version = version
+        self.users = {user_id: user for user_id, (user, _) in rows.items()}
+        self.points = {user_id: points for user_id, (_, points) in rows.items()}
+        self.sorted_points = sorted(self.points.values())
+        # points -> ids of the students with them
+        self.students = {}
+        for user_id, points in self.points.items():
+            self.students.setdefault(points, set()).add(user_id)
+
+    # rank of a student with the points, one more than the number of students with more points
+    def rank(self, points: int):
+        return len(self.sorted_points) - bisect_right(self.sorted_points, points) + 1
+
+    # user id -> (rank, points)
+    def ranking(self):
+        return {user_id: (self.rank(points), points) for user_id, points in self.points.items()}
+
+    def entry(self, user_id: int):
+        points = self.points[user_id]
+        return {"rank": self.rank(points), "points": points, "User": self.users[user_id]}
+
+    def snapshot(self):
+        order = sorted(self.points, key=lambda user_id: (-self.points[user_id], user_id))
+        return [self.entry(user_id) for user_id in order]
+
+    # adds or removes points of a student, returns the entries whose rank or points changed
+    # only the student and the students with points between its old and new points change rank
+    def change(self, user_id: int, user, delta: int):
+        old = self.points.get(user_id, 0)
+        new = old + delta
+        if new > 0:
+            if user is not None:
+                self.users[user_id] = user
+            if user_id not in self.users:
+                return None
+        elif not old:
+            return None
+        if old:
+            del self.sorted_points[bisect_left(self.sorted_points, old)]
+            self.students[old].discard(user_id)
+            if not self.students[old]:
+                del self.students[old]
+        if new > 0:
+            self.points[user_id] = new
+            insort(self.sorted_points, new)
+            self.students.setdefault(new, set()).add(user_id)
+        else:
+            del self.points[user_id]
+        low, high = sorted((old, new))
+        changed = {other for points in range(max(low, 1), high) for other in self.students.get(points, ())}
+        if new > 0:
+            changed.add(user_id)
+        changes = sorted((self.entry(other) for other in changed), key=lambda entry: entry["rank"])
+        return changes, [] if new > 0 else [user_id]
+
+    # replaces the standings with reloaded rows, returns what changed
+    def replace(self, rows: dict, version: int):
+        before = self.ranking()
+        self.load(rows, version)
+        after = self.ranking()
+        changes = [self.entry(user_id) for user_id, value in after.items() if before.get(user_id) != value]
+        removed = [user_id for user_id in before if user_id not in after]
+        changes.sort(key=lambda entry: entry["rank"])
+        return changes, removed
+
+# a viewer with its own bounded buffer of formatted messages
+class Subscriber:
+    def __init__(self):
+        self.queue = asyncio.Queue(maxsize=CLIENT_BUFFER_SIZE)
+
+    def send(self, message: str, snapshot):
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            # drops the backlog and starts the viewer over from the current standings
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(snapshot())
+
+    # ends the stream of the viewer after what it was already sent
+    def close(self):
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+# fan out of point changes to the viewers. all state is changed in the event loop thread,
+# the sync routers hand their changes over with call_soon_threadsafe
+class LeaderboardHub:
+    def __init__(self):
+        self.loop = None
+        self.standings: Dict[int, Standings] = {}
+        self.subscribers: Dict[int, Set[Subscriber]] = {}
+        self.loading: Dict[int, asyncio.Task] = {}
+        # changes published while the standings of a quarter range load, applied after the load
+        self.pending: Dict[int, list] = {}
+        self.resync_task = None
+        self.closing = False
+
+    def watched(self, quarter_range_id: int):
+        return self.loop is not None and (quarter_range_id in self.standings or quarter_range_id in self.pending)
+
+    def snapshot_message(self, quarter_range_id: int):
+        return sse("snapshot", {"quarter_range_id": quarter_range_id,
+            "leaderboard": self.standings[quarter_range_id].snapshot()})
+
+    # sends a message to every viewer of the quarter range, the snapshot is only built for overflowing viewers
+    def broadcast(self, quarter_range_id: int, message: str):
+        snapshot = None
+        def get_snapshot():
+            nonlocal snapshot
+            if snapshot is None:
+                snapshot = self.snapshot_message(quarter_range_id)
+            return snapshot
+        for subscriber in self.subscribers.get(quarter_range_id, ()):
+            subscriber.send(message, get_snapshot)
+
+    def broadcast_changes(self, quarter_range_id: int, changes):
+        if not changes or not (changes[0] or changes[1]):
+            return
+        self.broadcast(quarter_range_id, sse("delta", {"quarter_range_id": quarter_range_id,
+            "changes": changes[0], "removed": changes[1]}))
+
+    # version is the points version of the quarter range the change was committed with. a change made while the
+    # standings load is also kept for the loaded standings, and a change the loaded points already have (its version
+    # isn't above theirs) is skipped
+    def apply(self, quarter_range_id: int, user_id: int, user, delta: int, version: int):
+        pending = self.pending.get(quarter_range_id)
+        if pending is not None:
+            pending.append((user_id, user, delta, version))
+        standings = self.standings.get(quarter_range_id)
+        if standings and version > standings.version:
+            self.broadcast_changes(quarter_range_id, standings.change(user_id, user, delta))
+
+    # loads (or reloads) the standings of a quarter range once even if many viewers connect at the same time
+    async def load(self, quarter_range_id: int):
+        task = self.loading.get(quarter_range_id)
+        if task is None:
+            self.pending[quarter_range_id] = []
+            task = asyncio.ensure_future(self.install(quarter_range_id))
+            self.loading[quarter_range_id] = task
+            task.add_done_callback(lambda _: self.loading.pop(quarter_range_id, None))
+        await asyncio.shield(task)
+
+    # sets the loaded standings and applies the changes published during the load that they don't have. the viewers of reloaded
+    # standings are sent what changed, new standings are sent as a snapshot. standings that lost their viewers
+    # during the load aren't kept
+    async def install(self, quarter_range_id: int):
+        try:
+            rows, version = await to_thread.run_sync(load_standings, quarter_range_id)
+        finally:
+            pending = self.pending.pop(quarter_range_id, [])
+        if quarter_range_id not in self.subscribers:
+            return
+        pending = [(user_id, user, delta) for user_id, user, delta, change_version in pending if change_version > version]
+        standings = self.standings.get(quarter_range_id)
+        if standings is None:
+            standings = self.standings[quarter_range_id] = Standings(rows, version)
+            for change in pending:
+                standings.change(*change)
+            return
+        self.broadcast_changes(quarter_range_id, standings.replace(rows, version))
+        for change in pending:
+            self.broadcast_changes(quarter_range_id, standings.change(*change))
+
+    async def subscribe(self, quarter_range_id: int, subscriber: Subscriber):
+        self.loop = asyncio.get_running_loop()
+        self.subscribers.setdefault(quarter_range_id, set()).add(subscriber)
+        if quarter_range_id not in self.standings:
+            await self.load(quarter_range_id)
+        subscriber.queue.put_nowait(self.snapshot_message(quarter_range_id))
+        if self.resync_task is None or self.resync_task.done():
+            self.resync_task = asyncio.ensure_future(self.resync_loop())
+
+    def unsubscribe(self, quarter_range_id: int, subscriber: Subscriber):
+        subscribers = self.subscribers.get(quarter_range_id)
+        if subscribers is None:
+            return
+        subscribers.discard(subscriber)
+        # standings without viewers are dropped so they don't go stale
+        if not subscribers:
+            self.subscribers.pop(quarter_range_id, None)
+            self.standings.pop(quarter_range_id, None)
+
+    # reloads the standings of every watched quarter range and sends what changed
+    async def resync(self):
+        for quarter_range_id in list(self.standings):
+            if quarter_range_id in self.standings:
+                await self.load(quarter_range_id)
+
+    async def resync_loop(self):
+        while self.subscribers:
+            await asyncio.sleep(RESYNC_SECONDS)
+            await self.resync()
+
+    # event stream for one viewer, with heartbeats while nothing changes
+    async def stream(self, request: Request, quarter_range_id: int):
+        subscriber = Subscriber()
+        try:
+            if self.closing:
+                return
+            await self.subscribe(quarter_range_id, subscriber)
+            while True:
+                try:
+                    message = await asyncio.wait_for(subscriber.queue.get(), HEARTBEAT_SECONDS)
+                    if message is None:
+                        break
+                    yield message
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": heartbeat\n\n"
+        finally:
+            self.unsubscribe(quarter_range_id, subscriber)
+
+    # ends every stream so a shutting down server doesn't wait for viewers that never disconnect
+    # runs in the event loop (signal handler or shutdown hook)
+    def close(self):
+        self.closing = True
+        for subscribers in self.subscribers.values():
+            for subscriber in subscribers:
+                subscriber.close()
+        if self.resync_task is not None:
+            self.resync_task.cancel()
+
+    # closes from any thread (the server's signal handler)
+    def close_soon(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.close)
+
+    # called by the routers after a point change is committed (from the threadpool)
+    def publish(self, quarter_range_id: int, user_id: int, user, delta: int, version: int):
+        if self.watched(quarter_range_id):
+            self.loop.call_soon_threadsafe(self.apply, quarter_range_id, user_id, user, delta, version)
+
+    # called after changes that move or remove many points (event times, users, quarter ranges)
+    def publish_reload(self):
+        if self.loop is not None and self.standings:
+            self.loop.call_soon_threadsafe(lambda: asyncio.ensure_future(self.resync()))
+
+hub = LeaderboardHub()
+
+# module functions used by the routers, version is the points version of the quarter range returned by etag.bump
+def point_added(quarter_range_id: int, user, version: int):
+    if hub.watched(quarter_range_id):
+        hub.publish(quarter_range_id, user.id, user_entry(user), 1, version)
+
+def point_removed(quarter_range_id: int, user_id: int, version: int):
+    hub.publish(quarter_range_id, user_id, None, -1, version)
+
+def reload():
+    hub.publish_reload()
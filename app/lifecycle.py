@@ -0,0 +1,66 @@
+# startup and shutdown of a worker
+# startup sizes the threadpool sync routes run in, warms the db pool and the caches so the first requests
+# of a new worker aren't slower than the rest, starts the task that closes quarter ranges that ended, resumes
+# unfinished deletion jobs and starts the task that tries stale and failed ones again, and shares the metrics of the
+# worker with the others. shutdown stops them, ends the live leaderboard streams, waits for the background work
+# that is still queued and closes the db connections
+import logging
+
+from anyio import to_thread
+
+from . import current_events, deletion_jobs, etag, leaderboard_stream, metrics, prize_catalog, quarter_calendar, quarter_close, slow_query
+from .config import settings
+from .database import SessionLocal, engine, replica_engines
+
+logger = logging.getLogger('app.lifecycle')
+
+# loads the in memory caches that are out of date, so requests don't load them
+def load_caches():
+    db = SessionLocal()
+    try:
+        etag.versions.get(db)
+        # the versions of the replicas too, a request routed to one doesn't read them first
+        for replica_engine in replica_engines:
+            etag.versions.load(replica_engine)
+        quarter_calendar.get_quarter_ranges(db)
+        current_events.get_ongoing(db)
+        prize_catalog.catalog.refresh(db)
+        quarter_close.get_closed(db)
+    finally:
+        db.close()
+
+# opens the connections the pool keeps and loads the in memory caches
+def warm_up():
+    connections = []
+    try:
+        for _ in range(engine.pool.size()):
+            connections.append(engine.connect())
+    finally:
+        # returned to the pool and kept open for the first requests
+        for connection in connections:
+            connection.close()
+    load_caches()
+
+async def startup():
+    # sync routes and dependencies share this many threads (anyio's default is 40)
+    to_thread.current_default_thread_limiter().total_tokens = settings.threadpool_size
+    try:
+        await to_thread.run_sync(warm_up)
+    except Exception:
+        # a worker still starts when the db is not up yet, requests connect when it is
+        logger.exception('could not warm up the database pool and caches')
+    quarter_close.start()
+    deletion_jobs.wake()
+    deletion_jobs.start()
+    metrics.start_shared()
+
+async def shutdown():
+    leaderboard_stream.hub.close()
+    await quarter_close.stop()
+    await deletion_jobs.stop()
+    await to_thread.run_sync(deletion_jobs.shutdown)
+    await to_thread.run_sync(slow_query.shutdown)
+    await to_thread.run_sync(etag.shutdown)
+    await to_thread.run_sync(metrics.stop_shared)
+    for db_engine in [engine, *replica_engines]:
+        db_engine.dispose()
@@ -1,16 +1,23 @@
 from fastapi import Depends, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, PlainTextResponse
 from fastapi_pagination import add_pagination
-from app import models, oauth2
+from app import models, oauth2, metrics, slow_query, etag, lifecycle, replicas
 from app.schemas.Main import ChatBotInput
-from chatbot.chat import get_response
 from .routers import auth, user, quarter, event, student_points, prize, winner, event_times, leaderboard, user_step
+from .routers import slow_query as slow_query_router, sync, check_in, deletion_jobs
 
-from app.database import get_db
+from app.database import engine, replica_engines, get_db
 from sqlalchemy.orm import Session
 
 # defines that app is for FastAPI
-app = FastAPI()
+# responses are encoded with orjson
+app = FastAPI(default_response_class=ORJSONResponse)
+
+# sizes the threadpool and warms the db pool and caches when a worker starts,
+# ends streams and drains background work when it stops
+app.on_event("startup")(lifecycle.startup)
+app.on_event("shutdown")(lifecycle.shutdown)
 
 # origins of which server can access the app
 origins = ["http://localhost:4200"]
@@ -22,10 +29,22 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
-    # for exporting student points to user
-    expose_headers=["content-disposition"]
+    # for exporting student points to user, etag for conditional requests
+    expose_headers=["content-disposition", "etag"]
 )
 
+# records latency, status codes and sql statements of every request
+app.middleware("http")(metrics.metrics_middleware)
+# logs statements over the slow query threshold in settings
+for db_engine in [engine, *replica_engines]:
+    metrics.install_query_listeners(db_engine)
+    slow_query.install_slow_query_log(db_engine)
+# clients that wrote read from the primary for a while (only needed with read replicas)
+if replica_engines:
+    app.middleware("http")(replicas.sticky_after_write_middleware)
+# read endpoints answer 304 when the etag in If-None-Match is still current
+app.add_exception_handler(etag.NotModified, etag.not_modified_handler)
+
 # adds routes to app
 app.include_router(auth.router)
 app.include_router(user.router)
@@ -37,14 +56,25 @@ app.include_router(winner.router)
 app.include_router(event_times.router)
 app.include_router(leaderboard.router)
 app.include_router(user_step.router)
+app.include_router(slow_query_router.router)
+app.include_router(sync.router)
+app.include_router(check_in.router)
+app.include_router(deletion_jobs.router)
 
 # adds pagination for datatables in angular
 add_pagination(app)
 
+# metrics of the app in prometheus format for scraping
+@app.get('/metrics', response_class=PlainTextResponse, include_in_schema=False)
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 # Chatbot feature for qna in front end
 @app.post('/predict')
 # takes a message as an input and requires the user to be logged in.
 def predict(message: ChatBotInput, current_user = Depends(oauth2.get_current_user)):
     # get bot response from the chat.py file and return it
+    # imported here so torch, nltk and the models are only loaded by the first chatbot request, not on startup
+    from chatbot.chat import get_response
     response = get_response(message.message, current_user.role_type_id)
     return {"name": "Sam", "message": response}
\ No newline at end of file
@@ -0,0 +1,292 @@
+# request level performance metrics for the app
+# counts requests, request latency and the sql statements each request runs
+# and renders them in the prometheus text format for /metrics.
+# the workers of python -m app serve each count their own requests, they write them to a shared directory
+# (settings.metrics_dir) and /metrics of any worker adds up the files of all of them
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from fastapi import Request
+from sqlalchemy import event
+from starlette.routing import Match
+
+from .config import settings
+
+logger = logging.getLogger('app.metrics')
+
+# buckets for request latency and total sql time in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# buckets for the number of sql statements run by a request
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+# paths that are not measured (the scraper would only measure itself)
+EXCLUDED_PATHS = {'/metrics'}
+
+# seconds between writes of the metrics of a worker to the shared directory
+SHARED_WRITE_SECONDS = 1.0
+
+# stats of the request currently being handled
+# sync routes run in a threadpool which copies the context, so the object is mutated instead of re-set
+class RequestStats:
+    def __init__(self, method: str, path: str):
+        self.method = method
+        self.path = path
+        self.route = path
+        self.query_count = 0
+        self.query_time = 0.0
+
+current_request: ContextVar[Optional[RequestStats]] = ContextVar('current_request', default=None)
+
+# histogram with fixed buckets for each set of labels
+class Histogram:
+    def __init__(self, name: str, description: str, buckets):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        # labels -> [bucket counts..., sum, count]
+        self.values = {}
+
+    def observe(self, labels: tuple, value: float):
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    # adds the counts of the same labels from another worker
+    def add(self, labels: tuple, counts: list):
+        current = self.values.get(labels)
+        if current is None:
+            self.values[labels] = list(counts)
+        else:
+            self.values[labels] = [a + b for a, b in zip(current, counts)]
+
+    def render(self, label_names: tuple):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        for labels, counts in sorted(self.values.items()):
+            base = format_labels(label_names, labels)
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{format_labels(label_names + ("le",), labels + (format_value(bound),))} {count}')
+            lines.append(f'{self.name}_bucket{format_labels(label_names + ("le",), labels + ("+Inf",))} {counts[-1]}')
+            lines.append(f'{self.name}_sum{base} {format_value(counts[-2])}')
+            lines.append(f'{self.name}_count{base} {counts[-1]}')
+        return lines
+
+# formats label names and values as {name="value",...}
+def format_labels(names: tuple, values: tuple):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+# formats numbers without a trailing .0 for whole numbers
+def format_value(value: float):
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+# all metrics of the process
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests_total = {}
+        self.in_progress = 0
+        self.queries_total = 0
+        self.query_seconds_total = 0.0
+        self.request_latency = Histogram('http_request_duration_seconds', 'Request latency by route', LATENCY_BUCKETS)
+        self.request_queries = Histogram('http_request_db_queries', 'Number of SQL statements run per request by route', QUERY_COUNT_BUCKETS)
+        self.request_query_time = Histogram('http_request_db_query_seconds', 'Total SQL statement time per request by route', LATENCY_BUCKETS)
+
+    def histograms(self):
+        return [self.request_latency, self.request_queries, self.request_query_time]
+
+    def request_started(self):
+        with self.lock:
+            self.in_progress += 1
+
+    def request_finished(self, stats: RequestStats, status_code: int, elapsed: float):
+        labels = (stats.method, stats.route)
+        with self.lock:
+            self.in_progress -= 1
+            key = labels + (str(status_code),)
+            self.requests_total[key] = self.requests_total.get(key, 0) + 1
+            self.request_latency.observe(labels, elapsed)
+            self.request_queries.observe(labels, stats.query_count)
+            self.request_query_time.observe(labels, stats.query_time)
+
+    def query_finished(self, elapsed: float):
+        with self.lock:
+            self.queries_total += 1
+            self.query_seconds_total += elapsed
+
+    # all counts as json (label tuples become lists), written to the shared directory
+    def dump(self):
+        with self.lock:
+            return {'requests_total': [[*key, count] for key, count in self.requests_total.items()],
+                'in_progress': self.in_progress, 'queries_total': self.queries_total,
+                'query_seconds_total': self.query_seconds_total,
+                'histograms': {histogram.name: [[list(labels), counts] for labels, counts in histogram.values.items()]
+                    for histogram in self.histograms()}}
+
+    # adds the counts of a dump of another worker
+    def add(self, dumped: dict):
+        with self.lock:
+            for *key, count in dumped['requests_total']:
+                key = tuple(key)
+                self.requests_total[key] = self.requests_total.get(key, 0) + count
+            self.in_progress += dumped['in_progress']
+            self.queries_total += dumped['queries_total']
+            self.query_seconds_total += dumped['query_seconds_total']
+            for histogram in self.histograms():
+                for labels, counts in dumped['histograms'].get(histogram.name, []):
+                    histogram.add(tuple(labels), counts)
+
+    # returns all metrics in the prometheus text exposition format
+    def render(self):
+        with self.lock:
+            lines = ['# HELP http_requests_total Requests by route and status code', '# TYPE http_requests_total counter']
+            for (method, route, status_code), count in sorted(self.requests_total.items()):
+                lines.append(f'http_requests_total{format_labels(("method", "route", "status"), (method, route, status_code))} {count}')
+            lines += ['# HELP http_requests_in_progress Requests currently being handled', '# TYPE http_requests_in_progress gauge',
+                f'http_requests_in_progress {self.in_progress}']
+            lines += ['# HELP db_queries_total SQL statements run by the process', '# TYPE db_queries_total counter',
+                f'db_queries_total {self.queries_total}']
+            lines += ['# HELP db_query_seconds_total Time spent running SQL statements', '# TYPE db_query_seconds_total counter',
+                f'db_query_seconds_total {format_value(self.query_seconds_total)}']
+            lines += self.request_latency.render(('method', 'route'))
+            lines += self.request_queries.render(('method', 'route'))
+            lines += self.request_query_time.render(('method', 'route'))
+        return '\n'.join(lines) + '\n'
+
+registry = MetricsRegistry()
+
+# metrics of all workers from the files in a directory, one per worker (named by pid)
+# a worker writes its file every SHARED_WRITE_SECONDS and when it stops, so the counts of a worker that was
+# restarted stay in the totals (with no requests in progress)
+class SharedMetrics:
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.path = os.path.join(directory, f'{os.getpid()}.json')
+        self.stopping = threading.Event()
+        self.writer = None
+
+    # replaced in one step, a reader never sees half a file
+    def write(self):
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(registry.dump(), f)
+        os.replace(temp_path, self.path)
+
+    def start(self):
+        self.writer = threading.Thread(target=self.run, name='metrics-writer', daemon=True)
+        self.writer.start()
+
+    def run(self):
+        while not self.stopping.wait(SHARED_WRITE_SECONDS):
+            try:
+                self.write()
+            except OSError:
+                logger.exception('could not write the metrics to %s', self.path)
+
+    def stop(self):
+        self.stopping.set()
+        if self.writer is not None:
+            self.writer.join()
+        self.write()
+
+    # this worker's file is written first so its own counts are current
+    def render(self):
+        self.write()
+        total = MetricsRegistry()
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            try:
+                with open(path) as f:
+                    total.add(json.load(f))
+            except (OSError, ValueError):
+                logger.exception('could not read the metrics of %s', path)
+        return total.render()
+
+shared = None
+
+# removes the files of an earlier run, called by python -m app serve before the workers start
+def clear_shared(directory: str):
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        os.remove(path)
+
+# called on worker startup and shutdown
+def start_shared():
+    global shared
+    if settings.metrics_dir and shared is None:
+        shared = SharedMetrics(settings.metrics_dir)
+        shared.start()
+
+def stop_shared():
+    global shared
+    if shared is not None:
+        shared.stop()
+        shared = None
+
+# metrics of all workers when they share a directory, else of this process
+def render():
+    if shared is not None:
+        return shared.render()
+    return registry.render()
+
+# finds the route template (ex. /users/{id}) so ids don't create a label per row
+def find_route(request: Request):
+    for route in request.app.router.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return route.path
+    return 'unmatched'
+
+# middleware that times every request and records its sql statements
+async def metrics_middleware(request: Request, call_next):
+    if request.url.path in EXCLUDED_PATHS:
+        return await call_next(request)
+    stats = RequestStats(request.method, request.url.path)
+    stats.route = find_route(request)
+    token = current_request.set(stats)
+    registry.request_started()
+    start = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        registry.request_finished(stats, status_code, time.perf_counter() - start)
+        current_request.reset(token)
+
+# times each sql statement with sqlalchemy cursor events on the engine
+def install_query_listeners(engine):
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start_time'].pop()
+        registry.query_finished(elapsed)
+        stats = current_request.get()
+        if stats is not None:
+            stats.query_count += 1
+            stats.query_time += elapsed
+
+    # a failed statement never reaches after_cursor_execute so drop its start time
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        if context.connection is not None and context.connection.info.get('query_start_time'):
+            context.connection.info['query_start_time'].pop()
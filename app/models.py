@@ -1,8 +1,14 @@
 # defines the models of the tabels inside app
-from sqlalchemy import TIMESTAMP, Boolean, Column, ForeignKey, Integer, String, text
+from sqlalchemy import TIMESTAMP, BigInteger, Boolean, Column, Float, ForeignKey, Index, Integer, String, UniqueConstraint, func, text
+from sqlalchemy.dialects.postgresql import JSONB, ExcludeConstraint
 from app.database import Base
 from sqlalchemy.orm import relationship
 
+# rows an admin deleted are hidden right away (deleted_at is set, reads filter on deleted_at == None)
+# and removed with their children by a deletion job in the background
+class SoftDelete:
+    deleted_at = Column(TIMESTAMP(timezone=True))
+
 # role table for users
 class RoleType(Base):
     # sets table name of model inside db
@@ -12,12 +18,12 @@ class RoleType(Base):
     role_type = Column(String, unique = True, nullable = False)
 
 # users table
-class User(Base):
+class User(SoftDelete, Base):
     # sets table name inside db
     __tablename__ = 'users'
     # columns inside the table
     id = Column(Integer, primary_key= True, nullable = False)
-    username = Column(String, nullable= False, unique=True)
+    username = Column(String, nullable= False)
     password = Column(String,nullable=False)
     first_name = Column(String, nullable=False)
     last_name = Column(String, nullable=False)
@@ -28,6 +34,16 @@ class User(Base):
 
     # references role (does not store in db)
     role_type = relationship("RoleType")
+    # indexes for sorting the users list (id breaks ties so pages are stable)
+    __table_args__ = (
+        Index('ix_users_first_name_id', 'first_name', 'id'),
+        Index('ix_users_last_name_id', 'last_name', 'id'),
+        Index('ix_users_grade_id', 'grade', 'id'),
+        Index('ix_users_role_type_id_id', 'role_type_id', 'id'),
+        Index('ix_users_created_at_id', 'created_at', 'id'),
+        # usernames are unique among the users that aren't deleted
+        Index('uq_users_username', 'username', unique=True, postgresql_where=text('deleted_at IS NULL')),
+    )
 
 # Quarters table
 class Quarter(Base):
@@ -36,9 +52,11 @@ class Quarter(Base):
     # columns inside the table
     id = Column(Integer, primary_key = True, nullable=False)
     quarter = Column(String, unique=True, nullable=False)
+    # set by a db trigger on every update (for /sync)
+    updated_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'), index=True)
 
 # Quarter Range Table (defines how long a quarter is)
-class Quarter_Range(Base):
+class Quarter_Range(SoftDelete, Base):
     # sets table name to quarter-ranges
     __tablename__ = 'quarter-ranges'
     # columns inside the table
@@ -46,17 +64,31 @@ class Quarter_Range(Base):
     start_range = Column(TIMESTAMP(timezone=True), nullable=False)
     end_range = Column(TIMESTAMP(timezone=True), nullable=False)
     quarter_id = Column(Integer, ForeignKey("quarters.id", ondelete='CASCADE'), nullable=False)
+    # set by a db trigger on every update (for /sync)
+    updated_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'), index=True)
     # references quarter table above
     quarter = relationship("Quarter")
+    # quarter ranges that aren't deleted cannot overlap (gist index on the range, checked by the db on insert/update)
+    __table_args__ = (
+        ExcludeConstraint((func.tstzrange(start_range, end_range, text("'[]'")), '&&'),
+            name='quarter_ranges_no_overlap', using='gist', where=text('deleted_at IS NULL')),
+        Index('ix_quarter_ranges_quarter_id', 'quarter_id'),
+    )
 
 # Events Table
-class Events(Base):
+class Events(SoftDelete, Base):
     # sets table name to events
     __tablename__ = 'events'
     # columns inside the table
     id = Column(Integer, nullable=False, primary_key= True)
-    name = Column(String, nullable = False, unique = True)
+    name = Column(String, nullable = False)
     is_sport = Column(Boolean, nullable = False)
+    # set by a db trigger on every update (for /sync)
+    updated_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'), index=True)
+    # event names are unique among the events that aren't deleted
+    __table_args__ = (
+        Index('uq_events_name', 'name', unique=True, postgresql_where=text('deleted_at IS NULL')),
+    )
 
 # Event time table
 class EventTime(Base):
@@ -66,8 +98,8 @@ class EventTime(Base):
     id = Column(Integer, nullable= False, primary_key=True)
     start_time = Column(TIMESTAMP(timezone=True), nullable=False)
     end_time = Column(TIMESTAMP(timezone=True), nullable=False)
-    event_id = Column(Integer, ForeignKey("events.id", ondelete='CASCADE'), nullable=False)
-    quarter_range_id = Column(Integer, ForeignKey("quarter-ranges.id", ondelete='CASCADE'), nullable=False)
+    event_id = Column(Integer, ForeignKey("events.id", ondelete='CASCADE'), nullable=False, index=True)
+    quarter_range_id = Column(Integer, ForeignKey("quarter-ranges.id", ondelete='CASCADE'), nullable=False, index=True)
     # references event table above
     event = relationship("Events")
     # references quarter range table above
@@ -80,10 +112,43 @@ class StudentPoint(Base):
     # columns inside the table
     id = Column(Integer, primary_key = True, nullable=False)
     user_id = Column(Integer, ForeignKey("users.id", ondelete='CASCADE'), nullable=False)
-    event_time_id = Column(Integer, ForeignKey("event_times.id", ondelete='CASCADE'), nullable =False)
+    event_time_id = Column(Integer, ForeignKey("event_times.id", ondelete='CASCADE'), nullable =False, index=True)
     # references users, and events table above.
     user = relationship("User")
     event_time= relationship("EventTime")
+    # a student has one point per event time (points are inserted with ON CONFLICT on it)
+    __table_args__ = (
+        UniqueConstraint('user_id', 'event_time_id', name='uq_student_points_user_id_event_time_id'),
+    )
+
+# Student points archive table
+# points of quarter ranges that were archived (python -m app archive), moved out of student_points so it stays small.
+# their rollups and standings are kept, lists that can include them read both tables
+class StudentPointArchive(Base):
+    # sets table name to student_points_archive
+    __tablename__ = 'student_points_archive'
+    # columns inside the table, id is the id the point had in student_points
+    id = Column(Integer, primary_key = True, autoincrement=False, nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete='CASCADE'), nullable=False)
+    event_time_id = Column(Integer, ForeignKey("event_times.id", ondelete='CASCADE'), nullable =False, index=True)
+    archived_at = Column(TIMESTAMP(timezone = True), nullable = False, server_default=text('now()'))
+    __table_args__ = (
+        UniqueConstraint('user_id', 'event_time_id', name='uq_student_points_archive_user_id_event_time_id'),
+    )
+
+# Student point rollups table
+# points of each student per quarter range and event type, kept up to date by db triggers on
+# student_points, event_times and events (for multi quarter and year to date leaderboards)
+class StudentPointRollup(Base):
+    # sets table name to student_point_rollups
+    __tablename__ = 'student_point_rollups'
+    # columns inside the table
+    quarter_range_id = Column(Integer, ForeignKey("quarter-ranges.id", ondelete='CASCADE'), primary_key=True, nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete='CASCADE'), primary_key=True, nullable=False, index=True)
+    is_sport = Column(Boolean, primary_key=True, nullable=False)
+    points = Column(Integer, nullable=False)
+    # references users table above
+    user = relationship("User")
 
 # Prizes table
 class Prize(Base):
@@ -93,6 +158,21 @@ class Prize(Base):
     id = Column(Integer, primary_key = True, nullable = False)
     name = Column(String, nullable = False, unique= True)
     level = Column(Integer, nullable = False)
+    # chance of being picked compared to the other prizes of the level
+    weight = Column(Integer, nullable = False, server_default=text('1'))
+    # prizes left, None for no limit (prizes with none left aren't picked)
+    quantity = Column(Integer)
+    # set by a db trigger on every update (for /sync)
+    updated_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'), index=True)
+
+# Prize levels table
+# a winner gets a prize of the highest level whose min_points they have
+class PrizeLevel(Base):
+    # sets table name to prize_levels
+    __tablename__ = 'prize_levels'
+    # columns inside the table
+    level = Column(Integer, primary_key = True, nullable = False)
+    min_points = Column(Integer, nullable = False, unique = True)
 
 # Student Winner table
 class StudentWinner(Base):
@@ -102,9 +182,9 @@ class StudentWinner(Base):
     id = Column(Integer, primary_key = True, nullable=False)
     top_points = Column(Boolean, nullable=False)
     points = Column(Integer, nullable=False)
-    user_id = Column(Integer, ForeignKey("users.id", ondelete='CASCADE'), nullable =False)
-    quarter_range_id = Column(Integer, ForeignKey("quarter-ranges.id", ondelete='CASCADE'), nullable=False)
-    prize_id = Column(Integer, ForeignKey("prizes.id", ondelete='SET NULL'), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete='CASCADE'), nullable =False, index=True)
+    quarter_range_id = Column(Integer, ForeignKey("quarter-ranges.id", ondelete='CASCADE'), nullable=False, index=True)
+    prize_id = Column(Integer, ForeignKey("prizes.id", ondelete='SET NULL'), nullable=False, index=True)
     # references other tables in db
     user = relationship("User")
     quarter_range = relationship("Quarter_Range")
@@ -116,8 +196,94 @@ class UserStep(Base):
     __tablename__ = 'user_steps'
     # columns inside the table
     id = Column(Integer, primary_key = True, nullable=False)
-    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
     step = Column(String, nullable=False)
     accessed_at = Column(TIMESTAMP(timezone = True), nullable = False, server_default=text('now()'))
     # references other tables in db
-    user = relationship("User")
\ No newline at end of file
+    user = relationship("User")
+
+# Sync tombstones table
+# a db trigger adds a row whenever an event, prize, quarter or quarter range is deleted
+class SyncTombstone(Base):
+    # sets table name to sync_tombstones
+    __tablename__ = 'sync_tombstones'
+    # columns inside the table
+    id = Column(Integer, primary_key = True, nullable=False)
+    table_name = Column(String, nullable=False)
+    record_id = Column(Integer, nullable=False)
+    deleted_at = Column(TIMESTAMP(timezone = True), nullable = False, server_default=text('now()'), index=True)
+
+# Table versions table
+# version of each table is bumped by the routers on every change (for etags of read endpoints)
+class TableVersion(Base):
+    # sets table name to table_versions
+    __tablename__ = 'table_versions'
+    # columns inside the table
+    table_name = Column(String, primary_key = True, nullable=False)
+    version = Column(BigInteger, nullable=False, server_default=text('0'))
+
+# Idempotency keys table
+# response of a request sent with an Idempotency-Key header, a retry with the same key gets it again
+# instead of running the request twice. rows are removed after a day
+class IdempotencyKey(Base):
+    # sets table name to idempotency_keys
+    __tablename__ = 'idempotency_keys'
+    # columns inside the table
+    user_id = Column(Integer, ForeignKey("users.id", ondelete='CASCADE'), primary_key=True, nullable=False)
+    key = Column(String, primary_key=True, nullable=False)
+    # hash of the route and body, a key can't be reused for a different request
+    fingerprint = Column(String, nullable=False)
+    status_code = Column(Integer)
+    response = Column(JSONB)
+    created_at = Column(TIMESTAMP(timezone = True), nullable = False, server_default=text('now()'), index=True)
+
+# Quarter standings table
+# final points, rank and percentile of every student with points in a quarter range, written once when the
+# quarter range is closed. closed leaderboards and user points are read from it (rows can't be updated)
+class QuarterStanding(Base):
+    # sets table name to quarter_standings
+    __tablename__ = 'quarter_standings'
+    # columns inside the table
+    quarter_range_id = Column(Integer, ForeignKey("quarter-ranges.id", ondelete='CASCADE'), primary_key=True, nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete='CASCADE'), primary_key=True, nullable=False, index=True)
+    points = Column(Integer, nullable=False)
+    rank = Column(Integer, nullable=False)
+    percentile = Column(Float, nullable=False)
+    # references users table above
+    user = relationship("User")
+    __table_args__ = (Index('ix_quarter_standings_quarter_range_id_rank', 'quarter_range_id', 'rank', 'user_id'),)
+
+# Quarter closes table
+# quarter ranges whose standings were frozen (and winners picked) after they ended
+class QuarterClose(Base):
+    # sets table name to quarter_closes
+    __tablename__ = 'quarter_closes'
+    # columns inside the table
+    quarter_range_id = Column(Integer, ForeignKey("quarter-ranges.id", ondelete='CASCADE'), primary_key=True, nullable=False)
+    closed_at = Column(TIMESTAMP(timezone = True), nullable = False, server_default=text('now()'))
+    participants = Column(Integer, nullable=False)
+    # set when the points of the quarter range were moved to student_points_archive
+    archived_at = Column(TIMESTAMP(timezone = True))
+
+# Deletion jobs table
+# an admin delete of a user, event or quarter range hides the row and adds a job, the job deletes the
+# children in batches (each its own transaction) and then the row itself. deleted_rows shows the progress
+class DeletionJob(Base):
+    # sets table name to deletion_jobs
+    __tablename__ = 'deletion_jobs'
+    # columns inside the table
+    id = Column(Integer, primary_key = True, nullable=False)
+    table_name = Column(String, nullable=False)
+    record_id = Column(Integer, nullable=False)
+    # pending, running, done or failed
+    status = Column(String, nullable=False, server_default='pending')
+    deleted_rows = Column(BigInteger, nullable=False, server_default=text('0'))
+    error = Column(String)
+    created_at = Column(TIMESTAMP(timezone = True), nullable = False, server_default=text('now()'))
+    # set after every batch, a running job that wasn't updated for a while is picked up again
+    updated_at = Column(TIMESTAMP(timezone = True), nullable = False, server_default=text('now()'))
+    finished_at = Column(TIMESTAMP(timezone = True))
+    __table_args__ = (
+        Index('ix_deletion_jobs_unfinished', 'id', postgresql_where=text("status <> 'done'")),
+    )
+
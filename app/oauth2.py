@@ -4,7 +4,7 @@ from datetime import datetime, timedelta
 from pydantic import ValidationError
 
 from .schemas import Main as schemas
-from . import database, models, main
+from . import database, models
 from fastapi import Depends, Request, status, HTTPException
 from sqlalchemy.orm import Session
 from .config import settings
@@ -84,14 +84,18 @@ def verify_access_token(token: str, credentials_exception):
         raise credentials_exception
     return token_data
 
-# returns current user from token
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(database.get_db)):
-    # exception to be used for verification
-    credentials_exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, 
+# exception to be used for verification
+def credentials_exception():
+    return HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, 
                                 detail=f'Could not validate credentials', 
                                 headers={"WWW-Authenticate": "Bearer"})
+
+# returns current user from token
+def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(database.get_db)):
     # verifies the token
-    token = verify_access_token(token, credentials_exception)
-    # gets User object from the user_id inside token and returns it
-    user = db.query(models.User).filter(models.User.id == token.id).first()
+    token = verify_access_token(token, credentials_exception())
+    # gets User object from the user_id inside token and returns it, a deleted user is logged out
+    user = db.query(models.User).filter(models.User.id == token.id, models.User.deleted_at == None).first()
+    if not user:
+        raise credentials_exception()
     return user
\ No newline at end of file
@@ -0,0 +1,107 @@
+# in memory prize catalog for choosing winner prizes
+# prize levels and the prizes that can be picked (no limit or some left) are kept in memory grouped by level.
+# the level of a winner is found with a binary search over the level thresholds, and a prize of the level is
+# picked by weight with an alias table, so choosing a prize is O(1) and doesn't query the db.
+# the catalog is reloaded when the prizes version changes (prize and level changes bump it) or is invalidated
+import random
+import threading
+from bisect import bisect_right
+from typing import Dict, List, Optional
+
+from sqlalchemy import or_, select
+from sqlalchemy.orm import Session
+
+from . import etag, models
+
+# prizes of one level with Vose's alias method, every pick is one random slot and one coin flip
+class AliasTable:
+    def __init__(self, prizes: list):
+        self.prizes = prizes
+        count = len(prizes)
+        total = sum(prize.weight for prize in prizes)
+        scaled = [prize.weight * count / total for prize in prizes]
+        self.chance = [1.0] * count
+        self.alias = list(range(count))
+        small = [i for i, value in enumerate(scaled) if value < 1]
+        large = [i for i, value in enumerate(scaled) if value >= 1]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.chance[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] -= 1 - scaled[less]
+            (small if scaled[more] < 1 else large).append(more)
+
+    def pick(self, rng: random.Random):
+        slot = rng.randrange(len(self.prizes))
+        return self.prizes[slot] if rng.random() < self.chance[slot] else self.prizes[self.alias[slot]]
+
+class PrizeCatalog:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rng = random.Random()
+        self.version = None
+        # levels sorted by min_points and the min_points for bisect
+        self.levels = []
+        self.thresholds: List[int] = []
+        self.tables: Dict[int, AliasTable] = {}
+
+    # read on a connection of its own, not in the transaction of the request: a request that took a prize (not
+    # committed yet and maybe rolled back) would load its own quantities for every request
+    def load(self, db: Session, version):
+        with db.get_bind().connect() as connection:
+            levels = connection.execute(select(models.PrizeLevel.level, models.PrizeLevel.min_points).order_by(
+                models.PrizeLevel.min_points)).all()
+            prizes = connection.execute(select(models.Prize.id, models.Prize.name, models.Prize.level, models.Prize.weight,
+                models.Prize.quantity).where(or_(models.Prize.quantity == None, models.Prize.quantity > 0)).order_by(models.Prize.id)).all()
+        by_level = {}
+        for prize in prizes:
+            by_level.setdefault(prize.level, []).append(prize)
+        with self.lock:
+            self.levels = levels
+            self.thresholds = [level.min_points for level in levels]
+            self.tables = {level: AliasTable(level_prizes) for level, level_prizes in by_level.items()}
+            self.version = version
+
+    # loads the catalog when the prizes version changed
+    def refresh(self, db: Session):
+        version = (etag.versions.get(db).get(etag.PRIZES),)
+        with self.lock:
+            if etag.is_current(self.version, version):
+                return
+        self.load(db, version)
+
+    def invalidate(self):
+        with self.lock:
+            self.version = None
+
+    # highest level whose min_points the points reach, None when they are below every level
+    def level_for(self, db: Session, points: int):
+        self.refresh(db)
+        with self.lock:
+            index = bisect_right(self.thresholds, points) - 1
+            return self.levels[index].level if index >= 0 else None
+
+    # random prize of the level by weight, None if the level has no prizes left
+    # prizes in excluded are left out, picked by weight from the rest of the level
+    def pick(self, db: Session, level: int, excluded=()):
+        self.refresh(db)
+        with self.lock:
+            table = self.tables.get(level)
+            if not table:
+                return None
+            if not excluded:
+                return table.pick(self.rng)
+            prizes = [prize for prize in table.prizes if prize.id not in excluded]
+            return self.rng.choices(prizes, weights=[prize.weight for prize in prizes])[0] if prizes else None
+
+catalog = PrizeCatalog()
+
+# module functions used by the routers
+def get_level(db: Session, points: int) -> Optional[int]:
+    return catalog.level_for(db, points)
+
+def pick_prize(db: Session, level: int, excluded=()):
+    return catalog.pick(db, level, excluded)
+
+def invalidate():
+    catalog.invalidate()
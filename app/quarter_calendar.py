@@ -0,0 +1,125 @@
+# in memory calendar of the quarter ranges
+# quarter ranges are a handful of rows that change a few times a year, so they are kept sorted in memory
+# and the current, previous and containing quarter range are found with a binary search instead of a query.
+# the calendar is reloaded when the quarter ranges or quarters version is past the one it was loaded at, so a
+# change made on one worker is seen by the others within the version cache ttl
+import threading
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from sqlalchemy.orm import Session, joinedload
+
+from . import etag, models
+from .schemas.Quarters import QuarterRangeOut
+
+# id of "Quarter 1", the school year starts with its quarter range
+FIRST_QUARTER_ID = 1
+
+# returns the current time with a timezone to compare with the timestamptz columns
+def now():
+    return datetime.now(timezone.utc)
+
+# naive datetimes are taken as the server's local time (like postgres does with its session time zone)
+def to_aware(value: datetime):
+    if value.tzinfo is None:
+        return value.astimezone()
+    return value
+
+# sorted quarter ranges with the start of each range for bisect
+class QuarterCalendar:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ranges: Optional[List[QuarterRangeOut]] = None
+        self.starts: List[datetime] = []
+        self.version = None
+
+    # loads all quarter ranges (with their quarter) sorted by start
+    # version is read before the rows, a load that raced a change keeps the old version and is loaded again
+    def load(self, db: Session, version):
+        rows = db.query(models.Quarter_Range).options(joinedload(models.Quarter_Range.quarter)).filter(
+            models.Quarter_Range.deleted_at == None).order_by(models.Quarter_Range.start_range).all()
+        ranges = [QuarterRangeOut.from_orm(row) for row in rows]
+        starts = [r.start_range for r in ranges]
+        with self.lock:
+            self.ranges = ranges
+            self.starts = starts
+            self.version = version
+        return ranges, starts
+
+    # returns the ranges and their starts, loading them when the versions changed
+    def snapshot(self, db: Session):
+        table_versions = etag.versions.get(db)
+        version = (table_versions.get(etag.QUARTER_RANGES), table_versions.get(etag.QUARTERS))
+        with self.lock:
+            if self.ranges is not None and etag.is_current(self.version, version):
+                return self.ranges, self.starts
+        return self.load(db, version)
+
+    def all(self, db: Session):
+        return self.snapshot(db)[0]
+
+    # range where start_range < value < end_range
+    def at(self, db: Session, value: datetime):
+        value = to_aware(value)
+        ranges, starts = self.snapshot(db)
+        index = bisect_left(starts, value) - 1
+        if index >= 0 and ranges[index].end_range > value:
+            return ranges[index]
+        return None
+
+    # range that fully holds start and end (start_range < start and end < end_range)
+    def containing(self, db: Session, start: datetime, end: datetime):
+        quarter_range = self.at(db, start)
+        if quarter_range and quarter_range.end_range > to_aware(end):
+            return quarter_range
+        return None
+
+    def current(self, db: Session):
+        return self.at(db, now())
+
+    # the most recent range that ended before now (not the current one)
+    def previous(self, db: Session):
+        current_time = now()
+        ranges, starts = self.snapshot(db)
+        index = bisect_right(starts, current_time) - 1
+        while index >= 0:
+            if ranges[index].end_range < current_time:
+                return ranges[index]
+            index -= 1
+        return None
+
+    # ranges from the start of the school year (the latest quarter 1 that started) that have started by now
+    def school_year(self, db: Session):
+        current_time = now()
+        ranges = [r for r in self.all(db) if r.start_range <= current_time]
+        starts = [index for index, r in enumerate(ranges) if r.quarter_id == FIRST_QUARTER_ID]
+        return ranges[starts[-1]:] if starts else ranges
+
+    # ranges that overlap start and end (either can be None for no limit)
+    def overlapping(self, db: Session, start: Optional[datetime], end: Optional[datetime]):
+        start = to_aware(start) if start else None
+        end = to_aware(end) if end else None
+        return [r for r in self.all(db) if (start is None or r.end_range >= start) and (end is None or r.start_range <= end)]
+
+calendar = QuarterCalendar()
+
+# module functions used by the routers
+def get_quarter_ranges(db: Session):
+    return calendar.all(db)
+
+def get_current(db: Session):
+    return calendar.current(db)
+
+def get_previous(db: Session):
+    return calendar.previous(db)
+
+def get_containing(db: Session, start: datetime, end: datetime):
+    return calendar.containing(db, start, end)
+
+def get_school_year(db: Session):
+    return calendar.school_year(db)
+
+def get_overlapping(db: Session, start: Optional[datetime], end: Optional[datetime]):
+    return calendar.overlapping(db, start, end)
+
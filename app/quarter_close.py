@@ -0,0 +1,159 @@
+# closes quarter ranges after they end
+# a background task of every worker checks the quarter calendar and closes the quarter ranges that ended: the
+# final standings are frozen into quarter_standings, the winners are picked and a quarter_closes row marks it
+# closed, all in one transaction. the quarter range row is locked with skip locked so only one worker closes it,
+# and not while a point change of it is being committed (see execute_point_write). leaderboards and user points
+# of closed quarter ranges are read from the frozen standings
+import asyncio
+import logging
+import threading
+
+from anyio import to_thread
+from fastapi import HTTPException, status
+from sqlalchemy import delete, text, update
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from . import etag, models, quarter_calendar
+from .config import settings
+from .database import SessionLocal
+
+logger = logging.getLogger('app.quarter_close')
+
+# final standings of a quarter range from the point rollups, deleted students are left out
+# students with the same points share a rank, percentile is the share of participants with less points
+snapshot_statement = text("""
+    INSERT INTO quarter_standings (quarter_range_id, user_id, points, rank, percentile)
+    SELECT :quarter_range_id, totals.user_id, totals.points,
+        rank() OVER (ORDER BY totals.points DESC),
+        round((rank() OVER (ORDER BY totals.points) - 1) * 100.0 / count(*) OVER (), 1)
+    FROM (SELECT r.user_id, sum(r.points) AS points FROM student_point_rollups r JOIN users u ON u.id = r.user_id
+        WHERE r.quarter_range_id = :quarter_range_id AND u.deleted_at IS NULL GROUP BY r.user_id) totals
+""")
+
+# ids of the closed quarter ranges with their number of participants
+# reloaded when the quarter standings or quarter ranges version changes (closing bumps quarter standings)
+class ClosedQuarters:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.participants = {}
+        self.version = None
+
+    def refresh(self, db: Session):
+        table_versions = etag.versions.get(db)
+        version = (table_versions.get(etag.QUARTER_STANDINGS), table_versions.get(etag.QUARTER_RANGES))
+        with self.lock:
+            if etag.is_current(self.version, version):
+                return
+        rows = db.query(models.QuarterClose.quarter_range_id, models.QuarterClose.participants).all()
+        with self.lock:
+            self.participants = {row.quarter_range_id: row.participants for row in rows}
+            self.version = version
+
+    def get(self, db: Session):
+        self.refresh(db)
+        with self.lock:
+            return self.participants
+
+closed = ClosedQuarters()
+
+# number of participants of a closed quarter range, None when it isn't closed
+def get_participants(db: Session, quarter_range_id: int):
+    return closed.get(db).get(quarter_range_id)
+
+# number of participants by the ids of the closed quarter ranges
+def get_closed(db: Session):
+    return closed.get(db)
+
+# error code of the student_points_closed_guard and event_times_closed_guard triggers, they reject a point change
+# (or an event time moved) in a closed quarter range
+CLOSED_ERROR = '55000'
+
+# runs a statement that adds, moves or deletes points, returns exception when a point is in a closed quarter range
+# (archived ones are closed too). the trigger locks the quarter range before it checks quarter_closes, so a change
+# made while the quarter range is closed waits for the close and is rejected, and a close waits for the change
+def execute_point_write(db: Session, statement, params=None):
+    try:
+        return db.execute(statement, params)
+    except OperationalError as e:
+        if getattr(e.orig, 'pgcode', None) != CLOSED_ERROR:
+            raise
+        db.rollback()
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=e.orig.diag.message_primary)
+
+# freezes the standings of closed quarter ranges again, in the transaction that changed their points or students
+# (a deletion job removing the points of a deleted event, a deleted student)
+def refreeze(db: Session, quarter_range_ids):
+    for quarter_range_id in quarter_range_ids:
+        db.execute(delete(models.QuarterStanding).where(models.QuarterStanding.quarter_range_id == quarter_range_id),
+            execution_options={'synchronize_session': False})
+        participants = db.execute(snapshot_statement, {'quarter_range_id': quarter_range_id}).rowcount
+        db.execute(update(models.QuarterClose).where(models.QuarterClose.quarter_range_id == quarter_range_id).values(
+            participants=participants), execution_options={'synchronize_session': False})
+    if quarter_range_ids:
+        etag.bump(db, etag.QUARTER_STANDINGS)
+
+# freezes the standings and picks the winners of a quarter range that ended
+# returns False when it isn't due or another worker is closing (or closed) it
+def close_quarter_range(db: Session, quarter_range_id: int):
+    # imported here, the routers import this module
+    from .routers.winner import add_winners
+    locked = db.query(models.Quarter_Range.id).filter(models.Quarter_Range.id == quarter_range_id,
+        models.Quarter_Range.end_range <= quarter_calendar.now(), models.Quarter_Range.deleted_at == None).with_for_update(skip_locked=True).first()
+    if not locked or db.query(models.QuarterClose.quarter_range_id).filter(models.QuarterClose.quarter_range_id == quarter_range_id).first():
+        db.rollback()
+        return False
+    participants = db.execute(snapshot_statement, {'quarter_range_id': quarter_range_id}).rowcount
+    db.add(models.QuarterClose(quarter_range_id=quarter_range_id, participants=participants))
+    # the quarter is still closed when no winner can be picked (no prize for a level), admins can add them later
+    try:
+        with db.begin_nested():
+            winners = add_winners(db, quarter_range_id)
+    except HTTPException as e:
+        logger.warning('quarter range %s closed without winners: %s', quarter_range_id, e.detail)
+        winners = []
+    etag.bump(db, etag.QUARTER_STANDINGS)
+    db.commit()
+    logger.info('closed quarter range %s with %s participants and %s winners', quarter_range_id, participants, len(winners))
+    return True
+
+# closes every quarter range that ended and isn't closed yet, each in its own transaction
+def close_due():
+    db = SessionLocal()
+    try:
+        current_time = quarter_calendar.now()
+        participants = closed.get(db)
+        due = [r.id for r in quarter_calendar.get_quarter_ranges(db) if r.end_range <= current_time and r.id not in participants]
+        # ends the read transaction so each close starts with a snapshot of its own
+        db.rollback()
+        for quarter_range_id in due:
+            close_quarter_range(db, quarter_range_id)
+    finally:
+        db.close()
+
+# checks for quarter ranges to close every quarter_close_check_seconds until cancelled
+async def run():
+    while True:
+        try:
+            await to_thread.run_sync(close_due)
+        except Exception:
+            logger.exception('could not close the quarter ranges that ended')
+        await asyncio.sleep(settings.quarter_close_check_seconds)
+
+task = None
+
+def start():
+    global task
+    if settings.quarter_close_check_seconds > 0 and task is None:
+        task = asyncio.get_running_loop().create_task(run())
+
+async def stop():
+    global task
+    if task is None:
+        return
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    task = None
@@ -0,0 +1,139 @@
+# in memory rank index of the students of a quarter range
+# the points of every student with points in a quarter range are kept sorted, so the rank, number of participants
+# and percentile of one student are found with a binary search instead of a grouped count per request.
+# point changes made by this worker are applied to the index after they commit (like the live leaderboard), and
+# an index is rebuilt with one grouped count when the points version of its quarter range shows a change made by
+# another worker, or event times, events, quarter ranges or users changed
+import threading
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+from typing import Optional
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from . import etag, models
+
+# number of quarter ranges kept in memory (the current one and a few past ones are looked up)
+MAX_QUARTER_RANGES = 8
+
+# points of the students of one quarter range
+class RankIndex:
+    def __init__(self, points: dict, version):
+        self.points = points
+        self.sorted_points = sorted(points.values())
+        self.version = version
+
+    # rank (students with the same points share a rank), participants and
+    # percentile (share of participants with less points) of a student, None if the student has no points
+    def lookup(self, user_id: int):
+        points = self.points.get(user_id)
+        if points is None:
+            return None
+        total = len(self.sorted_points)
+        rank = total - bisect_right(self.sorted_points, points) + 1
+        below = bisect_left(self.sorted_points, points)
+        return {"points": points, "rank": rank, "total": total, "percentile": round(below / total * 100, 1)}
+
+    # adds change (1 or -1) to the points of a student, a student left with no points isn't a participant
+    def apply(self, user_id: int, change: int):
+        old = self.points.get(user_id)
+        if old is not None:
+            del self.sorted_points[bisect_left(self.sorted_points, old)]
+        new = (old or 0) + change
+        if new > 0:
+            self.points[user_id] = new
+            insort(self.sorted_points, new)
+        else:
+            self.points.pop(user_id, None)
+
+# points per student of a quarter range (same totals as the /leaderboards query, without deleted students, events
+# and quarter ranges)
+def load_points(db: Session, quarter_range_id: int):
+    rows = db.query(models.StudentPoint.user_id, func.count(models.StudentPoint.id)).join(
+        models.User, (models.User.id == models.StudentPoint.user_id) & (models.User.deleted_at == None)).join(
+        models.EventTime, models.EventTime.id == models.StudentPoint.event_time_id).join(
+        models.Events, (models.Events.id == models.EventTime.event_id) & (models.Events.deleted_at == None)).join(
+        models.Quarter_Range, (models.Quarter_Range.id == models.EventTime.quarter_range_id) & (models.Quarter_Range.deleted_at == None)).filter(
+        models.EventTime.quarter_range_id == quarter_range_id).group_by(models.StudentPoint.user_id).all()
+    return dict(rows)
+
+# version an index of the quarter range was loaded at, the points version is bumped by every point change of it
+def index_version(table_versions: dict, quarter_range_id: int):
+    return (table_versions.get(etag.quarter_points(quarter_range_id), 0), table_versions.get(etag.EVENT_TIMES),
+        table_versions.get(etag.EVENTS), table_versions.get(etag.QUARTER_RANGES), table_versions.get(etag.USERS))
+
+class QuarterRanks:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.indexes = OrderedDict()
+        # one load per quarter range at a time, requests that miss together wait for it
+        self.load_locks = {}
+
+    def cached(self, quarter_range_id: int, version):
+        with self.lock:
+            index = self.indexes.get(quarter_range_id)
+            if index is not None and etag.is_current(index.version, version):
+                self.indexes.move_to_end(quarter_range_id)
+                return index
+            return None
+
+    def get(self, db: Session, quarter_range_id: int):
+        version = index_version(etag.versions.get(db), quarter_range_id)
+        index = self.cached(quarter_range_id, version)
+        if index is not None:
+            return index
+        with self.lock:
+            load_lock = self.load_locks.setdefault(quarter_range_id, threading.Lock())
+        with load_lock:
+            # loaded by the request this one waited for
+            index = self.cached(quarter_range_id, version)
+            if index is not None:
+                return index
+            index = RankIndex(load_points(db, quarter_range_id), version)
+            with self.lock:
+                self.indexes[quarter_range_id] = index
+                self.indexes.move_to_end(quarter_range_id)
+                while len(self.indexes) > MAX_QUARTER_RANGES:
+                    evicted, _ = self.indexes.popitem(last=False)
+                    self.load_locks.pop(evicted, None)
+        return index
+
+    # index of the quarter range before a point change is committed, None when it isn't loaded
+    def before_change(self, quarter_range_id: int):
+        with self.lock:
+            return self.indexes.get(quarter_range_id)
+
+    # applies the (user id, change) pairs of a committed transaction to the index taken before the commit. the commit
+    # bumped the points version of the quarter range by one, so the index stays current unless another worker changed
+    # points too (its version is then behind and it is rebuilt). an index loaded in between may have the changes
+    # already and is left alone
+    def apply(self, index: Optional[RankIndex], quarter_range_id: int, changes):
+        if index is None:
+            return
+        with self.lock:
+            if self.indexes.get(quarter_range_id) is not index:
+                return
+            for user_id, change in changes:
+                index.apply(user_id, change)
+            index.version = (index.version[0] + 1, *index.version[1:])
+
+ranks = QuarterRanks()
+
+# module functions used by the routers
+def get_rank(db: Session, quarter_range_id: int, user_id: int):
+    return ranks.get(db, quarter_range_id).lookup(user_id)
+
+# taken before the commit of a point change and passed to point_added/point_removed after it
+def before_change(quarter_range_id: int):
+    return ranks.before_change(quarter_range_id)
+
+def point_added(index: Optional[RankIndex], quarter_range_id: int, user_id: int):
+    ranks.apply(index, quarter_range_id, [(user_id, 1)])
+
+def point_removed(index: Optional[RankIndex], quarter_range_id: int, user_id: int):
+    ranks.apply(index, quarter_range_id, [(user_id, -1)])
+
+# a point edited to another student of the same quarter range (one commit, one bump of its version)
+def point_moved(index: Optional[RankIndex], quarter_range_id: int, old_user_id: int, user_id: int):
+    ranks.apply(index, quarter_range_id, [(old_user_id, -1), (user_id, 1)])
@@ -0,0 +1,36 @@
+# routing of read only endpoints to the read replicas
+# read routes add Depends(replicas.use_replica) as their first dependency, the session of the request
+# (shared with the current user lookup and the etag check) then runs on a replica. writes, read after write
+# paths and clients that wrote in the last replica_sticky_seconds stay on the primary
+import time
+
+from fastapi import Depends, Request
+from sqlalchemy.orm import Session
+
+from .config import settings
+from .database import choose_replica, get_db, replica_engines
+
+# cookie with the time until which the client reads from the primary
+STICKY_COOKIE = 'primary_until'
+# methods that don't change data
+SAFE_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+# checks if the client wrote recently
+def is_sticky(request: Request):
+    try:
+        return float(request.cookies.get(STICKY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+# dependency for read routes, has to run before the session's first query
+def use_replica(request: Request, db: Session = Depends(get_db)):
+    if replica_engines and not is_sticky(request):
+        db.info['replica'] = choose_replica()
+
+# after a successful write the client reads from the primary for a while so it sees its own changes
+async def sticky_after_write_middleware(request: Request, call_next):
+    response = await call_next(request)
+    if replica_engines and request.method not in SAFE_METHODS and response.status_code < 400:
+        until = int(time.time()) + settings.replica_sticky_seconds + 1
+        response.set_cookie(key=STICKY_COOKIE, value=str(until), max_age=settings.replica_sticky_seconds, httponly=True)
+    return response
@@ -20,7 +20,7 @@ login_description = "To authenticate a user's credential for app. Requires usern
 # method would connect to db 
 def login(response: Response, user_credentials: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(database.get_db)):
     # checks if username exists in db and returns exception if don't
-    user = db.query(models.User).filter(models.User.username == user_credentials.username).first()
+    user = db.query(models.User).filter(models.User.username == user_credentials.username, models.User.deleted_at == None).first()
     if not user:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid Credentials")
     # if password from db doesn't match the password entered by user, return error
@@ -0,0 +1,84 @@
+from fastapi import status, HTTPException, Depends, APIRouter
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import literal, select, true
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session, aliased
+from .. import models, oauth2, etag, current_events, leaderboard_stream, quarter_close, quarter_ranks
+from ..schemas import StudentPoints as schemas
+from ..database import get_db
+
+# app would use this router to route methods
+# tags for documentation
+router = APIRouter(
+    tags=['Check In']
+)
+
+# picks the ongoing event time the scan is for
+def resolve_event_time(ongoing, check_in: schemas.CheckIn):
+    if check_in.event_time_id is not None:
+        ongoing = [e for e in ongoing if e.id == check_in.event_time_id]
+    elif check_in.event_id is not None:
+        ongoing = [e for e in ongoing if e.event_id == check_in.event_id]
+    if not ongoing:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No event is happening now")
+    if len(ongoing) > 1:
+        names = ', '.join(f'{e.name} ({e.event_id})' for e in ongoing)
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Several events are happening now, pass the event_id of one of: {names}")
+    return ongoing[0]
+
+# finds the student and adds the point in one statement
+# the row has the student, the id of the inserted point (None when the student already had it) and the id of the
+# point the student already had. no row means the username isn't a student
+def check_in_student(db: Session, username: str, event_time_id: int):
+    student = select(models.User.id, models.User.username, models.User.first_name, models.User.last_name,
+        models.User.grade).where(models.User.username == username, models.User.role_type_id == 3, models.User.deleted_at == None).cte('student')
+    inserted = insert(models.StudentPoint.__table__).from_select(['user_id', 'event_time_id'],
+        select(student.c.id, literal(event_time_id))).on_conflict_do_nothing(
+        index_elements=['user_id', 'event_time_id']).returning(models.StudentPoint.id).cte('inserted')
+    existing = aliased(models.StudentPoint)
+    query = select(student, inserted.c.id.label('point_id'), existing.id.label('existing_id')).select_from(
+        student.outerjoin(inserted, true()).outerjoin(existing, (existing.user_id == student.c.id) & (existing.event_time_id == event_time_id)))
+    # the standings of a closed quarter range are frozen, it gets no more points
+    return quarter_close.execute_point_write(db, query).first()
+
+# description of check in
+check_in_description = ("Check in a student at a kiosk: finds the student by username (or badge code) and adds the point for the "
+    "event happening now. Pass event_id or event_time_id when several events are happening. Scanning a student again "
+    "returns 200 with already_checked_in instead of adding a second point")
+# routes to /check-in
+# response status would be 201 (200 when the student was already checked in)
+# response model returns a schema of CheckInOut
+@router.post('/check-in', status_code=status.HTTP_201_CREATED, response_model=schemas.CheckInOut, description=check_in_description)
+# CheckIn schema with the scanned username
+# connects to db session
+# authenticate if user is logged in
+def check_in(check_in: schemas.CheckIn, db: Session = Depends(get_db), current_user = Depends(oauth2.get_current_user)):
+    # returns exception if user isn't an admin
+    if current_user.role_type_id != 1:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to add points")
+    # event time from the in memory list of current events
+    event_time = resolve_event_time(current_events.get_ongoing(db), check_in)
+    row = check_in_student(db, check_in.username.strip(), event_time.id)
+    if row is None:
+        # only the failed scans look up why
+        user = db.query(models.User.id).filter(models.User.username == check_in.username.strip(), models.User.deleted_at == None).first()
+        if not user:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Username not found")
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Only students can have points")
+    created = row.point_id is not None
+    if created:
+        new_versions = etag.bump(db, etag.quarter_points(event_time.quarter_range_id))
+    rank_index = quarter_ranks.before_change(event_time.quarter_range_id)
+    db.commit()
+    # sends the rank changes to live leaderboard viewers and the rank index
+    if created:
+        leaderboard_stream.point_added(event_time.quarter_range_id, row, new_versions[etag.quarter_points(event_time.quarter_range_id)])
+        quarter_ranks.point_added(rank_index, event_time.quarter_range_id, row.id)
+    content = {
+        "point_id": row.point_id if created else row.existing_id,
+        "already_checked_in": not created,
+        "user": {"id": row.id, "username": row.username, "first_name": row.first_name, "last_name": row.last_name, "grade": row.grade},
+        "event": {"event_time_id": event_time.id, "event_id": event_time.event_id, "name": event_time.name,
+            "start_time": event_time.start_time, "end_time": event_time.end_time},
+    }
+    return ORJSONResponse(content, status_code=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
@@ -0,0 +1,32 @@
+from fastapi import status, HTTPException, Depends, APIRouter
+from sqlalchemy.orm import Session
+from .. import models, oauth2
+from ..schemas import DeletionJobs as schemas
+from ..database import get_db
+
+# app would use this router to route methods
+# prefix for routes in file
+# tags for documentation
+router = APIRouter(
+    prefix='/deletion-jobs',
+    tags=['Deletion Jobs']
+)
+
+# description of get deletion job
+get_deletion_job_description = ("Get the progress of a deletion job. Deleting a user, event or quarter range hides it right away "
+    "and returns its job, the job removes its points, event times and winners in batches and then the row itself")
+# get a deletion job from the db session
+# routes to /deletion-jobs/id where id is the id of a job
+# response model returns a schema of DeletionJob
+@router.get('/{id}', response_model=schemas.DeletionJob, description=get_deletion_job_description)
+# id for an id of a job
+# connects to db session
+# authenticate if user is logged in
+def get_deletion_job(id: int, db: Session = Depends(get_db), current_user = Depends(oauth2.get_current_user)):
+    # returns exception if user isn't an admin
+    if current_user.role_type_id != 1:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to view deletion jobs")
+    job = db.query(models.DeletionJob).filter(models.DeletionJob.id == id).first()
+    if not job:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Deletion job with id: {id} was not found")
+    return job
@@ -2,9 +2,11 @@ from datetime import datetime
 from typing import List
 from fastapi import Body, Response, status, HTTPException, Depends, APIRouter
 from fastapi_pagination import Page, paginate
-from sqlalchemy import desc
-from .. import models, utils, oauth2
+from sqlalchemy import desc, update
+from sqlalchemy.exc import IntegrityError
+from .. import models, utils, oauth2, etag, replicas, deletion_jobs, leaderboard_stream
 from ..schemas import Events as schemas
+from ..schemas.DeletionJobs import DeletionJob
 from ..database import engine, get_db
 from sqlalchemy.orm import Session
 
@@ -16,18 +18,25 @@ router = APIRouter(
     tags=['Events']
 )
 
+# error code postgres returns when the uq_events_name index rejects a name
+UNIQUE_VIOLATION = '23505'
+
+# checks if a db error is from a name another event has
+def is_name_error(e: IntegrityError):
+    return getattr(e.orig, 'pgcode', None) == UNIQUE_VIOLATION
+
 # description of get events
 get_events_description = "Get all of the events from database"
 # get all events from the db session
 # routes to /events
 # response model returns a schema list of Events that is paginated
-@router.get('/', response_model=Page[schemas.Event], description=get_events_description)
+@router.get('/', response_model=Page[schemas.Event], description=get_events_description, dependencies=[Depends(replicas.use_replica), Depends(etag.conditional(etag.EVENTS))])
 # connects to db session
 # authenticate if user is logged in
 # filters for events
 def get_events(db: Session = Depends(get_db), current_user = Depends(oauth2.get_current_user), nameFilter: str = ''):
     # gets all events in db with added filter and ordering id descending
-    events = db.query(models.Events).filter(models.Events.name.contains(nameFilter)).order_by(
+    events = db.query(models.Events).filter(models.Events.name.contains(nameFilter), models.Events.deleted_at == None).order_by(
         desc(models.Events.id)).all()
     # return a paginated list of events
     return paginate(events)
@@ -46,16 +55,22 @@ def create_event(event: schemas.CreateUpdateEvent, db: Session = Depends(get_db)
     # returns exception if user isn't an admin
     if current_user.role_type_id != 1:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to create quarter range")
-    # returns exception if event name matches with any other event name
-    events_query = db.query(models.Events).filter(models.Events.name == event.name)
-    if events_query.first():
-        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Event name: {event.name} already exists")
     # adds event to db and return event back to user
+    # the event is sent as it was inserted instead of being loaded again after the commit
+    # returns exception if event name matches with any other event name (the uq_events_name index rejects it)
     new_event = models.Events(**event.dict())
     db.add(new_event)
+    try:
+        db.flush()
+    except IntegrityError as e:
+        db.rollback()
+        if is_name_error(e):
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Event name: {event.name} already exists")
+        raise
+    created_event = schemas.Event.from_orm(new_event)
+    etag.bump(db, etag.EVENTS)
     db.commit()
-    db.refresh(new_event)
-    return new_event
+    return created_event
 
 # description of updating event
 update_event_description = "Updates an event in the database"
@@ -72,39 +87,47 @@ def update_event(id: int, event:schemas.CreateUpdateEvent,
     # returns exception if user isn't an admin
     if current_user.role_type_id != 1:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to create quarter range")
-    # checks if the id exists in db and return exception if not
-    event_query = db.query(models.Events).filter(models.Events.id == id)
-    if not event_query.first():
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Event with id: {id} was not found")
-    # checks if event with same name exist in db. returns exception if true
-    test_event_name = db.query(models.Events).filter(models.Events.name == event.name).first()
-    if test_event_name:
-        if test_event_name.id != id:
+    # updates event in db and returns the updated event in the same statement
+    # returns exception if another event has the same name (the uq_events_name index rejects it)
+    try:
+        updated_event = db.execute(update(models.Events).where(models.Events.id == id, models.Events.deleted_at == None).values(
+            **event.dict()).returning(models.Events.id, models.Events.name, models.Events.is_sport),
+            execution_options={'synchronize_session': False}).first()
+    except IntegrityError as e:
+        db.rollback()
+        if is_name_error(e):
             raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Event name: {event.name} already exists")
-    # updates event in db and returns event
-    event_query.update(event.dict(),synchronize_session=False)
+        raise
+    # returns exception if the id doesn't exist in db
+    if not updated_event:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Event with id: {id} was not found")
+    etag.bump(db, etag.EVENTS)
     db.commit()
-    return event_query.first()
+    return updated_event
 
 # description of deleting event
-delete_event_description = "Delete an event from the database"
+delete_event_description = ("Delete an event from the database. The event is hidden right away and a deletion job removes it "
+    "with its event times and points in the background, its progress is at /deletion-jobs/{job id}")
 # deletes an event
 # routes to /events/id where id is an id of a certain event
-# returns 204 if success
-@router.delete('/{id}', status_code=status.HTTP_204_NO_CONTENT, description=delete_event_description)
+# returns 202 with the deletion job if success
+@router.delete('/{id}', status_code=status.HTTP_202_ACCEPTED, response_model=DeletionJob, description=delete_event_description)
 # id for an id of event
 # connects to db session
 # authenticate if user is logged in
-def delete_event(id: int, db: Session = Depends(get_db), current_user = Depends(oauth2.get_current_user)):
+def delete_event(id: int, response: Response, db: Session = Depends(get_db), current_user = Depends(oauth2.get_current_user)):
     # returns exception if user isn't an admin
     if current_user.role_type_id != 1:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to delete events")
-    # checks if the id exists in db and return exception if not
-    event_query = db.query(models.Events).filter(models.Events.id == id)
-    if not event_query.first():
+    # hides the event and adds the job that deletes it, then returns the job. returns exception if the id isn't in db
+    job = deletion_jobs.soft_delete(db, 'events', id)
+    if job is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Event with id: {id} was not found")
-    # deletes event from db and returns status code
-    event_query.delete(synchronize_session=False)
+    etag.bump(db, etag.EVENTS, etag.EVENT_TIMES, etag.STUDENT_POINTS)
     db.commit()
-    return Response(status_code=status.HTTP_204_NO_CONTENT)
+    deletion_jobs.wake()
+    # its points are hidden, live leaderboards reload
+    leaderboard_stream.reload()
+    response.headers['Location'] = f'/deletion-jobs/{job.id}'
+    return job
     
\ No newline at end of file
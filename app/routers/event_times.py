@@ -1,12 +1,12 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import List
 from fastapi import Body, Response, status, HTTPException, Depends, APIRouter
-from fastapi_pagination import Page, paginate
-from sqlalchemy import desc
-from .. import models, utils, oauth2
+from fastapi_pagination import Page
+from sqlalchemy import delete, desc, insert, update
+from .. import models, utils, oauth2, quarter_calendar, quarter_close, etag, leaderboard_stream, fast_pages, replicas
 from ..schemas import Events as schemas
 from ..database import engine, get_db
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, joinedload
 
 # app would use this router to route methods
 # prefix for routes in file
@@ -16,25 +16,63 @@ router = APIRouter(
     tags=['EventTimes']
 )
 
+# loads the event and quarter range (with its quarter) of event times in one query
+def event_time_load_options():
+    return [joinedload(models.EventTime.event),
+        joinedload(models.EventTime.quarter_range).joinedload(models.Quarter_Range.quarter)]
+
+# columns of an event time with its event and quarter range for the list fast path
+def event_time_columns():
+    return [models.EventTime.id.label("event_time_id"), models.EventTime.start_time, models.EventTime.end_time,
+        models.EventTime.event_id, models.EventTime.quarter_range_id, models.Events.name.label("event_name"), models.Events.is_sport,
+        models.Quarter_Range.start_range, models.Quarter_Range.end_range, models.Quarter_Range.quarter_id, models.Quarter.quarter]
+
+# joins the tables of event_time_columns to a query that has event times
+# event times of deleted events and quarter ranges are left out while their deletion job runs
+def join_event_time_tables(query):
+    return query.join(models.Events, (models.Events.id == models.EventTime.event_id) & (models.Events.deleted_at == None)).join(
+        models.Quarter_Range, (models.Quarter_Range.id == models.EventTime.quarter_range_id) & (models.Quarter_Range.deleted_at == None)).join(
+        models.Quarter, models.Quarter.id == models.Quarter_Range.quarter_id)
+
+# dict of a row with event_time_columns, same fields as schemas.EventTime
+def event_time_item(row):
+    return {"start_time": row["start_time"], "end_time": row["end_time"], "event_id": row["event_id"], "id": row["event_time_id"],
+        "event": {"name": row["event_name"], "is_sport": row["is_sport"], "id": row["event_id"]},
+        "quarter_range_id": row["quarter_range_id"],
+        "quarter_range": {"start_range": row["start_range"], "end_range": row["end_range"], "quarter_id": row["quarter_id"],
+            "id": row["quarter_range_id"], "quarter": {"id": row["quarter_id"], "quarter": row["quarter"]}}}
+
+# adds the event time of a row with event_time_columns (and its event, quarter range and quarter) to the included rows
+# of a lite page, field is the item field that references the event time
+def include_event_time(row, included, field: str):
+    included.add("event_times", field, row["event_time_id"], lambda: {"id": row["event_time_id"], "start_time": row["start_time"],
+        "end_time": row["end_time"], "event_id": row["event_id"], "quarter_range_id": row["quarter_range_id"]})
+    included.add("events", field, row["event_id"], lambda: {"name": row["event_name"], "is_sport": row["is_sport"], "id": row["event_id"]})
+    included.add("quarter_ranges", field, row["quarter_range_id"], lambda: {"id": row["quarter_range_id"],
+        "start_range": row["start_range"], "end_range": row["end_range"], "quarter_id": row["quarter_id"]})
+    included.add("quarters", field, row["quarter_id"], lambda: {"id": row["quarter_id"], "quarter": row["quarter"]})
+
 # description of get event times
 get_event_times_description = "Get all of the event times from database"
 # get all event times from the db session
 # routes to /event-times
 # response model returns a schema list of EventTimes that is paginated
-@router.get('/', response_model=Page[schemas.EventTime], description=get_event_times_description)
+@router.get('/', response_model=Page[schemas.EventTime], description=get_event_times_description, dependencies=[Depends(replicas.use_replica), Depends(etag.conditional(etag.EVENT_TIMES, etag.EVENTS, etag.QUARTER_RANGES, etag.QUARTERS))])
 # connects to db
 # authenticate if user is logged in
 # filters for event times
-def get_event_times(db: Session = Depends(get_db), current_user = Depends(oauth2.get_current_user), event_id: str = '', quarter_range_id: str = ''):
+def get_event_times(response: Response, db: Session = Depends(get_db), current_user = Depends(oauth2.get_current_user), event_id: str = '', quarter_range_id: str = ''):
     # create event time query for output
-    event_times = db.query(models.EventTime)
+    # only the columns of the response are selected, with the event and quarter range joined in
+    event_times = join_event_time_tables(db.query(*event_time_columns()).select_from(models.EventTime))
     # add filters for event and quarter id
     if event_id.isdigit():
         event_times = event_times.filter(models.EventTime.event_id == int(event_id))
     if quarter_range_id.isdigit():
         event_times = event_times.filter(models.EventTime.quarter_range_id == quarter_range_id)
-    # return a paginated list of event times ordered by descending based off end time
-    return paginate(event_times.order_by(desc(models.EventTime.end_time)).all())
+    # return a paginated list of event times ordered by descending based off end time (id breaks ties so pages are stable)
+    return fast_pages.page_response(event_times.order_by(desc(models.EventTime.end_time), desc(models.EventTime.id)),
+        event_time_item, response)
 
 # description of get event times
 get_current_event_time_description = "Get all event times that are ongoing of current date from database"
@@ -45,10 +83,11 @@ get_current_event_time_description = "Get all event times that are ongoing of cu
 # connects to db session
 # authenticate if user is logged in
 def get_current_event_times(db: Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user)):
-    # gets current datetime
-    current_time = datetime.now()
+    # gets current datetime (with time zone to compare with the timestamptz columns)
+    current_time = quarter_calendar.now()
     # gets event times based on current time and return to user
-    event_times = db.query(models.EventTime).filter(models.EventTime.end_time > current_time, models.EventTime.start_time < current_time).all()
+    event_times = db.query(models.EventTime).options(*event_time_load_options()).filter(
+        models.EventTime.end_time > current_time, models.EventTime.start_time < current_time).all()
     return event_times
 
 # description of create event times
@@ -69,18 +108,79 @@ def create_event_time(event_time: schemas.CreateUpdateEventTime,
     # checks if start date/time is greater than end date returns exception if so
     if event_time.start_time > event_time.end_time:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Start time needs to be less than end time")
-    # checks if event time matches to a quarter range in db returns exception if not
-    quarter_range = db.query(models.Quarter_Range).filter(models.Quarter_Range.start_range < event_time.start_time,
-        models.Quarter_Range.end_range > event_time.end_time).first()
+    # checks if event time matches to a quarter range (cached in memory) returns exception if not
+    quarter_range = quarter_calendar.get_containing(db, event_time.start_time, event_time.end_time)
     if not quarter_range:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Event Time does not fit in Quarter Range")
     # adds event time to db and return event time back to user
     new_event_time = models.EventTime(**{'start_time': event_time.start_time, 'end_time': event_time.end_time, 'event_id': event_time.event_id,
         'quarter_range_id': quarter_range.id})
     db.add(new_event_time)
+    db.flush()
+    new_id = new_event_time.id
+    etag.bump(db, etag.EVENT_TIMES)
+    db.commit()
+    # loads the event time with its event and quarter range in one query
+    return db.query(models.EventTime).options(*event_time_load_options()).filter(models.EventTime.id == new_id).first()
+
+# most event times that can be created in one request
+MAX_BULK_EVENT_TIMES = 500
+
+# returns the start and end of every occurrence of a bulk request
+def expand_occurrences(event_times: schemas.BulkCreateEventTimes):
+    if event_times.occurrences is not None:
+        return [(o.start_time, o.end_time) for o in event_times.occurrences]
+    rule = event_times.recurrence
+    weekdays = set(rule.weekdays)
+    occurrences = []
+    day = rule.start_date
+    while day <= rule.end_date and len(occurrences) <= MAX_BULK_EVENT_TIMES:
+        if day.weekday() in weekdays:
+            occurrences.append((quarter_calendar.to_aware(datetime.combine(day, rule.start_time)),
+                quarter_calendar.to_aware(datetime.combine(day, rule.end_time))))
+        day += timedelta(days=1)
+    return occurrences
+
+# description of bulk create event times
+bulk_create_event_times_description = "Creates many event times of an event from a list of occurrences or a weekly recurrence"
+# creates and add many event times to db in one statement
+# routes to /event-times/bulk
+# response status would be 201
+# reponse model returns a schema list of Event Times
+@router.post('/bulk', status_code=status.HTTP_201_CREATED, response_model=List[schemas.EventTime], description=bulk_create_event_times_description)
+# BulkCreateEventTimes schema for user to pass in occurrences or a recurrence rule
+# connects to db session
+# authenticate if user is logged in
+def bulk_create_event_times(event_times: schemas.BulkCreateEventTimes,
+    db: Session = Depends(get_db), current_user = Depends(oauth2.get_current_user)):
+    # returns exception if user isn't an admin
+    if current_user.role_type_id != 1:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to create event time")
+    # checks if event exists returns exception if not
+    if not db.query(models.Events.id).filter(models.Events.id == event_times.event_id, models.Events.deleted_at == None).first():
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Event with id: {event_times.event_id} was not found")
+    occurrences = expand_occurrences(event_times)
+    # returns exception if there are no or too many occurrences
+    if not occurrences:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="No event times to create")
+    if len(occurrences) > MAX_BULK_EVENT_TIMES:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Cannot create more than {MAX_BULK_EVENT_TIMES} event times at once")
+    # matches every occurrence to its quarter range in memory, returns exception if one doesn't fit
+    rows = []
+    for start_time, end_time in occurrences:
+        if start_time > end_time:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Start time needs to be less than end time ({start_time})")
+        quarter_range = quarter_calendar.get_containing(db, start_time, end_time)
+        if not quarter_range:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Event Time starting {start_time} does not fit in Quarter Range")
+        rows.append({'start_time': start_time, 'end_time': end_time, 'event_id': event_times.event_id,
+            'quarter_range_id': quarter_range.id})
+    # adds all event times in one insert and return them back to user
+    ids = [row.id for row in db.execute(insert(models.EventTime).values(rows).returning(models.EventTime.id))]
+    etag.bump(db, etag.EVENT_TIMES)
     db.commit()
-    db.refresh(new_event_time)
-    return new_event_time
+    return db.query(models.EventTime).options(*event_time_load_options()).filter(
+        models.EventTime.id.in_(ids)).order_by(models.EventTime.start_time).all()
 
 # description of updating event times
 update_event_time_description = "Updates an event time in the database"
@@ -97,23 +197,26 @@ def update_event_time(id: int, event_time:schemas.CreateUpdateEventTime,
     # returns exception if user isn't an admin
     if current_user.role_type_id != 1:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to create event time")
-    # checks if the id exists in db and return exception if not
-    updated_event_time = db.query(models.EventTime).filter(models.EventTime.id == id)
-    if not update_event_time:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Event time id: {id} was not found")
     # checks if start date/time is greater than end date  and return exception if so
     if event_time.start_time > event_time.end_time:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Start time needs to be less than end time")
-    # checks if event time matches to quarter range in db and returns exception if not
-    quarter_range = db.query(models.Quarter_Range).filter(models.Quarter_Range.start_range < event_time.start_time,
-        models.Quarter_Range.end_range > event_time.end_time).first()
+    # checks if event time matches to quarter range (cached in memory) and returns exception if not
+    quarter_range = quarter_calendar.get_containing(db, event_time.start_time, event_time.end_time)
     if not quarter_range:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Event Time does not fit in Quarter Range")
-    # updates and return the event time
-    updated_event_time.update({"start_time": event_time.start_time, "end_time": event_time.end_time, "event_id": event_time.event_id
-        , "quarter_range_id": quarter_range.id}, synchronize_session=False)
+    # updates the event time, returns exception if the id doesn't exist in db
+    # its points move with it, so an event time can't be moved out of, into or within a closed quarter range
+    updated = quarter_close.execute_point_write(db, update(models.EventTime).where(models.EventTime.id == id).values(
+        start_time=event_time.start_time, end_time=event_time.end_time, event_id=event_time.event_id,
+        quarter_range_id=quarter_range.id).returning(models.EventTime.id).execution_options(synchronize_session=False)).first()
+    if not updated:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Event time id: {id} was not found")
+    etag.bump(db, etag.EVENT_TIMES)
     db.commit()
-    return updated_event_time.first()
+    # points of the event time may be in another quarter range now
+    leaderboard_stream.reload()
+    # returns the event time with its event and quarter range loaded in one query
+    return db.query(models.EventTime).options(*event_time_load_options()).filter(models.EventTime.id == id).first()
 
 # description of deleting event time
 delete_event_time_description = "Delete an event time from the database"
@@ -128,12 +231,14 @@ def delete_event_time(id: int, db: Session = Depends(get_db), current_user = Dep
     # returns exception if user isn't an admin
     if current_user.role_type_id != 1:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to create event time")
-    # checks if the id exists in db and return exception if not
-    delete_event_time = db.query(models.EventTime).filter(models.EventTime.id == id)
-    if not delete_event_time:
+    # deletes event time (with its points) from db and returns status, the points of a closed quarter range can't be deleted
+    # returns exception if the id doesn't exist in db
+    deleted = quarter_close.execute_point_write(db, delete(models.EventTime.__table__).where(models.EventTime.id == id))
+    if not deleted.rowcount:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Event time id: {id} was not found")
-    # deletes event time from db and returns status
-    delete_event_time.delete(synchronize_session=False)
+    etag.bump(db, etag.EVENT_TIMES, etag.STUDENT_POINTS)
     db.commit()
+    # its points were removed, live leaderboards reload
+    leaderboard_stream.reload()
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
@@ -1,12 +1,15 @@
 from datetime import datetime
-from typing import List
-from fastapi import APIRouter, Response, status, HTTPException, Depends
+from typing import List, Optional
+from fastapi import APIRouter, Request, Response, status, HTTPException, Depends
+from fastapi.responses import StreamingResponse
 from fastapi_pagination import Page, paginate
-from sqlalchemy import desc, func, text
+from fastapi_pagination.ext.sqlalchemy import paginate as paginate_query
+from sqlalchemy import desc, func, select, text, union_all
 from ..schemas import Winners as schemas
 from ..database import engine, get_db
 from sqlalchemy.orm import Session
-from .. import models, utils, oauth2
+from .winner import winner_load_options
+from .. import models, utils, oauth2, quarter_calendar, quarter_ranks, quarter_close, etag, leaderboard_stream, replicas, fast_pages
 
 
 router = APIRouter(
@@ -18,13 +21,13 @@ get_past_winners_description = "Get all of the past winners from database"
 # get all events from the db session
 # routes to /past-winners
 # response model returns a schema list of StudentWinner
-@router.get('/past-winners', response_model=List[schemas.StudentWinner], description=get_past_winners_description)
+@router.get('/past-winners', response_model=List[schemas.StudentWinner], description=get_past_winners_description, dependencies=[Depends(replicas.use_replica), Depends(etag.conditional(etag.STUDENT_WINNERS, etag.USERS, etag.PRIZES, etag.QUARTER_RANGES, etag.QUARTERS))])
 # connects to db session
 # authenticate if user is logged in
 # filters for past winners
 def get_past_winners(db: Session = Depends(get_db), current_user = Depends(oauth2.get_current_user), quarter_range_id: str = ''):
     # past winner query
-    past_winners = db.query(models.StudentWinner)
+    past_winners = db.query(models.StudentWinner).options(*winner_load_options())
     # checks quarter range id filter 
     if quarter_range_id.isdigit():
         past_winners = past_winners.filter(models.StudentWinner.quarter_range_id == quarter_range_id).limit(5).all()
@@ -40,20 +43,8 @@ get_past_quarter_description = "Get all of the past quarter ranges from database
 # response model returns a schema QuarterRangeOut
 @router.get('/past-quarter', response_model=schemas.QuarterRangeOut, description=get_past_quarter_description)
 def get_past_quarter_range(db: Session = Depends(get_db), current_user = Depends(oauth2.get_current_user)):
-    # gets the current datetime
-    current_time = datetime.now()
-    # gets current quarter from the current datetime
-    current_quarter = db.query(models.Quarter_Range).filter(
-        models.Quarter_Range.end_range > current_time, models.Quarter_Range.start_range < current_time
-        ).first()
-    # quarter range query
-    previous_quarter = db.query(models.Quarter_Range)
-    # finds quarters that are not the current one and in the past
-    if current_quarter:
-        previous_quarter = previous_quarter.filter(models.Quarter_Range.id != current_quarter.id)
-    previous_quarter = previous_quarter.filter(models.Quarter_Range.end_range < current_time).order_by(
-        desc(models.Quarter_Range.end_range)
-    ).first()
+    # finds the latest quarter that ended before today from the cached quarter ranges
+    previous_quarter = quarter_calendar.get_previous(db)
     # return http exception if none exist
     if not previous_quarter:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No past quarters found")
@@ -62,20 +53,27 @@ def get_past_quarter_range(db: Session = Depends(get_db), current_user = Depends
 
 # gets all the user points accumulated together and return a paginated leaderboard if there are any
 # all depends on the quarter range id
+# closed quarter ranges are read from their frozen standings (no count or grouping)
 # description of get leaderboards
 get_leaderboards_description = "Get all of the leaderboards from database"
 # get all leaderboards from the db session
 # routes to /leaderboards
 # response model returns a schema list of Points that is paginated
 # filters for leaderboard
-@router.get('/leaderboards', response_model=Page[schemas.Points], description=get_leaderboards_description)
-def get_current_leaderboard(db: Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user), quarter_range_id: str = ''):
+@router.get('/leaderboards', response_model=Page[schemas.Points], description=get_leaderboards_description, dependencies=[Depends(replicas.use_replica), Depends(etag.conditional(etag.STUDENT_POINTS, etag.EVENT_TIMES, etag.USERS, etag.QUARTER_STANDINGS))])
+def get_current_leaderboard(response: Response, db: Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user), quarter_range_id: str = ''):
     # accumlate all user point for a certain quarter range and return it if exists
     if quarter_range_id.isdigit():
+        participants = quarter_close.get_participants(db, int(quarter_range_id))
+        if participants is not None:
+            return closed_leaderboard(db, int(quarter_range_id), participants, response)
+        # points of deleted students, events and quarter ranges are left out right away (before their deletion job ran)
         user_points = db.query(models.User, func.count(models.StudentPoint.user_id).label("points")).join(
             models.StudentPoint, models.StudentPoint.user_id == models.User.id , isouter= True
-            ).join(models.EventTime, models.EventTime.id == models.StudentPoint.event_time_id).filter(
-            models.EventTime.quarter_range_id == int(quarter_range_id)
+            ).join(models.EventTime, models.EventTime.id == models.StudentPoint.event_time_id).join(
+            models.Events, (models.Events.id == models.EventTime.event_id) & (models.Events.deleted_at == None)).join(
+            models.Quarter_Range, (models.Quarter_Range.id == models.EventTime.quarter_range_id) & (models.Quarter_Range.deleted_at == None)).filter(
+            models.EventTime.quarter_range_id == int(quarter_range_id), models.User.deleted_at == None
         ).group_by(models.User.id).order_by(text("points DESC")).all()
         if not user_points:
             return HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No user points found for quarter")
@@ -83,13 +81,90 @@ def get_current_leaderboard(db: Session = Depends(get_db), current_user: int = D
     # return if no user points at all
     return paginate([])
 
-# gets the current points of the user for the quarter range
+# page of the frozen standings of a closed quarter range in rank order, nothing is summed or counted
+# the total is the participants of the close, refrozen with the standings (a deleted student leaves both)
+def closed_leaderboard(db: Session, quarter_range_id: int, participants: int, response: Response):
+    standings = db.query(models.User.id, models.User.username, models.User.first_name, models.User.last_name, models.User.grade,
+        models.QuarterStanding.points).join(models.QuarterStanding, models.QuarterStanding.user_id == models.User.id).filter(
+        models.QuarterStanding.quarter_range_id == quarter_range_id, models.User.deleted_at == None).order_by(models.QuarterStanding.rank, models.QuarterStanding.user_id)
+    return fast_pages.page_response(standings, standing_item, response, total=participants)
+
+def standing_item(row):
+    return {"User": {"id": row["id"], "username": row["username"], "first_name": row["first_name"], "last_name": row["last_name"],
+        "grade": row["grade"]}, "points": row["points"]}
+
+# leaderboard over many quarter ranges (year to date, a date range or a list of quarter ranges)
+# summed from the student point rollups (points per student, quarter range and event type) instead of all the points
+# description of get rollup leaderboards
+get_rollup_leaderboards_description = ("Get a leaderboard summed over the quarter ranges of the school year so far (year_to_date), "
+    "the quarter ranges overlapping start/end or a comma separated list of quarter_range_ids, optionally only for a grade or sport/non sport events")
+# routes to /leaderboards/rollup
+# response model returns a schema list of Points that is paginated
+@router.get('/leaderboards/rollup', response_model=Page[schemas.Points], description=get_rollup_leaderboards_description,
+    dependencies=[Depends(replicas.use_replica), Depends(etag.conditional(etag.STUDENT_POINTS, etag.EVENT_TIMES, etag.EVENTS, etag.QUARTER_RANGES, etag.USERS))])
+# connects to db session
+# authenticate if user is logged in
+# filters for leaderboard
+def get_rollup_leaderboard(db: Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user),
+    year_to_date: bool = False, start: Optional[datetime] = None, end: Optional[datetime] = None, quarter_range_ids: str = '',
+    grade: Optional[int] = None, is_sport: Optional[bool] = None):
+    # quarter ranges to sum, rollups are per quarter range so a date range includes every quarter range it touches
+    if year_to_date:
+        ids = [r.id for r in quarter_calendar.get_school_year(db)]
+    elif start or end:
+        ids = [r.id for r in quarter_calendar.get_overlapping(db, start, end)]
+    else:
+        ids = [int(id) for id in quarter_range_ids.split(',') if id.strip().isdigit()]
+    # return if no quarter ranges
+    if not ids:
+        return paginate([])
+    # points of deleted events stay in the rollups until their deletion job removes them, they are taken out of the
+    # sums like /leaderboards hides them (there are only points of deleted events while a deletion job runs)
+    all_points = union_all(select(models.StudentPoint.user_id, models.StudentPoint.event_time_id),
+        select(models.StudentPointArchive.user_id, models.StudentPointArchive.event_time_id)).subquery()
+    deleted_points = select(all_points.c.user_id, func.count().label("points")).join(
+        models.EventTime, models.EventTime.id == all_points.c.event_time_id).join(
+        models.Events, (models.Events.id == models.EventTime.event_id) & (models.Events.deleted_at != None)).join(
+        models.Quarter_Range, (models.Quarter_Range.id == models.EventTime.quarter_range_id) & (models.Quarter_Range.deleted_at == None)).where(
+        models.EventTime.quarter_range_id.in_(ids))
+    if is_sport is not None:
+        deleted_points = deleted_points.where(models.Events.is_sport == is_sport)
+    deleted_points = deleted_points.group_by(all_points.c.user_id).subquery()
+    points = (func.sum(models.StudentPointRollup.points) - func.coalesce(func.max(deleted_points.c.points), 0)).label("points")
+    # deleted quarter ranges (a list of ids can have them) are left out, their rollups stay until their deletion job
+    # removes them
+    user_points = db.query(models.User, points).join(models.StudentPointRollup, models.StudentPointRollup.user_id == models.User.id).join(
+        models.Quarter_Range, (models.Quarter_Range.id == models.StudentPointRollup.quarter_range_id) & (models.Quarter_Range.deleted_at == None)).outerjoin(
+        deleted_points, deleted_points.c.user_id == models.User.id).filter(
+        models.StudentPointRollup.quarter_range_id.in_(ids), models.User.deleted_at == None)
+    # filters for grade and event type
+    if grade is not None:
+        user_points = user_points.filter(models.User.grade == grade)
+    if is_sport is not None:
+        user_points = user_points.filter(models.StudentPointRollup.is_sport == is_sport)
+    # most points first, id breaks ties so pages are stable. students left without points aren't listed
+    return paginate_query(user_points.group_by(models.User.id).having(points > 0).order_by(desc(points), models.User.id))
+
+# live leaderboard of a quarter range as server sent events
+# sends a "snapshot" event with the whole leaderboard, then "delta" events with the students whose rank or points changed
+# description of stream leaderboards
+stream_leaderboards_description = "Stream live rank changes of a leaderboard as server sent events"
+# routes to /leaderboards/stream
+@router.get('/leaderboards/stream', description=stream_leaderboards_description)
+# authenticate if user is logged in, the token is only verified so the stream doesn't hold a db connection
+async def stream_leaderboard(request: Request, quarter_range_id: int, token: str = Depends(oauth2.oauth2_scheme)):
+    oauth2.verify_access_token(token, oauth2.credentials_exception())
+    return StreamingResponse(leaderboard_stream.hub.stream(request, quarter_range_id), media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# gets the current points of the user for the quarter range with their rank
 # description of get user points
-get_user_points_description = "Get the points for the current user"
-# get points for current user from the db session
+get_user_points_description = "Get the points, rank, number of participants and percentile for the current user"
+# get points for current user from the rank index of the quarter range
 # routes to /user-points
-# response model returns a schema Points
-@router.get('/user-points', response_model=schemas.Points)
+# response model returns a schema UserPoints
+@router.get('/user-points', response_model=schemas.UserPoints, description=get_user_points_description,
+    dependencies=[Depends(replicas.use_replica), Depends(etag.conditional(etag.STUDENT_POINTS, etag.EVENT_TIMES, etag.USERS, etag.QUARTER_STANDINGS, per_user=True))])
 # connects to db session
 # authenticate if user is logged in
 # filters for points
@@ -99,14 +174,23 @@ def get_current_user_points(db: Session = Depends(get_db), current_user: int = D
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="No points for current user")
     # returns exception if quarter range id not a number 
     if (quarter_range_id.isdigit()):
-        # get all the points for the current user and certain quarter
-        user_points = db.query(models.User, func.count(models.StudentPoint.id).label("points")).join(
-            models.StudentPoint, models.StudentPoint.user_id == models.User.id , isouter= True
-        ).join(models.EventTime, models.EventTime.id == models.StudentPoint.event_time_id, isouter=True).filter(
-            models.EventTime.quarter_range_id == quarter_range_id, models.User.id == current_user.id
-        ).group_by(models.User.id).first()
+        # get the points and rank of the current user for certain quarter
+        # from the frozen standings when the quarter range is closed
+        participants = quarter_close.get_participants(db, int(quarter_range_id))
+        if participants is not None:
+            user_rank = closed_user_rank(db, int(quarter_range_id), current_user.id, participants)
+        else:
+            user_rank = quarter_ranks.get_rank(db, int(quarter_range_id), current_user.id)
         # return exception if no points exists for user
-        if not user_points:
+        if not user_rank:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No student points found for user")
-        return user_points
-    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="quarter range id not found")
\ No newline at end of file
+        return {"User": current_user, **user_rank}
+    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="quarter range id not found")
+
+# points, rank and percentile of a student in the frozen standings, None if the student had no points
+def closed_user_rank(db: Session, quarter_range_id: int, user_id: int, participants: int):
+    standing = db.query(models.QuarterStanding.points, models.QuarterStanding.rank, models.QuarterStanding.percentile).filter(
+        models.QuarterStanding.quarter_range_id == quarter_range_id, models.QuarterStanding.user_id == user_id).first()
+    if not standing:
+        return None
+    return {"points": standing.points, "rank": standing.rank, "total": participants, "percentile": standing.percentile}
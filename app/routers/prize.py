@@ -2,7 +2,10 @@ from datetime import datetime
 from typing import List
 from fastapi import Body, Response, status, HTTPException, Depends, APIRouter
 from fastapi_pagination import Page, paginate
-from .. import models, utils, oauth2
+from sqlalchemy import delete, exists, literal, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+from .. import models, utils, oauth2, etag, replicas, prize_catalog
 from ..schemas import Prizes as schemas
 from ..database import engine, get_db
 from sqlalchemy.orm import Session
@@ -20,7 +23,7 @@ get_prizes_description = "Get all of the prizes from database"
 # get all prizes from the db session
 # routes to /prizes
 # response model returns a schema list of Prizes that is paginated
-@router.get('/', response_model=Page[schemas.Prize], description=get_prizes_description)
+@router.get('/', response_model=Page[schemas.Prize], description=get_prizes_description, dependencies=[Depends(replicas.use_replica), Depends(etag.conditional(etag.PRIZES))])
 # connects to db
 # authenticate if user is logged in
 # filters for prizes
@@ -30,6 +33,44 @@ def get_prizes(db: Session = Depends(get_db), current_user = Depends(oauth2.get_
      # returns a paginated list of prizes
      return paginate(prizes)
 
+# description of get prize levels
+get_prize_levels_description = "Get the prize levels and the points a winner needs for each of them"
+# get the prize levels sorted by points
+# routes to /prizes/levels (before /prizes/id so levels isn't taken as an id)
+# response model returns a schema list of PrizeLevel
+@router.get('/levels', response_model=List[schemas.PrizeLevel], description=get_prize_levels_description, dependencies=[Depends(etag.conditional(etag.PRIZES))])
+# connects to db
+# authenticate if user is logged in
+def get_prize_levels(db: Session = Depends(get_db), current_user = Depends(oauth2.get_current_user)):
+    return db.query(models.PrizeLevel).order_by(models.PrizeLevel.min_points).all()
+
+# description of updating prize levels
+update_prize_levels_description = "Replaces the prize levels. A winner gets a prize of the highest level whose min_points they have"
+# replaces the prize levels
+# routes to /prizes/levels
+# response model returns a schema list of PrizeLevel
+@router.put('/levels', response_model=List[schemas.PrizeLevel], description=update_prize_levels_description)
+# UpdatePrizeLevels schema with every level
+# connects to db session
+# authenticate if user is logged in
+def update_prize_levels(prize_levels: schemas.UpdatePrizeLevels, db: Session = Depends(get_db), current_user = Depends(oauth2.get_current_user)):
+    # checks if not admin, returns exception if true
+    if current_user.role_type_id != 1:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to update prize levels")
+    # checks that no prize is left without its level
+    levels = {level.level for level in prize_levels.levels}
+    prize = db.query(models.Prize).filter(models.Prize.level.notin_(levels)).first()
+    if prize:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Prize: {prize.name} has level {prize.level} which would be removed")
+    # replaces the levels, they are part of the prize catalog so the prizes version is bumped
+    db.query(models.PrizeLevel).delete(synchronize_session=False)
+    db.add_all([models.PrizeLevel(**level.dict()) for level in prize_levels.levels])
+    etag.bump(db, etag.PRIZES)
+    db.commit()
+    prize_catalog.invalidate()
+    # the validated levels are sorted by level, higher levels need more points so they are sorted by points too
+    return prize_levels.levels
+
 # description of create prize
 create_prize_description = "Creates a prize which is added to db"
 # creates and add prize to db
@@ -44,15 +85,20 @@ def create_prize(prize: schemas.CreateUpdatePrize,db: Session = Depends(get_db),
     # returns exception if user isn't an admin
     if current_user.role_type_id != 1:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to create quarter range")
-    # checks if prize name exists in db. return exception if true
-    prize_query = db.query(models.Prize).filter(prize.name == models.Prize.name).first()
-    if prize_query:
-        raise HTTPException(status_code=status.HTTP_409_CONFLICT,detail=f"Prize name: {prize.name} already exists")
     # adds prize to db and returns prize to user
-    new_prize = models.Prize(**prize.dict())
-    db.add(new_prize)
+    # it is only added when its level exists and no prize has its name, in one statement
+    level_exists = exists().where(models.PrizeLevel.level == prize.level)
+    values = prize.dict()
+    new_prize = db.execute(insert(models.Prize).from_select(list(values), select(*[literal(value) for value in values.values()]).where(
+        level_exists)).on_conflict_do_nothing(index_elements=[models.Prize.name]).returning(*models.Prize.__table__.c)).first()
+    if not new_prize:
+        # checks if prize name exists in db. return exception if true, otherwise the level doesn't exist
+        if db.query(models.Prize.id).filter(models.Prize.name == prize.name).first():
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT,detail=f"Prize name: {prize.name} already exists")
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Prize level: {prize.level} was not found")
+    etag.bump(db, etag.PRIZES)
     db.commit()
-    db.refresh(new_prize)
+    prize_catalog.invalidate()
     return new_prize
 
 # description of updating prize
@@ -70,20 +116,23 @@ def update_prize(id:int,prize:schemas.CreateUpdatePrize,
     # checks if not admin, returns exception if true
     if current_user.role_type_id != 1:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to create quarter range")
-    # checks if id not in db. returns error if true
-    prize_query = db.query(models.Prize).filter(models.Prize.id == id)
-    if not prize_query.first():
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Prize with id: {id} was not found")
-    # checks if prize name exists in db. return exception if true
-    prize_name = db.query(models.Prize).filter(prize.name == models.Prize.name)
-    check_prize_name = prize_name.first()
-    if check_prize_name:
-        if check_prize_name.id !=id:
-            raise HTTPException(status_code=status.HTTP_409_CONFLICT,detail=f"Prize name: {prize.name} already exists")
-    # updates prize and returns prize to user
-    prize_query.update(prize.dict(),synchronize_session=False)
+    # updates prize and returns prize to user, it is only updated when its level exists
+    # the unique name of the prizes table rejects a name another prize has
+    try:
+        updated_prize = db.execute(update(models.Prize).where(models.Prize.id == id, exists().where(models.PrizeLevel.level == prize.level)).values(
+            **prize.dict()).returning(*models.Prize.__table__.c), execution_options={'synchronize_session': False}).first()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,detail=f"Prize name: {prize.name} already exists")
+    if not updated_prize:
+        # checks if id not in db. returns error if true, otherwise the level doesn't exist
+        if not db.query(models.Prize.id).filter(models.Prize.id == id).first():
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Prize with id: {id} was not found")
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Prize level: {prize.level} was not found")
+    etag.bump(db, etag.PRIZES)
     db.commit()
-    return prize_query.first()
+    prize_catalog.invalidate()
+    return updated_prize
     
 # description of deleting prize time
 delete_prize_description = "Delete a prize from the database"
@@ -98,11 +147,11 @@ def delete_prize(id:int, db: Session = Depends(get_db), current_user = Depends(o
     # checks if not admin, returns exception if true
     if current_user.role_type_id != 1:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to create quarter range")
-    # checks if id not in db. returns error if true
-    prize_query = db.query(models.Prize).filter(models.Prize.id == id)
-    if not prize_query.first():
+    # deletes prize and returns status code, returns error if id not in db
+    deleted = db.execute(delete(models.Prize).where(models.Prize.id == id), execution_options={'synchronize_session': False})
+    if not deleted.rowcount:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Prize with id: {id} was not found")
-    # deletes prize and returns status code
-    prize_query.delete(synchronize_session=False)
+    etag.bump(db, etag.PRIZES, etag.STUDENT_WINNERS)
     db.commit()
+    prize_catalog.invalidate()
     return Response(status_code=status.HTTP_204_NO_CONTENT)
\ No newline at end of file
@@ -1,12 +1,13 @@
-from datetime import datetime
 from typing import List
 from fastapi import Body, Response, status, HTTPException, Depends, APIRouter
 from fastapi_pagination import Page, paginate
-from sqlalchemy import desc
-from .. import models, utils, oauth2
+from sqlalchemy import desc, update
+from sqlalchemy.exc import IntegrityError
+from .. import models, utils, oauth2, quarter_calendar, etag, replicas, deletion_jobs, leaderboard_stream
 from ..schemas import Quarters as schemas
+from ..schemas.DeletionJobs import DeletionJob
 from ..database import engine, get_db
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, joinedload
 
 # app would use this router to route methods
 # prefix for routes in file
@@ -15,12 +16,19 @@ router = APIRouter(
     tags=['Quarters']
 )
 
+# error code postgres returns when the quarter_ranges_no_overlap constraint rejects a range
+EXCLUSION_VIOLATION = '23P01'
+
+# checks if a db error is from an overlapping quarter range
+def is_overlap_error(e: IntegrityError):
+    return getattr(e.orig, 'pgcode', None) == EXCLUSION_VIOLATION
+
 # description of get quarters
 get_quarters_description = "Get all of the quarters from database"
 # get all quarters from the db session
 # routes to /quarters
 # response model returns a schema list of Quarter
-@router.get('/quarters', response_model=List[schemas.Quarter], description=get_quarters_description)
+@router.get('/quarters', response_model=List[schemas.Quarter], description=get_quarters_description, dependencies=[Depends(replicas.use_replica), Depends(etag.conditional(etag.QUARTERS))])
 # connects to db session
 # authenticate if user is logged in
 def get_quarters(db: Session = Depends(get_db), current_user = Depends(oauth2.get_current_user)):
@@ -37,10 +45,8 @@ get_current_quarter_range_description = "Get current quarter range from database
 # connects to db session
 # authenticate if user is logged in
 def get_current_quarter_range(db: Session = Depends(get_db), current_user = Depends(oauth2.get_current_user)):
-    # gets current datetime
-    current_time = datetime.now()
-    # find current quarter range with current time
-    current_quarter_range = db.query(models.Quarter_Range).filter(models.Quarter_Range.end_range > current_time, models.Quarter_Range.start_range < current_time).first()
+    # find current quarter range with current time from the cached quarter ranges
+    current_quarter_range = quarter_calendar.get_current(db)
     # returns exception of no quarter range is set for current time
     if not current_quarter_range:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No quarter range set for today")
@@ -52,16 +58,20 @@ get_quarter_ranges_description = "Get all of the quarter ranges from database"
 # get all quarter ranges from the db session
 # routes to /quarter-ranges
 # response model returns a schema list of QuarterRangeOut that is paginated
-@router.get('/quarter-ranges', response_model=Page[schemas.QuarterRangeOut], description=get_quarter_ranges_description)
+@router.get('/quarter-ranges', response_model=Page[schemas.QuarterRangeOut], description=get_quarter_ranges_description, dependencies=[Depends(replicas.use_replica), Depends(etag.conditional(etag.QUARTER_RANGES, etag.QUARTERS))])
 # connects to db session
 # authenticate if user is logged in
 def get_quarter_ranges(db: Session = Depends(get_db), current_user = Depends(oauth2.get_current_user)):
     # retrieves data from db and returns it back to user
     # order data from start range descending
-    quarter_ranges = db.query(models.Quarter_Range).order_by(desc(models.Quarter_Range.start_range)).all()
+    quarter_ranges = db.query(models.Quarter_Range).options(joinedload(models.Quarter_Range.quarter)).filter(models.Quarter_Range.deleted_at == None).order_by(desc(models.Quarter_Range.start_range)).all()
     # return paginated list of quarter ranges
     return paginate(quarter_ranges)
 
+# loads a quarter range with its quarter in one query, for the response of a change
+def load_quarter_range(db: Session, id: int):
+    return db.query(models.Quarter_Range).options(joinedload(models.Quarter_Range.quarter)).filter(models.Quarter_Range.id == id).first()
+
 # description of create quarter range
 create_quarter_range_description = "Creates a quarter range which is added to db"
 # creates and add quarter range to db
@@ -80,23 +90,21 @@ def create_quarter_range(quarter_range: schemas.CreateUpdateQuarterRange,
     # checks if start date is greater than end date then raise exception if true
     if quarter_range.start_range > quarter_range.end_range:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Start date needs to be less than end date")
-    # checks if start/end date is between any range in table and returns exception if true
-    test_start_date = db.query(models.Quarter_Range).filter(
-        quarter_range.start_range >= models.Quarter_Range.start_range, 
-        quarter_range.start_range <= models.Quarter_Range.end_range).first()
-    if test_start_date:
-        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Start date conflicts with other quarter ranges")
-    test_end_date = db.query(models.Quarter_Range).filter(
-        quarter_range.end_range >= models.Quarter_Range.start_range, 
-        quarter_range.end_range <= models.Quarter_Range.end_range).first()
-    if test_end_date:
-        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="End date conflicts with other quarter ranges")
     # add the quarter_range to db and return the created range back to user
+    # the db rejects it with the exclusion constraint if it overlaps any range in table
     new_quarter = models.Quarter_Range(**quarter_range.dict())
     db.add(new_quarter)
-    db.commit()
-    db.refresh(new_quarter)
-    return new_quarter
+    try:
+        db.flush()
+        new_id = new_quarter.id
+        etag.bump(db, etag.QUARTER_RANGES)
+        db.commit()
+    except IntegrityError as e:
+        db.rollback()
+        if is_overlap_error(e):
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Quarter range conflicts with other quarter ranges")
+        raise
+    return load_quarter_range(db, new_id)
 
 # description of updating quarter range
 update_quarter_range_description = "Updates a quarter range in the database"
@@ -113,48 +121,47 @@ def update_quarter_range(id: int, quarter_range: schemas.CreateUpdateQuarterRang
     # checks if not admin. raise exception if true
     if current_user.role_type_id != 1:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to update quarter range")
-    # check if quarter range exists. if false return exception
-    quarter_range_query = db.query(models.Quarter_Range).filter(models.Quarter_Range.id == id)
-    test_quarter_range = quarter_range_query.first()
-    if not test_quarter_range:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Quarter Range with id: {id} was not found")
     # checks if start_range is greater than end_range. returns exception if true
     if quarter_range.start_range > quarter_range.end_range:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Start date needs to be less than end date")
-    # checks if both start/end dates conflict with other dates in the db
-    test_start_date = db.query(models.Quarter_Range).filter(
-        quarter_range.start_range >= models.Quarter_Range.start_range, 
-        quarter_range.start_range <= models.Quarter_Range.end_range).first()
-    if test_start_date and test_start_date.id != id:
-        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Start date conflicts with other quarter ranges")
-    test_end_date = db.query(models.Quarter_Range).filter(
-        quarter_range.end_range >= models.Quarter_Range.start_range, 
-        quarter_range.end_range <= models.Quarter_Range.end_range).first()
-    if test_end_date and test_end_date.id != id:
-        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="End date conflicts with other quarter ranges")
-    # updates and return the quarter_range
-    quarter_range_query.update(quarter_range.dict(), synchronize_session=False)
-    db.commit()
-    return quarter_range_query.first()
+    # updates and return the quarter_range, returns exception if the quarter range doesn't exist
+    # the db rejects it with the exclusion constraint if it overlaps any other range in table
+    try:
+        updated = db.execute(update(models.Quarter_Range).where(models.Quarter_Range.id == id, models.Quarter_Range.deleted_at == None).values(
+            **quarter_range.dict()).returning(models.Quarter_Range.id), execution_options={'synchronize_session': False}).first()
+        if not updated:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Quarter Range with id: {id} was not found")
+        etag.bump(db, etag.QUARTER_RANGES)
+        db.commit()
+    except IntegrityError as e:
+        db.rollback()
+        if is_overlap_error(e):
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Quarter range conflicts with other quarter ranges")
+        raise
+    return load_quarter_range(db, id)
 
 # description of deleting quarter range
-delete_quarter_range_description = "Delete a quarter range from the database"
+delete_quarter_range_description = ("Delete a quarter range from the database. The quarter range is hidden right away and a deletion job "
+    "removes it with its event times, points, winners and standings in the background, its progress is at /deletion-jobs/{job id}")
 # deletes a quarter range
 # routes to /quarter-ranges/id where id is an id of a certain quarter range
-# returns 204 if success
-@router.delete('/quarter-ranges/{id}', status_code=status.HTTP_204_NO_CONTENT, description=delete_quarter_range_description)
+# returns 202 with the deletion job if success
+@router.delete('/quarter-ranges/{id}', status_code=status.HTTP_202_ACCEPTED, response_model=DeletionJob, description=delete_quarter_range_description)
 # id for an id of quarter range
 # connects to db session
 # authenticate if user is logged in
-def delete_quarter_range(id:int, db: Session = Depends(get_db), current_user = Depends(oauth2.get_current_user)):
+def delete_quarter_range(id:int, response: Response, db: Session = Depends(get_db), current_user = Depends(oauth2.get_current_user)):
     # checks if not admin. returns exception if true
     if current_user.role_type_id != 1:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to delete quarter range")
-    # test if id is in the db. raise exception if not
-    quarter_range_query = db.query(models.Quarter_Range).filter(models.Quarter_Range.id == id)
-    if not quarter_range_query.first():
+    # hides the quarter range and adds the job that deletes it, then returns the job. raise exception if id isn't in the db
+    job = deletion_jobs.soft_delete(db, 'quarter-ranges', id)
+    if job is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Quarter Range with id: {id} was not found")
-    # deletes quarter-range and returns 204 when completed
-    quarter_range_query.delete(synchronize_session=False)
+    etag.bump(db, etag.QUARTER_RANGES, etag.EVENT_TIMES, etag.STUDENT_POINTS, etag.STUDENT_WINNERS)
     db.commit()
-    return Response(status_code=status.HTTP_204_NO_CONTENT)
\ No newline at end of file
+    deletion_jobs.wake()
+    # its points are hidden, live leaderboards reload
+    leaderboard_stream.reload()
+    response.headers['Location'] = f'/deletion-jobs/{job.id}'
+    return job
\ No newline at end of file
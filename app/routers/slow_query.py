@@ -0,0 +1,39 @@
+from typing import List
+from fastapi import Response, status, HTTPException, Depends, APIRouter
+from .. import oauth2, slow_query
+from ..schemas import SlowQueries as schemas
+
+# app would use this router to route methods
+# prefix for routes in file
+# tags for documentation
+router = APIRouter(
+    prefix='/slow-queries',
+    tags=['Slow Queries']
+)
+
+# description of get slow queries
+get_slow_queries_description = "Get the most recent slow sql statements recorded by the app"
+# get recent slow queries (newest first) from memory
+# routes to /slow-queries
+# response model returns a schema list of SlowQuery
+@router.get('/', response_model=List[schemas.SlowQuery], description=get_slow_queries_description)
+# authenticate if user is logged in
+def get_slow_queries(current_user = Depends(oauth2.get_current_user)):
+    # returns exception if user isn't an admin
+    if current_user.role_type_id != 1:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to view slow queries")
+    return slow_query.get_recent_queries()
+
+# description of clearing slow queries
+clear_slow_queries_description = "Clears the recorded slow sql statements"
+# clears the slow queries in memory
+# routes to /slow-queries
+# returns 204 if success
+@router.delete('/', status_code=status.HTTP_204_NO_CONTENT, description=clear_slow_queries_description)
+# authenticate if user is logged in
+def clear_slow_queries(current_user = Depends(oauth2.get_current_user)):
+    # returns exception if user isn't an admin
+    if current_user.role_type_id != 1:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to clear slow queries")
+    slow_query.clear_recent_queries()
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
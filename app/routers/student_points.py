@@ -1,14 +1,19 @@
 from datetime import datetime
-from typing import List
-from fastapi import Body, Response, status, HTTPException, Depends, APIRouter
-from fastapi.responses import StreamingResponse
-from fastapi_pagination import Page, paginate
-from sqlalchemy import asc, desc, func, text
-from .. import models, utils, oauth2
+from typing import List, Optional, Union
+from fastapi import Body, Header, Response, status, HTTPException, Depends, APIRouter
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from fastapi_pagination import Page
+from fastapi_pagination.api import pagination_ctx
+from sqlalchemy import asc, delete, desc, func, literal, select, text, true, union_all, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+from .. import models, utils, oauth2, etag, leaderboard_stream, fast_pages, replicas, idempotency, quarter_close, quarter_ranks
 from ..schemas import StudentPoints as schemas
-from ..database import engine, get_db
-from sqlalchemy.orm import Session
-import pandas as pd
+from ..schemas import Main as schema
+from ..database import get_db
+from sqlalchemy.orm import Session, contains_eager
+from .event_times import event_time_columns, event_time_item, include_event_time, join_event_time_tables
 import io
 
 # app would use this router to route methods
@@ -19,41 +24,97 @@ router = APIRouter(
     tags=['Student Points']
 )
 
+# error code postgres returns when uq_student_points_user_id_event_time_id rejects a point
+UNIQUE_VIOLATION = '23505'
+
+# table the points of a list are read from
+# student_points when no quarter range of the list is closed, else student_points and student_points_archive
+# together (the points of a closed quarter range can be moved to the archive at any time, a quarter range being
+# archived has points in both)
+def point_table(db: Session, quarter_range_id: str):
+    closed = quarter_close.get_closed(db)
+    if not closed or (quarter_range_id.isdigit() and int(quarter_range_id) not in closed):
+        return models.StudentPoint.__table__
+    hot, cold = models.StudentPoint.__table__, models.StudentPointArchive.__table__
+    return union_all(select(hot.c.id, hot.c.user_id, hot.c.event_time_id),
+        select(cold.c.id, cold.c.user_id, cold.c.event_time_id)).subquery('student_points')
+
+# columns of a point with its user and event time for the list fast path
+def point_columns(points):
+    return [points.c.id, points.c.user_id, points.c.event_time_id, models.User.username,
+        models.User.first_name, models.User.last_name, models.User.grade, *event_time_columns()]
+
+# returns exception when the point is in the archive, archived points can't be changed
+def check_not_archived(db: Session, id: int):
+    if db.query(models.StudentPointArchive.id).filter(models.StudentPointArchive.id == id).first():
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Student point with id: {id} is archived and can't be changed")
+
+
+# dict of a row with point_columns, same fields as schemas.StudentPointsOut
+def point_item(row):
+    return {"id": row["id"], "user_id": row["user_id"],
+        "user": {"id": row["user_id"], "username": row["username"], "first_name": row["first_name"], "last_name": row["last_name"],
+            "grade": row["grade"]},
+        "event_time_id": row["event_time_id"], "event_time": event_time_item(row)}
+
+# lite item of a row with point_columns, its user and event time are added to included
+def point_lite_item(row, included):
+    included.add("users", "user_id", row["user_id"], lambda: {"id": row["user_id"], "username": row["username"],
+        "first_name": row["first_name"], "last_name": row["last_name"], "grade": row["grade"]})
+    include_event_time(row, included, "event_time_id")
+    return {"id": row["id"], "user_id": row["user_id"], "event_time_id": row["event_time_id"]}
+
 # description of get student points
-get_student_points_description = "Get all of the student points from database"
+get_student_points_description = ("Get all of the student points from database. view=lite sends only the ids of the user and event time "
+    "of each point and lists the users, event times, events, quarter ranges and quarters once in included, fields=id,user_id limits the item fields")
 # get all student points from the db session
 # routes to /student-points
 # response model returns a schema list of StudentPointsOut that is paginated
-@router.get('/', response_model=Page[schemas.StudentPointsOut],description=get_student_points_description)
+@router.get('/', response_model=Union[Page[schemas.StudentPointsOut], schemas.StudentPointsLitePage],description=get_student_points_description, dependencies=[Depends(pagination_ctx(Page[schemas.StudentPointsOut])), Depends(replicas.use_replica), Depends(etag.conditional(etag.STUDENT_POINTS, etag.USERS, etag.EVENT_TIMES, etag.EVENTS, etag.QUARTER_RANGES, etag.QUARTERS, per_user=True))])
 # connects to db session
 # authenticate if user is logged in
 # filters for student points
-def get_points(db: Session = Depends(get_db), current_user = Depends(oauth2.get_current_user), student_id: str = '', event_time_id: str = '', quarter_range_id: str = ''):
-    # checks if current user is a student
+def get_points(response: Response, db: Session = Depends(get_db), current_user = Depends(oauth2.get_current_user), student_id: str = '', event_time_id: str = '', quarter_range_id: str = '',
+    view: schema.View = schema.View.full, fields: str = ''):
+    # only the columns of the response are selected, with the user, event time, event and quarter range joined in
+    table = point_table(db, quarter_range_id)
+    points = join_event_time_tables(db.query(*point_columns(table)).select_from(table).join(
+        models.User, (models.User.id == table.c.user_id) & (models.User.deleted_at == None)).join(
+        models.EventTime, models.EventTime.id == table.c.event_time_id))
+    # checks if current user is a student, students only get their own points
     if current_user.role_type_id == 3:
-        # get student points based on current user and join with event time table
-        student_points = db.query(models.StudentPoint).join(models.EventTime, models.EventTime.id == models.StudentPoint.event_time_id).order_by(desc(models.StudentPoint.id)).filter(models.StudentPoint.user_id == current_user.id)
-        # filters for event time and quarter range
-        if event_time_id.isdigit():
-            student_points = student_points.filter(models.StudentPoint.event_time_id == int(event_time_id))
-        if quarter_range_id.isdigit():
-            student_points = student_points.filter(models.EventTime.quarter_range_id == int(quarter_range_id))
-        # return a paginated list of student poitns
-        return paginate(student_points.all())
-    # gets all event times in db for admin/staff
-    points = db.query(models.StudentPoint).join(models.EventTime, models.EventTime.id == models.StudentPoint.event_time_id).order_by(desc(models.StudentPoint.id))
-    # filters for event, user, and quarter
-    if student_id.isdigit():
-        points = points.filter(models.StudentPoint.user_id == int(student_id))
+        points = points.filter(table.c.user_id == current_user.id)
+    # filters for user for admin/staff
+    elif student_id.isdigit():
+        points = points.filter(table.c.user_id == int(student_id))
+    # filters for event and quarter
     if event_time_id.isdigit():
-        points = points.filter(models.StudentPoint.event_time_id == int(event_time_id))
+        points = points.filter(table.c.event_time_id == int(event_time_id))
     if quarter_range_id.isdigit():
         points = points.filter(models.EventTime.quarter_range_id == int(quarter_range_id))
     # return a paginated list of student points
-    return paginate(points.all())
+    points = points.order_by(desc(table.c.id))
+    if view == schema.View.lite:
+        return fast_pages.lite_page_response(points, point_lite_item, response, fields)
+    return fast_pages.page_response(points, point_item, response)
+
+# inserts the point when its user is a student and selects it with the student (id is the id of the student) and the
+# columns of its event time, no row when the user isn't a student or already has the point
+def add_point_statement(point: schemas.CreatePoint):
+    student = select(models.User.id, models.User.username, models.User.first_name, models.User.last_name,
+        models.User.grade).where(models.User.id == point.user_id, models.User.role_type_id == 3, models.User.deleted_at == None).cte('student')
+    inserted = insert(models.StudentPoint.__table__).from_select(['user_id', 'event_time_id'],
+        select(student.c.id, literal(point.event_time_id))).on_conflict_do_nothing(
+        index_elements=['user_id', 'event_time_id']).returning(models.StudentPoint.id, models.StudentPoint.event_time_id).cte('inserted')
+    return select(student, inserted.c.id.label("point_id"), *event_time_columns()).select_from(inserted).join(
+        student, true()).join(models.EventTime, models.EventTime.id == inserted.c.event_time_id).join(
+        models.Events, models.Events.id == models.EventTime.event_id).join(
+        models.Quarter_Range, models.Quarter_Range.id == models.EventTime.quarter_range_id).join(
+        models.Quarter, models.Quarter.id == models.Quarter_Range.quarter_id)
 
 # description of create student point
-create_point_description = "Creates a student point which is added to db"
+create_point_description = ("Creates a student point which is added to db. A retry sent with the same Idempotency-Key header "
+    "gets the response of the first request back (with an Idempotent-Replayed header) instead of a second point or a 409")
 # creates and add student point to db
 # routes to /student-points
 # response status would be 201
@@ -62,29 +123,43 @@ create_point_description = "Creates a student point which is added to db"
 # CreatePoint schema for user to pass in data to create student point
 # connects to db session
 # authenticate if user is logged in
+# optional key the client sends again when it retries the request
 def add_point(point: schemas.CreatePoint,
-    db: Session = Depends(get_db), current_user = Depends(oauth2.get_current_user)):
+    db: Session = Depends(get_db), current_user = Depends(oauth2.get_current_user), idempotency_key: Optional[str] = Header(None)):
     # returns exception if user isn't an admin
     if current_user.role_type_id != 1:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=f"Not authorized to add points")
-    # checks if user id is valid. return exception if isn't
-    user = db.query(models.User).filter(models.User.id == point.user_id).first()
-    if not user:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Could not find user id in db")
-    # checks if point already exist and return exception if true
-    find_point = db.query(models.StudentPoint).filter(models.StudentPoint.event_time_id == point.event_time_id, 
-        models.StudentPoint.user_id == user.id).first()
-    if find_point:
+    # returns the response of the first request when this is a retry
+    if idempotency_key:
+        key_fingerprint = idempotency.fingerprint('POST /student-points', point.dict())
+        replayed = idempotency.claim(db, current_user.id, idempotency_key, key_fingerprint)
+        if replayed is not None:
+            return replayed
+    # adds the point and returns it with its student and event time in one statement, nothing is inserted when the
+    # user isn't a student or already has the point (so retries can't add it twice)
+    # points can't be added to a closed (or archived) quarter range
+    row = quarter_close.execute_point_write(db, add_point_statement(point)).first()
+    if row is None:
+        # only the failed requests look up why
+        user = db.query(models.User.role_type_id).filter(models.User.id == point.user_id, models.User.deleted_at == None).first()
+        # checks if user id is valid. return exception if isn't
+        if not user:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Could not find user id in db")
+        # checks if data is a student and return exception if false
+        if user.role_type_id != 3:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Only students can have points")
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Student already attended event")
-    # checks if data is a student and return exception if false
-    if user.role_type_id != 3:
-        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Only students can have points")
-    # adds student point to db and return point back to user
-    created_point = models.StudentPoint(**point.dict())
-    db.add(created_point)
+    # returns point back to user, the response is stored with the point for retries
+    content = jsonable_encoder(point_item({**row._mapping, "id": row.point_id, "user_id": row.id}))
+    if idempotency_key:
+        idempotency.store(db, current_user.id, idempotency_key, key_fingerprint, status.HTTP_201_CREATED, content)
+    new_versions = etag.bump(db, etag.quarter_points(row.quarter_range_id))
+    rank_index = quarter_ranks.before_change(row.quarter_range_id)
     db.commit()
-    db.refresh(created_point)
-    return created_point
+    # sends the rank changes to live leaderboard viewers and the rank index
+    leaderboard_stream.point_added(row.quarter_range_id, row, new_versions[etag.quarter_points(row.quarter_range_id)])
+    quarter_ranks.point_added(rank_index, row.quarter_range_id, row.id)
+    return ORJSONResponse(content, status_code=status.HTTP_201_CREATED)
     
 # description of updating student point
 update_point_description = "Updates a student point in the database"
@@ -101,31 +176,54 @@ def edit_point(id: int, point: schemas.EditPoint,
     # only admin can edit point returns exception if false
     if current_user.role_type_id != 1:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=f"Not authorized to add points")
-    # check if id in url exists returns exception if false
-    point_query = db.query(models.StudentPoint).filter(models.StudentPoint.id == id)
-    if not point_query.first():
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Student point with id: {id} does not exist")
     # check if user id exists returns exception if false
-    user = db.query(models.User).filter(models.User.id == point.user_id).first()
+    # the columns are selected so the user isn't loaded again after the commit (for the leaderboards)
+    user = db.query(models.User.id, models.User.username, models.User.first_name, models.User.last_name, models.User.grade,
+        models.User.role_type_id).filter(models.User.id == point.user_id, models.User.deleted_at == None).first()
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"User with id: {point.user_id} does not exist")
     # checks if student returns exception if false
     if user.role_type_id != 3:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Only students can have points")
     # check if event time id exists returns exception if false
-    event_time = db.query(models.EventTime).filter(models.EventTime.id == point.event_time_id).first()
+    # loaded with its event and quarter range for the response
+    event_time = join_event_time_tables(db.query(*event_time_columns()).select_from(models.EventTime)).filter(
+        models.EventTime.id == point.event_time_id).first()
     if not event_time:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Event Time with id: {point.event_time_id} does not exist")
-    # checks if point already exist returns exception if false
-    find_point = db.query(models.StudentPoint).filter(models.StudentPoint.event_time_id == point.event_time_id, 
-        models.StudentPoint.user_id == user.id).first()
-    if find_point:
-        if find_point.id == id:
+    # updates the point and returns its student and quarter range from before the update in the same statement
+    # points can't be moved into or out of a closed quarter range. the unique constraint rejects a point the student
+    # already has (a student has one point per event time), also when two edits move points to the same student and
+    # event time at once
+    table = models.StudentPoint.__table__
+    old = select(table.c.id, table.c.user_id, models.EventTime.quarter_range_id).join(
+        models.EventTime, models.EventTime.id == table.c.event_time_id).where(table.c.id == id).subquery('old')
+    try:
+        old_point = quarter_close.execute_point_write(db, update(table).where(table.c.id == old.c.id).values(**point.dict()).returning(
+            old.c.user_id, old.c.quarter_range_id)).first()
+    except IntegrityError as e:
+        db.rollback()
+        if getattr(e.orig, 'pgcode', None) == UNIQUE_VIOLATION:
             raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Student already attended event")
-    # updates point in db and returns point
-    point_query.update(point.dict(),synchronize_session=False)
+        raise
+    # check if id in url exists returns exception if false
+    if not old_point:
+        check_not_archived(db, id)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Student point with id: {id} does not exist")
+    # returns the point with the user and event time that were loaded before the update
+    content = jsonable_encoder(point_item({**user._mapping, **event_time._mapping, "id": id, "user_id": user.id}))
+    new_versions = etag.bump(db, etag.quarter_points(old_point.quarter_range_id), etag.quarter_points(event_time.quarter_range_id))
+    old_index, new_index = quarter_ranks.before_change(old_point.quarter_range_id), quarter_ranks.before_change(event_time.quarter_range_id)
     db.commit()
-    return point_query.first()
+    # moves the point on the live leaderboards and the rank indexes
+    leaderboard_stream.point_removed(old_point.quarter_range_id, old_point.user_id, new_versions[etag.quarter_points(old_point.quarter_range_id)])
+    leaderboard_stream.point_added(event_time.quarter_range_id, user, new_versions[etag.quarter_points(event_time.quarter_range_id)])
+    if old_point.quarter_range_id == event_time.quarter_range_id:
+        quarter_ranks.point_moved(old_index, old_point.quarter_range_id, old_point.user_id, user.id)
+    else:
+        quarter_ranks.point_removed(old_index, old_point.quarter_range_id, old_point.user_id)
+        quarter_ranks.point_added(new_index, event_time.quarter_range_id, user.id)
+    return ORJSONResponse(content)
 
 # description of deleting point
 delete_point_description = "Delete a student point from the database"
@@ -140,21 +238,32 @@ def delete_point(id: int, db: Session = Depends(get_db), current_user = Depends(
     # checks if not admin and returns exception if true
     if current_user.role_type_id != 1:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to delete points")
+    # deletes the point and returns its student and quarter range in one statement
+    # points of a closed quarter range can't be deleted
+    table = models.StudentPoint.__table__
+    deleted_point = quarter_close.execute_point_write(db, delete(table).where(table.c.id == id,
+        models.EventTime.id == table.c.event_time_id).returning(table.c.user_id, models.EventTime.quarter_range_id)).first()
     # check if id in url exists returns exception if false
-    point_query = db.query(models.StudentPoint).filter(models.StudentPoint.id == id)
-    if not point_query.first():
+    if not deleted_point:
+        check_not_archived(db, id)
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Student point with id: {id} does not exist")
-    # delete student point from db and return response
-    point_query.delete(synchronize_session=False)
+    user_id, quarter_range_id = deleted_point.user_id, deleted_point.quarter_range_id
+    new_versions = etag.bump(db, etag.quarter_points(quarter_range_id))
+    rank_index = quarter_ranks.before_change(quarter_range_id)
     db.commit()
+    leaderboard_stream.point_removed(quarter_range_id, user_id, new_versions[etag.quarter_points(quarter_range_id)])
+    quarter_ranks.point_removed(rank_index, quarter_range_id, user_id)
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
+# grades with a sheet in the export, in sheet order
+EXPORT_GRADES = [9, 10, 11, 12]
+
 # description of export student points
 export_student_points_description = "Export student points from database into excel sheet"
 # export student points from the db session
 # routes to /student-points/export
 # response model returns a schema list of StudentPointsOut that is paginated
-@router.get('/export',description=export_student_points_description)
+@router.get('/export',description=export_student_points_description, dependencies=[Depends(replicas.use_replica)])
 # connects to db session
 # authenticate if user is logged in
 # filters for student points
@@ -165,51 +274,31 @@ def get_points_for_export(db: Session = Depends(get_db), current_user = Depends(
     # checks if the quarter range is not a digit and return exception if true
     if quarter_range_id.isdigit() == False:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Conflict with quarter range id filter")
-    # get quarter range from the filter
-    quarter_range = db.query(models.Quarter_Range).join(models.Quarter, models.Quarter_Range.quarter_id == models.Quarter.id).filter(
-        models.Quarter_Range.id == quarter_range_id).first()
+    # get quarter range from the filter, with its quarter for the file name
+    quarter_range = db.query(models.Quarter_Range).join(models.Quarter, models.Quarter_Range.quarter_id == models.Quarter.id).options(
+        contains_eager(models.Quarter_Range.quarter)).filter(models.Quarter_Range.id == quarter_range_id, models.Quarter_Range.deleted_at == None).first()
     # returns exception if quarter range doesn't exists
     if not quarter_range:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Quarter range with filter not found")
-    # query all users with points
-    user_points = db.query(models.User, func.count(models.StudentPoint.user_id).label("points")).join(
-            models.StudentPoint, models.StudentPoint.user_id == models.User.id , isouter= True
-            ).join(models.EventTime, models.EventTime.id == models.StudentPoint.event_time_id).filter(
-            models.EventTime.quarter_range_id == int(quarter_range_id)
-        ).group_by(models.User.id)
-    # Creates a dataframe from pandas, apply filter for each grade, set column names and content
-    df = pd.read_sql(sql=user_points.filter(models.User.grade==9).with_entities(
-            models.User.id.label('User ID'),
-            models.User.username.label('Username'), 
-            models.User.first_name.label('First Name'),
-            models.User.last_name.label('Last Name'),
-            models.User.grade.label('Grade Level'),
-            func.count(models.StudentPoint.user_id).label("points")
-        ).statement, con=engine)
-    df1 = pd.read_sql(sql=user_points.filter(models.User.grade==10).with_entities(
+    # query all users with points, summed from the rollups so archived quarter ranges are exported the same way
+    # every grade is read in one query and split into its sheet afterwards
+    user_points = db.query(
             models.User.id.label('User ID'),
-            models.User.username.label('Username'), 
+            models.User.username.label('Username'),
             models.User.first_name.label('First Name'),
             models.User.last_name.label('Last Name'),
             models.User.grade.label('Grade Level'),
-            func.count(models.StudentPoint.user_id).label("points")
-        ).statement, con=engine)
-    df2 = pd.read_sql(sql=user_points.filter(models.User.grade==11).with_entities(
-            models.User.id.label('User ID'),
-            models.User.username.label('Username'), 
-            models.User.first_name.label('First Name'),
-            models.User.last_name.label('Last Name'),
-            models.User.grade.label('Grade Level'),
-            func.count(models.StudentPoint.user_id).label("points")
-        ).statement, con=engine)
-    df3 = pd.read_sql(sql=user_points.filter(models.User.grade==12).with_entities(
-            models.User.id.label('User ID'),
-            models.User.username.label('Username'), 
-            models.User.first_name.label('First Name'),
-            models.User.last_name.label('Last Name'),
-            models.User.grade.label('Grade Level'),
-            func.count(models.StudentPoint.user_id).label("points")
-        ).statement, con=engine)
+            func.sum(models.StudentPointRollup.points).label("points")
+        ).join(
+            models.StudentPointRollup, models.StudentPointRollup.user_id == models.User.id).filter(
+            models.StudentPointRollup.quarter_range_id == int(quarter_range_id), models.User.deleted_at == None,
+            models.User.grade.in_(EXPORT_GRADES)
+        ).group_by(models.User.id).all()
+    # imported here so pandas is only loaded by exports, not on startup
+    import pandas as pd
+    # Creates a dataframe from pandas, apply filter for each grade, set column names and content
+    all_points = pd.DataFrame(user_points, columns=['User ID', 'Username', 'First Name', 'Last Name', 'Grade Level', 'points'])
+    df, df1, df2, df3 = [all_points[all_points['Grade Level'] == grade].reset_index(drop=True) for grade in EXPORT_GRADES]
     # for exporting excel file data to the user instead of using a path
     out = io.BytesIO()
     # writes excel file
@@ -0,0 +1,101 @@
+from datetime import datetime, timedelta
+from typing import Optional
+from fastapi import Depends, APIRouter
+from sqlalchemy import func, literal_column, select, true
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from sqlalchemy.orm import Session
+from .. import models, oauth2, quarter_calendar
+from ..schemas import Sync as schemas
+from ..database import get_db
+
+# app would use this router to route methods
+# tags for documentation
+router = APIRouter(
+    tags=['Sync']
+)
+
+# rows changed this long before since are sent again, so writes that committed after a sync
+# but started before it are not missed (the client upserts them by id)
+SYNC_OVERLAP = timedelta(seconds=60)
+
+# tables that are synced with their model and key in the response
+SYNC_TABLES = {
+    'events': (models.Events, 'events'),
+    'prizes': (models.Prize, 'prizes'),
+    'quarters': (models.Quarter, 'quarters'),
+    'quarter-ranges': (models.Quarter_Range, 'quarter_ranges'),
+}
+
+# empty json array for tables without changed rows
+JSON_EMPTY = literal_column("'[]'::json")
+
+# json array of the values ordered by id, [] without rows
+def json_array(value, order_by, condition=None):
+    aggregate = func.json_agg(aggregate_order_by(value, order_by))
+    if condition is not None:
+        aggregate = aggregate.filter(condition)
+    return func.coalesce(aggregate, JSON_EMPTY)
+
+# json of a quarter range row with its quarter (same fields as QuarterRangeOut)
+def quarter_range_json():
+    return func.json_build_object('id', models.Quarter_Range.id, 'start_range', models.Quarter_Range.start_range,
+        'end_range', models.Quarter_Range.end_range, 'quarter_id', models.Quarter_Range.quarter_id,
+        'quarter', func.json_build_object('id', models.Quarter.id, 'quarter', models.Quarter.quarter))
+
+# scalar subqueries with the rows of a table updated since the last sync (all rows if since is None) as a json array,
+# and the ids of its soft deleted rows (None for tables without soft deletes). soft deleted rows are sent as deleted
+# right away (their tombstone is added when the deletion job removes them)
+def changed_rows(model, since):
+    table = model.__table__
+    soft_delete = 'deleted_at' in table.c
+    if model is models.Quarter_Range:
+        rows = select(json_array(quarter_range_json(), table.c.id, table.c.deleted_at == None)).select_from(
+            table.join(models.Quarter.__table__, models.Quarter.id == table.c.quarter_id))
+    else:
+        rows = select(json_array(func.row_to_json(table.table_valued()), table.c.id, table.c.deleted_at == None if soft_delete else None))
+    deleted = select(json_array(table.c.id, table.c.id, table.c.deleted_at != None)) if soft_delete else None
+    if since is not None:
+        rows = rows.where(table.c.updated_at > since)
+        deleted = deleted.where(table.c.updated_at > since) if soft_delete else None
+    return rows.scalar_subquery(), deleted.scalar_subquery() if soft_delete else None
+
+# description of sync
+sync_description = "Get events, prizes, quarters and quarter ranges changed or deleted since a watermark. Without since, returns all of them"
+# get reference data changed since the last sync
+# routes to /sync
+# response model returns a schema of SyncOut
+@router.get('/sync', response_model=schemas.SyncOut, description=sync_description)
+# connects to db session
+# authenticate if user is logged in
+# since is the watermark returned by the last sync
+def sync(db: Session = Depends(get_db), current_user = Depends(oauth2.get_current_user), since: Optional[datetime] = None):
+    full = since is None
+    if not full:
+        since = quarter_calendar.to_aware(since) - SYNC_OVERLAP
+    # the watermark (from the db clock so it matches updated_at), the changed rows of every table and the tombstones
+    # are read in one statement
+    columns = {'watermark': func.now()}
+    for model, key in SYNC_TABLES.values():
+        rows, deleted_ids = changed_rows(model, since)
+        columns[key] = rows
+        if deleted_ids is not None and not full:
+            columns[f'deleted_{key}'] = deleted_ids
+    if not full:
+        tombstone = models.SyncTombstone
+        columns['tombstones'] = select(json_array(func.json_build_object('table_name', tombstone.table_name, 'record_id', tombstone.record_id),
+            tombstone.id)).where(tombstone.deleted_at > since).scalar_subquery()
+    result = db.execute(select(*[column.label(name) for name, column in columns.items()])).one()._mapping
+    # ids of deleted rows for each table since the last sync
+    deleted = {key: list(result.get(f'deleted_{key}') or []) for (_, key) in SYNC_TABLES.values()}
+    for tombstone in result.get('tombstones') or []:
+        if tombstone['table_name'] in SYNC_TABLES:
+            deleted[SYNC_TABLES[tombstone['table_name']][1]].append(tombstone['record_id'])
+    return {
+        'watermark': result['watermark'],
+        'full': full,
+        'events': result['events'],
+        'prizes': result['prizes'],
+        'quarters': result['quarters'],
+        'quarter_ranges': result['quarter_ranges'],
+        'deleted': deleted,
+    }
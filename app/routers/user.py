@@ -2,13 +2,16 @@ from datetime import datetime
 from operator import or_
 from typing import List
 from fastapi import Body, Response, status, HTTPException, Depends, APIRouter
-from fastapi_pagination import Page, paginate
-from sqlalchemy import func, text
-from .. import models, utils, oauth2
+from fastapi_pagination import Page
+from fastapi_pagination.ext.sqlalchemy import paginate
+from sqlalchemy import asc, desc, func, update
+from sqlalchemy.exc import IntegrityError
+from .. import models, utils, oauth2, etag, leaderboard_stream, replicas, deletion_jobs
 from ..schemas import Users as schemas
+from ..schemas.DeletionJobs import DeletionJob
 from ..schemas import Main as schema
 from ..database import engine, get_db
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, joinedload
 
 # app would use router for methods
 # prefix /users to all methods below
@@ -18,32 +21,69 @@ router = APIRouter(
     tags=['Users']
 )
 
+# columns of the user table for each sort column
+USER_SORT_COLUMNS = {
+    schemas.UserSortColumn.id: models.User.id,
+    schemas.UserSortColumn.username: models.User.username,
+    schemas.UserSortColumn.first_name: models.User.first_name,
+    schemas.UserSortColumn.last_name: models.User.last_name,
+    schemas.UserSortColumn.grade: models.User.grade,
+    schemas.UserSortColumn.role_type_id: models.User.role_type_id,
+    schemas.UserSortColumn.created_at: models.User.created_at,
+}
+
+# error code postgres returns when the uq_users_username index rejects a username
+UNIQUE_VIOLATION = '23505'
+
+# checks if a db error is from a username another user has
+def is_username_error(e: IntegrityError):
+    return getattr(e.orig, 'pgcode', None) == UNIQUE_VIOLATION
+
+# loads a user with their role type in one query, for the response of a change
+def load_user(db: Session, id: int):
+    return db.query(models.User).options(joinedload(models.User.role_type)).filter(models.User.id == id).first()
+
+# updates a user that isn't deleted and returns their id, None if they don't exist
+# the db rejects a username another user has with the uq_users_username index
+def update_user_row(db: Session, id: int, values: dict):
+    return db.execute(update(models.User).where(models.User.id == id, models.User.deleted_at == None).values(**values).returning(
+        models.User.id), execution_options={'synchronize_session': False}).first()
+
 # description of get users
 get_users_description = "Get all of the users from database"
 # get all users from the db
 # response_model returns a list of Users using model UserOut from schemas with Paged data
 # Paged data includes total, page number, and page size
-@router.get('/', response_model=Page[schemas.UserOut], description=get_users_description)
+@router.get('/', response_model=Page[schemas.UserOut], description=get_users_description, dependencies=[Depends(replicas.use_replica)])
 # connects to db
 # Authenticates user to see if login (would return 401 if no user)
 # http parameters in order to filter and sort data
 def get_users(db: Session = Depends(get_db), current_user = Depends(oauth2.get_current_user),
     usernameFilter: str = '', firstNameFilter: str='',lastNameFilter: str='',
-        gradeFilter: int = None, roleTypeIdFilter: int = None, sortColumn: str = 'id', sortDir: str = 'desc'):
+        gradeFilter: int = None, roleTypeIdFilter: int = None,
+        sortColumn: schemas.UserSortColumn = schemas.UserSortColumn.id, sortDir: schema.SortDirection = schema.SortDirection.desc):
     # checks if current user is Admin
     # returns users based on filters and page
     if current_user.role_type_id == 1:
-        users_query = db.query(models.User).filter(
-            models.User.username.contains(usernameFilter), models.User.first_name.contains(
-                firstNameFilter), models.User.last_name.contains(lastNameFilter))
+        users_query = db.query(models.User).options(joinedload(models.User.role_type)).filter(models.User.deleted_at == None)
+        # only filters by text that was passed in so the sort index can be used
+        if usernameFilter:
+            users_query = users_query.filter(models.User.username.contains(usernameFilter))
+        if firstNameFilter:
+            users_query = users_query.filter(models.User.first_name.contains(firstNameFilter))
+        if lastNameFilter:
+            users_query = users_query.filter(models.User.last_name.contains(lastNameFilter))
         # as gradeFilter/roletype is an int, would need to pass it in if statement
         if gradeFilter != None:
             users_query = users_query.filter(models.User.grade == gradeFilter)
         if roleTypeIdFilter != None:
             users_query = users_query.filter(models.User.role_type_id == roleTypeIdFilter)
-        # sorts by column name and direction
-        users = users_query.order_by(text(sortColumn + ' ' + sortDir)).all()
-        return paginate(users)
+        # sorts by column and direction with id as tie breaker, then gets only the requested page from db
+        direction = desc if sortDir == schema.SortDirection.desc else asc
+        order = [direction(USER_SORT_COLUMNS[sortColumn])]
+        if sortColumn != schemas.UserSortColumn.id:
+            order.append(direction(models.User.id))
+        return paginate(users_query.order_by(*order))
     # returns error if no roles/ is student / is staff
     raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to view users")
 
@@ -67,7 +107,7 @@ get_find_user_description = "Find a user based on their username"
 # would find a user with a certain username for passing in point
 @router.get('/find', response_model=schemas.UserPointOut, description=get_find_user_description)
 def find_user(username: str = '', db: Session = Depends(get_db), current_user = Depends(oauth2.get_current_user)):
-    user = db.query(models.User).filter(models.User.username == username).first()
+    user = db.query(models.User).filter(models.User.username == username, models.User.deleted_at == None).first()
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Username not found")
     if user.role_type_id != 3:
@@ -82,19 +122,23 @@ create_user_description = "Create a user which is added to db"
 def create_user(user: schemas.UserCreate, db: Session = Depends(get_db), current_user = Depends(oauth2.get_current_user)):
     # checks if admin role in current user
     if current_user.role_type_id == 1:
-        # checks if username exist. returns error if it already does exist
-        findUser = db.query(models.User).filter(models.User.username == user.username).first()
-        if findUser:
-            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Username: {user.username} already exists")
         #hash password and add to UserCreate Model
         hashed_password = utils.hash(user.password)
         user.password = hashed_password
         new_user = models.User(**user.dict()) 
-        # adds to db and returns created user.
+        # adds to db and returns created user. returns error if the username already exists
         db.add(new_user)
+        try:
+            db.flush()
+        except IntegrityError as e:
+            db.rollback()
+            if is_username_error(e):
+                raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Username: {user.username} already exists")
+            raise
+        new_id = new_user.id
+        etag.bump(db, etag.USERS)
         db.commit()
-        db.refresh(new_user)
-        return new_user
+        return load_user(db, new_id)
     # returns error if not admin
     raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to create user")
 
@@ -116,11 +160,12 @@ def change_password(updated_password: schemas.ChangePassword, db: Session = Depe
     user_dict = {"password": utils.hash(updated_password.new_password)}
     user_dict["edited_at"] = datetime.now()
 
-    # query user, updates password and returns user
-    user_query = db.query(models.User).filter(models.User.id == current_user.id)
-    user_query.update(user_dict, synchronize_session=False)
+    # updates password and returns user (the current user is expired by the commit, their id is kept before it)
+    user_id = current_user.id
+    update_user_row(db, user_id, user_dict)
+    etag.bump(db, etag.USERS)
     db.commit()
-    return user_query.first()
+    return load_user(db, user_id)
 
 # description of update user
 update_user_description = "Update a user in the db"
@@ -131,23 +176,23 @@ def update_user(id:int , updated_user: schemas.UserUpdate, db: Session = Depends
         get_db), current_user = Depends(oauth2.get_current_user)):
     # checks if admin
     if current_user.role_type_id == 1:
-        # gets user if exist. return error if doesn't
-        user_query = db.query(models.User).filter(models.User.id == id)
-        user = user_query.first()
-        if user == None:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"User with id: {id} was not found")
-        # checks if changed username already exist. returns error if it does
         userdict = updated_user.dict()
-        username_query = db.query(models.User).filter(models.User.username==userdict['username']).first()
-        if username_query:
-            if username_query.id != id:
-                raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Username: {userdict['username']} already exists")
         # adds edited_at to db
         userdict["edited_at"] = datetime.now()
-        # update user to db and returns updated user.
-        user_query.update(userdict, synchronize_session=False)
+        # update user to db and returns updated user. returns error if the changed username already exists
+        try:
+            updated = update_user_row(db, id, userdict)
+        except IntegrityError as e:
+            db.rollback()
+            if is_username_error(e):
+                raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Username: {userdict['username']} already exists")
+            raise
+        # return error if the user doesn't exist
+        if not updated:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"User with id: {id} was not found")
+        etag.bump(db, etag.USERS)
         db.commit()
-        return user_query.first()
+        return load_user(db, id)
     # returns exception if user is not admin
     raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to update users")
 
@@ -159,42 +204,42 @@ def reset_password(id:int, updated_password: schemas.ResetPassword, db: Session
         get_db), current_user = Depends(oauth2.get_current_user)):
     # checks if admin
     if current_user.role_type_id == 1:
-        # get user with id and if exist. returns error if doesn't
-        user_query = db.query(models.User).filter(models.User.id == id)
-        user = user_query.first()
-        if user == None: 
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Cannot find user with id: {id}")
         # checks if passwords match
         if updated_password.confirm_new_password != updated_password.new_password:
             raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Passwords do not match")
         # adds password and edited_at to dictionary
         user_dict = {"password": utils.hash(updated_password.new_password)}
         user_dict["edited_at"] = datetime.now()
-        # updates user password to db and returns user
-        user_query.update(user_dict, synchronize_session=False)
+        # updates user password to db and returns user. returns error if the user doesn't exist
+        if not update_user_row(db, id, user_dict):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Cannot find user with id: {id}")
+        etag.bump(db, etag.USERS)
         db.commit()
-        return user_query.first()
+        return load_user(db, id)
     # returns error if not admin
     raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to update users")
 
 # description of delete user 
-delete_user_description = "Delete a user in the db"
-# delete a certain user. returns code 204 when completed
-@router.delete('/{id}', status_code=status.HTTP_204_NO_CONTENT, description=delete_user_description)
-def delete_user(id:int, db: Session = Depends(get_db), current_user = Depends(oauth2.get_current_user)):
+delete_user_description = "Delete a user in the db. The user is hidden right away and removed by a deletion job, its progress is at /deletion-jobs/{job id}"
+# delete a certain user. returns code 202 with the deletion job, the user is hidden right away and
+# removed with their points, winners and steps in the background
+@router.delete('/{id}', status_code=status.HTTP_202_ACCEPTED, response_model=DeletionJob, description=delete_user_description)
+def delete_user(id:int, response: Response, db: Session = Depends(get_db), current_user = Depends(oauth2.get_current_user)):
     # checks if admin
     if current_user.role_type_id == 1:
-        # get user from db with user. if doesn't exit return error
-        user_query = db.query(models.User).filter(models.User.id == id)
-        user = user_query.first()
-        if user == None:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"User with id: {id} was not found")
         # cannot delete self
-        if current_user.id == user.id:
+        if current_user.id == id:
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=f"Not authorized to delete this user")
-        # delete user in db then returns response
-        user_query.delete(synchronize_session=False)
+        # hides the user and adds the job that deletes them, then returns the job. returns error if the user doesn't exist
+        job = deletion_jobs.soft_delete(db, 'users', id)
+        if job is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"User with id: {id} was not found")
+        etag.bump(db, etag.USERS, etag.STUDENT_POINTS, etag.STUDENT_WINNERS)
         db.commit()
-        return Response(status_code=status.HTTP_204_NO_CONTENT)
+        deletion_jobs.wake()
+        # their points are hidden, live leaderboards reload
+        leaderboard_stream.reload()
+        response.headers['Location'] = f'/deletion-jobs/{job.id}'
+        return job
     # returns error if not admin
     raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to delete users")
@@ -1,12 +1,14 @@
 from datetime import datetime
-from typing import List
+from typing import List, Union
 from fastapi import Body, Response, status, HTTPException, Depends, APIRouter
 from fastapi_pagination import Page, paginate
+from fastapi_pagination.api import pagination_ctx
 from sqlalchemy import desc
-from .. import models, utils, oauth2
+from .. import models, utils, oauth2, fast_pages, replicas
 from ..schemas import UserSteps as schemas
+from ..schemas import Main as schema
 from ..database import engine, get_db
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, joinedload
 
 # app would use this router to route methods
 # prefix for routes in file
@@ -16,20 +18,42 @@ router = APIRouter(
     tags=['User Steps']
 )
 
+# columns of a step with its user and role type for lite pages
+def step_columns():
+    return [models.UserStep.id, models.UserStep.user_id, models.UserStep.step, models.UserStep.accessed_at, models.User.username,
+        models.User.first_name, models.User.last_name, models.User.grade, models.User.role_type_id, models.RoleType.role_type]
+
+# lite item of a row with step_columns, its user and role type are added to included
+def step_lite_item(row, included):
+    included.add("users", "user_id", row["user_id"], lambda: {"id": row["user_id"], "username": row["username"],
+        "first_name": row["first_name"], "last_name": row["last_name"], "grade": row["grade"], "role_type_id": row["role_type_id"]})
+    included.add("role_types", "user_id", row["role_type_id"], lambda: {"id": row["role_type_id"], "role_type": row["role_type"]})
+    return {"user_id": row["user_id"], "step": row["step"], "id": row["id"], "accessed_at": row["accessed_at"]}
+
 # description of get user steps
-get_steps_description = "Get all of the user steps from database"
+get_steps_description = ("Get all of the user steps from database. view=lite sends only the user id of each step and lists "
+    "the users and role types once in included, fields=id,step limits the item fields")
 # get all user steps from the db session
 # routes to /user-steps
 # response model returns a schema list of UserStep that is paginated
-@router.get('/', response_model=Page[schemas.UserStep], description=get_steps_description)
+@router.get('/', response_model=Union[Page[schemas.UserStep], schemas.UserStepsLitePage], description=get_steps_description, dependencies=[Depends(pagination_ctx(Page[schemas.UserStep])), Depends(replicas.use_replica)])
 # connects to db
 # authenticate if user is logged in
 # filters for step
-def get_steps(db: Session = Depends(get_db), current_user = Depends(oauth2.get_current_user), user_id: str = ''):
+def get_steps(response: Response, db: Session = Depends(get_db), current_user = Depends(oauth2.get_current_user), user_id: str = '',
+    view: schema.View = schema.View.full, fields: str = ''):
     if current_user.role_type_id != 1:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="User cannot access user steps")
-    # gets all steps
-    steps = db.query(models.UserStep)
+    # lite page with only the columns it sends, paginated in the db
+    if view == schema.View.lite:
+        steps = db.query(*step_columns()).select_from(models.UserStep).join(models.User, models.User.id == models.UserStep.user_id).join(
+            models.RoleType, models.RoleType.id == models.User.role_type_id, isouter=True)
+        if user_id.isdigit():
+            steps = steps.filter(models.UserStep.user_id == int(user_id))
+        return fast_pages.lite_page_response(steps.order_by(desc(models.UserStep.accessed_at), desc(models.UserStep.id)),
+            step_lite_item, response, fields)
+    # gets all steps with their user and role type in the same query
+    steps = db.query(models.UserStep).options(joinedload(models.UserStep.user).joinedload(models.User.role_type))
     # filters for step
     if  user_id.isdigit():
         steps = steps.filter(models.UserStep.user_id == user_id)
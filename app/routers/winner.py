@@ -2,11 +2,11 @@ from datetime import datetime
 from typing import List
 from fastapi import Body, Response, status, HTTPException, Depends, APIRouter
 from fastapi_pagination import Page, paginate
-from sqlalchemy import func, text
-from .. import models, utils, oauth2
+from sqlalchemy import delete, desc, exists, func, insert, or_, select, update
+from .. import models, utils, oauth2, etag, replicas, prize_catalog
 from ..schemas import Winners as schemas
 from ..database import engine, get_db
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, joinedload
 
 # app would use this router to route methods
 # prefix for routes in file
@@ -16,18 +16,23 @@ router = APIRouter(
     tags=['Student Winners']
 )
 
+# loads the user, quarter range and prize of winners in the same query
+def winner_load_options():
+    return [joinedload(models.StudentWinner.user), joinedload(models.StudentWinner.prize),
+        joinedload(models.StudentWinner.quarter_range).joinedload(models.Quarter_Range.quarter)]
+
 # description of get winners
 get_winners_description = "Get all of the winners from database"
 # get all winners from the db session
 # routes to /student-winners
 # response model returns a schema list of StudentWinners that is paginated
-@router.get('/', response_model=Page[schemas.StudentWinner], description=get_winners_description)
+@router.get('/', response_model=Page[schemas.StudentWinner], description=get_winners_description, dependencies=[Depends(replicas.use_replica), Depends(etag.conditional(etag.STUDENT_WINNERS, etag.USERS, etag.PRIZES, etag.QUARTER_RANGES, etag.QUARTERS))])
 # connects to db session
 # authenticate if user is logged in
 # filters for winners
 def get_winners(db: Session = Depends(get_db), current_user = Depends(oauth2.get_current_user), student_id: str = '', quarter_range_id: str = ''):
     # winners query
-    winners = db.query(models.StudentWinner)
+    winners = db.query(models.StudentWinner).options(*winner_load_options())
     # filters based on user id and winner id
     if student_id.isdigit():
         winners = winners.filter(models.StudentWinner.user_id == int(student_id))
@@ -50,74 +55,66 @@ def create_winners(quarter: schemas.CreateWinner, db: Session = Depends(get_db),
     # checks if not admin, returns exception if true
     if current_user.role_type_id != 1:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to create quarter range")
-    winners = [] # define a list of winners to be added to response
-    # checks if quarter with id exists. returns exception if false
-    quarter_query = db.query(models.Quarter_Range).filter(quarter.quarter_range_id == models.Quarter_Range.id)
-    if not quarter_query.first():
+    # adds the winners, returns exception if the quarter range doesn't exist
+    ids = add_winners(db, quarter.quarter_range_id)
+    if ids is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Quarter range with id: {quarter.quarter_range_id} was not found")
-    # checks if already top winner. creates a winner with the most amount of points
-    check_top_winner = db.query(models.StudentWinner).filter(quarter.quarter_range_id == models.StudentWinner.quarter_range_id, models.StudentWinner.top_points == True).first()
-    if not check_top_winner:
-        # get winner based on the quarter and points
-        winner_query = db.query(models.User, func.count(models.StudentPoint.user_id).label("points")).join(
-            models.StudentPoint, models.StudentPoint.user_id == models.User.id, isouter=True).join(models.EventTime, models.StudentPoint.event_time_id == models.EventTime.id).filter(
-                models.EventTime.quarter_range_id == quarter.quarter_range_id).group_by(
-                models.User.id).order_by(text("points DESC")).first()
-        # check if students have any points 
-        if winner_query:
-            # level of prize for winner
-            level = return_prize_level(winner_query.points)
-            # get random prize based on points
-            prize = db.query(models.Prize).filter(
-                level == models.Prize.level).order_by(
-                text("RANDOM()")).first()
-            # checks if no prize based on level
-            if not prize:
-                raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Prize with level: {level} was not found")
-            # add top winner to db and add to winners list
-            top_winner_dict = {"user_id": winner_query.User.id, "quarter_range_id":quarter.quarter_range_id, "prize_id":prize.id, "top_points":True, "points": winner_query.points}
-            winner = models.StudentWinner(**top_winner_dict)
-            db.add(winner)
-            db.commit()
-            db.refresh(winner)
-            winners.append(winner)
-    # Get a random student from each grade wtih a point
-    for grade in range(9, 13):
-        # checks if grade winner already exists for quarter
-        check_winner = db.query(models.StudentWinner).join(models.User, models.User.id == models.StudentWinner.user_id, isouter=True).filter(
-            models.StudentWinner.quarter_range_id == quarter.quarter_range_id,
-            models.User.grade == grade, models.StudentWinner.top_points == False).first()
-        # would go to the next pass if true
-        if check_winner:
-            continue
-        # gets a random winner based on the quarter then add to db
-        grade_winner = db.query(models.User, func.count(models.StudentPoint.user_id).label("points")).join(
-            models.User, models.StudentPoint.user_id == models.User.id, isouter=True).join(models.EventTime, models.StudentPoint.event_time_id == models.EventTime.id).filter(
-                models.EventTime.quarter_range_id == quarter.quarter_range_id, models.User.grade == grade).group_by(
-                models.User.id).order_by(text("RANDOM()")).first()
-        # checks if ANY winner exists for the grade
-        if grade_winner:
-            # level of prize for winner
-            level = return_prize_level(grade_winner.points)
-            # get random prize based on points
-            prize = db.query(models.Prize).filter(
-                level == models.Prize.level).order_by(
-                text("RANDOM()")).first()
-            # checks if no prize based on level
-            if not prize:
-                raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Prize with level: {level} was not found")
-            # add grade quarter winner to db and to list
-            quarter_winner = {"user_id": grade_winner.User.id, "quarter_range_id":quarter.quarter_range_id, "prize_id":prize.id, "top_points":False, "points": grade_winner.points}
-            winner = models.StudentWinner(**quarter_winner)
-            db.add(winner)
-            db.commit()
-            db.refresh(winner)
-            winners.append(winner)
     # check if winners is empty and return exception
-    if not winners:
+    if not ids:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="No winners to add to db")
-    # return the list of winners
-    return winners
+    # all winners are committed together
+    db.commit()
+    # return the list of winners, loaded with their user, prize and quarter range in one query
+    return db.query(models.StudentWinner).options(*winner_load_options()).filter(models.StudentWinner.id.in_(ids)).order_by(
+        models.StudentWinner.id).all()
+
+# grades that get a random winner
+GRADES = range(9, 13)
+
+# adds the top winner and a random winner of each grade that the quarter range doesn't have yet
+# used by the route and by the quarter close. the winners are inserted but not committed, returns their ids
+# (None when the quarter range doesn't exist)
+def add_winners(db: Session, quarter_range_id: int):
+    # winners the quarter range already has with the grade of each, in one query with the quarter range
+    # (one row without a winner when it has none, no rows when it doesn't exist)
+    existing = db.query(models.StudentWinner.id, models.StudentWinner.top_points, models.User.grade).select_from(models.Quarter_Range).join(
+        models.StudentWinner, models.StudentWinner.quarter_range_id == models.Quarter_Range.id, isouter=True).join(
+        models.User, models.User.id == models.StudentWinner.user_id, isouter=True).filter(
+        models.Quarter_Range.id == quarter_range_id, models.Quarter_Range.deleted_at == None).all()
+    if not existing:
+        return None
+    existing = [row for row in existing if row.id is not None]
+    has_top_winner = any(row.top_points for row in existing)
+    missing_grades = [grade for grade in GRADES if grade not in {row.grade for row in existing if not row.top_points}]
+    if has_top_winner and not missing_grades:
+        return []
+    # points per student of the quarter (from the rollups, the points of archived quarter ranges aren't in student points)
+    totals = db.query(models.User.id.label("user_id"), models.User.grade, func.sum(models.StudentPointRollup.points).label("points")).join(
+        models.StudentPointRollup, models.StudentPointRollup.user_id == models.User.id).filter(
+        models.StudentPointRollup.quarter_range_id == quarter_range_id, models.User.deleted_at == None).group_by(models.User.id).subquery()
+    # the student with the most points and a random student with a point from each grade, in one query
+    ranked = select(totals, func.row_number().over(order_by=desc(totals.c.points)).label("top_rank"),
+        func.row_number().over(partition_by=totals.c.grade, order_by=func.random()).label("grade_rank")).subquery()
+    picks = db.execute(select(ranked).where(or_(ranked.c.top_rank == 1, ranked.c.grade_rank == 1))).all()
+    # creates a winner with the most amount of points if there isn't one (if students have any points)
+    # then a winner for each grade without one, each with a random prize of the level for the points from the prize catalog
+    picked = [(pick, True) for pick in picks if pick.top_rank == 1 and not has_top_winner]
+    picked += sorted([(pick, False) for pick in picks if pick.grade_rank == 1 and pick.grade in missing_grades], key=lambda p: p[0].grade)
+    rows = []
+    took_prize = False
+    # prizes with a quantity this request couldn't take, left out of the picks for the other winners too
+    used_up = set()
+    for pick, top_points in picked:
+        prize = choose_prize(db, pick.points, used_up)
+        took_prize = took_prize or prize.quantity is not None
+        rows.append({"user_id": pick.user_id, "quarter_range_id": quarter_range_id, "prize_id": prize.id, "top_points": top_points,
+            "points": pick.points})
+    if not rows:
+        return []
+    # adds all winners in one insert
+    ids = [row.id for row in db.execute(insert(models.StudentWinner).values(rows).returning(models.StudentWinner.id))]
+    etag.bump(db, etag.STUDENT_WINNERS, *([etag.PRIZES] if took_prize else []))
+    return ids
 
 # description of updating winner
 update_winner_description = "Updates a winner in the database"
@@ -134,18 +131,17 @@ def update_winner(id: int, winner: schemas.UpdateWinner,
     # checks if not admin, returns exception if true
     if current_user.role_type_id != 1:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to create quarter range")
-    # check if winner with id exist. returns exception if false
-    winner_query = db.query(models.StudentWinner).filter(id == models.StudentWinner.id)
-    if not winner_query.first():
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Winner with id: {id} was not found")
-    # check if prize id exists. returns exception if false
-    prize = db.query(models.Prize).filter(winner.prize_id == models.Prize.id).first()
-    if not prize:
+    # updates winner when the prize exists, returns exception if the winner or prize doesn't exist
+    updated = db.execute(update(models.StudentWinner).where(models.StudentWinner.id == id, exists().where(models.Prize.id == winner.prize_id)).values(
+        **winner.dict()).returning(models.StudentWinner.id), execution_options={'synchronize_session': False}).first()
+    if not updated:
+        if not db.query(models.StudentWinner.id).filter(models.StudentWinner.id == id).first():
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Winner with id: {id} was not found")
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Prize with id: {winner.prize_id} was not found")
-    # updates winner and returns winner
-    winner_query.update(winner.dict(), synchronize_session=False)
+    etag.bump(db, etag.STUDENT_WINNERS)
     db.commit()
-    return winner_query.first()
+    # returns the winner loaded with their user, prize and quarter range in one query
+    return db.query(models.StudentWinner).options(*winner_load_options()).filter(models.StudentWinner.id == id).first()
 
 # description of deleting winner
 delete_winner_description = "Delete a winner from the database"
@@ -160,20 +156,34 @@ def delete_winner(id: int, db: Session = Depends(get_db), current_user = Depends
     # checks if not admin, returns exception if true
     if current_user.role_type_id != 1:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to create quarter range")
-    # check if winner with id exist. returns exception if false
-    winner_query = db.query(models.StudentWinner).filter(id == models.StudentWinner.id)
-    if not winner_query.first():
+    # delete winner and returns status code, returns exception if the winner doesn't exist
+    deleted = db.execute(delete(models.StudentWinner).where(models.StudentWinner.id == id), execution_options={'synchronize_session': False})
+    if not deleted.rowcount:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Winner with id: {id} was not found")
-    # delete winner and returns status code
-    winner_query.delete(synchronize_session=False)
+    etag.bump(db, etag.STUDENT_WINNERS)
     db.commit()
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
-# would return prize level for certain amount of points
-def return_prize_level(count: int):
-    if count < 5:
-        return 1
-    elif count < 15:
-        return 2
-    else:
-        return 3
\ No newline at end of file
+# picks a random prize (by weight) of the level for the points from the in memory prize catalog
+# prizes with a quantity are taken in the db in the transaction of the winner. a prize that is used up (taken by
+# another request or earlier in this one, the catalog can't see either) is added to used_up and another prize of the
+# level is picked without it, the catalog is reloaded for the next requests. the caller bumps the prizes version
+# when one was taken
+def choose_prize(db: Session, points: int, used_up: set):
+    level = prize_catalog.get_level(db, points)
+    if level is None:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"No prize level for {points} points")
+    while True:
+        prize = prize_catalog.pick_prize(db, level, used_up)
+        if prize is None:
+            break
+        if prize.quantity is None:
+            return prize
+        taken = db.execute(update(models.Prize).where(models.Prize.id == prize.id, models.Prize.quantity > 0).values(
+            quantity=models.Prize.quantity - 1).returning(models.Prize.id), execution_options={'synchronize_session': False}).first()
+        if taken:
+            return prize
+        used_up.add(prize.id)
+        prize_catalog.invalidate()
+    # checks if no prize is left at the level
+    raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Prize with level: {level} was not found")
@@ -0,0 +1,18 @@
+from datetime import datetime
+from typing import Optional
+from pydantic import BaseModel
+
+# schema for outputting a deletion job with its progress
+class DeletionJob(BaseModel):
+    id: int
+    table_name: str
+    record_id: int
+    # pending, running, done or failed
+    status: str
+    deleted_rows: int
+    error: Optional[str] = None
+    created_at: datetime
+    updated_at: datetime
+    finished_at: Optional[datetime] = None
+    class Config:
+        orm_mode=True
@@ -1,5 +1,6 @@
-from datetime import datetime
-from pydantic import BaseModel
+from datetime import date, datetime, time
+from typing import List, Optional
+from pydantic import BaseModel, conint, conlist, root_validator
 
 from app.schemas.Quarters import QuarterRangeOut
 
@@ -30,4 +31,31 @@ class EventTime(CreateUpdateEventTime):
     quarter_range: QuarterRangeOut
     # to return schema to user
     class Config: 
-        orm_mode=True
\ No newline at end of file
+        orm_mode=True
+
+# schema for one occurrence of a bulk created event time
+class EventTimeOccurrence(BaseModel):
+    start_time: datetime
+    end_time: datetime
+
+# schema for a weekly schedule of event times
+# weekdays are 0 for monday to 6 for sunday, times without a time zone are the server's local time
+class EventTimeRecurrence(BaseModel):
+    start_date: date
+    end_date: date
+    weekdays: conlist(conint(ge=0, le=6), min_items=1)
+    start_time: time
+    end_time: time
+
+# schema for creating many event times of an event at once
+# takes either a list of occurrences or a recurrence rule
+class BulkCreateEventTimes(BaseModel):
+    event_id: int
+    occurrences: Optional[List[EventTimeOccurrence]] = None
+    recurrence: Optional[EventTimeRecurrence] = None
+
+    @root_validator
+    def check_occurrences_or_recurrence(cls, values):
+        if (values.get('occurrences') is None) == (values.get('recurrence') is None):
+            raise ValueError('either occurrences or recurrence is required')
+        return values
@@ -1,4 +1,5 @@
 from datetime import datetime
+from enum import Enum
 from typing import Optional
 from pydantic import BaseModel, EmailStr, conint
 
@@ -22,6 +23,19 @@ class Token(BaseModel):
 class TokenData(BaseModel):
     id: Optional[str] = None
 
+# direction for sorting lists
+# a cleared sort (Angular MatSort sends an empty direction) sorts ascending like the database default
+class SortDirection(str, Enum):
+    asc = 'asc'
+    desc = 'desc'
+    none = ''
+
+# shape of list items. lite items only have their own columns and the ids of what they reference,
+# the referenced rows are listed once per page in included
+class View(str, Enum):
+    full = 'full'
+    lite = 'lite'
+
 # for the chatbot input of the user
 class ChatBotInput(BaseModel):
     message: str
\ No newline at end of file
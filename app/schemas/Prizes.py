@@ -1,13 +1,41 @@
-from pydantic import BaseModel, conint
+from typing import List, Optional
+from pydantic import BaseModel, conint, validator
 
 # schema for creating/updating a prize
+# weight is the chance of the prize being picked compared to the other prizes of its level
+# quantity is the number of prizes left (None for no limit)
 class CreateUpdatePrize(BaseModel):
     name: str
-    level: conint(ge=1,le=3)
+    level: conint(ge=1)
+    weight: conint(ge=1) = 1
+    quantity: Optional[conint(ge=0)] = None
 
 # Prize schema for output
 # references CreatePrize for fields
 class Prize(CreateUpdatePrize):
     id: int
     class Config:
-        orm_mode=True
\ No newline at end of file
+        orm_mode=True
+
+# schema of a prize level and the points a winner needs for it
+class PrizeLevel(BaseModel):
+    level: conint(ge=1)
+    min_points: conint(ge=0)
+    class Config:
+        orm_mode=True
+
+# schema for replacing the prize levels, levels and points have to be unique and higher levels need more points
+class UpdatePrizeLevels(BaseModel):
+    levels: List[PrizeLevel]
+
+    @validator('levels')
+    def check_levels(cls, levels):
+        if not levels:
+            raise ValueError('at least one level is needed')
+        levels = sorted(levels, key=lambda l: l.level)
+        for lower, higher in zip(levels, levels[1:]):
+            if higher.level == lower.level:
+                raise ValueError(f'level {higher.level} is listed twice')
+            if higher.min_points <= lower.min_points:
+                raise ValueError(f'level {higher.level} needs more points than level {lower.level}')
+        return levels
@@ -0,0 +1,13 @@
+from datetime import datetime
+from typing import Optional
+from pydantic import BaseModel
+
+# schema for outputting a recorded slow query
+class SlowQuery(BaseModel):
+    recorded_at: datetime
+    method: Optional[str] = None
+    route: Optional[str] = None
+    duration_ms: float
+    statement: str
+    parameters: Optional[str] = None
+    explain: Optional[str] = None
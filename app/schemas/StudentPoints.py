@@ -1,8 +1,9 @@
 from datetime import datetime
+from typing import List, Optional
 from pydantic import BaseModel
-from .Quarters import QuarterRangeOut
+from .Quarters import Quarter, QuarterRangeOut
 from .Users import UserPointOut
-from .Events import EventTime
+from .Events import Event, EventTime
 
 # point schema for inputting student point
 class CreatePoint(BaseModel):
@@ -24,3 +25,62 @@ class StudentPointsOut(BaseModel):
     class Config:
         orm_mode = True
 
+# lite student point schema, the user and event time are in included
+class StudentPointLite(BaseModel):
+    id: int
+    user_id: int
+    event_time_id: int
+
+# event time of included without its event and quarter range
+class EventTimeLite(BaseModel):
+    id: int
+    start_time: datetime
+    end_time: datetime
+    event_id: int
+    quarter_range_id: int
+
+# quarter range of included without its quarter
+class QuarterRangeLite(BaseModel):
+    id: int
+    start_range: datetime
+    end_range: datetime
+    quarter_id: int
+
+# rows referenced by the points of a page, each listed once
+class StudentPointsIncluded(BaseModel):
+    users: List[UserPointOut] = []
+    event_times: List[EventTimeLite] = []
+    events: List[Event] = []
+    quarter_ranges: List[QuarterRangeLite] = []
+    quarters: List[Quarter] = []
+
+# page of lite student points
+class StudentPointsLitePage(BaseModel):
+    items: List[StudentPointLite]
+    total: int
+    page: int
+    size: int
+    included: StudentPointsIncluded
+
+# schema for checking in a student at a kiosk
+# username is the username of the student (or the badge code printed from it)
+# the event happening now is used, event_id or event_time_id pick one when several are happening
+class CheckIn(BaseModel):
+    username: str
+    event_id: Optional[int] = None
+    event_time_id: Optional[int] = None
+
+# event time a student was checked in to
+class CheckInEvent(BaseModel):
+    event_time_id: int
+    event_id: int
+    name: str
+    start_time: datetime
+    end_time: datetime
+
+# schema for outputting a check in, already_checked_in is true when the student had the point before the scan
+class CheckInOut(BaseModel):
+    point_id: Optional[int]
+    already_checked_in: bool
+    user: UserPointOut
+    event: CheckInEvent
@@ -0,0 +1,24 @@
+from datetime import datetime
+from typing import List
+from pydantic import BaseModel
+from .Events import Event
+from .Prizes import Prize
+from .Quarters import Quarter, QuarterRangeOut
+
+# ids of deleted rows for each table
+class SyncDeleted(BaseModel):
+    events: List[int] = []
+    prizes: List[int] = []
+    quarters: List[int] = []
+    quarter_ranges: List[int] = []
+
+# schema for outputting reference data changed since a watermark
+# the client passes watermark back as since on its next sync
+class SyncOut(BaseModel):
+    watermark: datetime
+    full: bool
+    events: List[Event]
+    prizes: List[Prize]
+    quarters: List[Quarter]
+    quarter_ranges: List[QuarterRangeOut]
+    deleted: SyncDeleted
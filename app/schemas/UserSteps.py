@@ -1,5 +1,7 @@
+from typing import List, Optional
 from pydantic import BaseModel
 from .Users import UserOut
+from .Main import RoleType
 from datetime import datetime
 
 # schema for creating a step
@@ -14,4 +16,31 @@ class UserStep(CreateStep):
     accessed_at: datetime
     user: UserOut
     class Config:
-        orm_mode=True
\ No newline at end of file
+        orm_mode=True
+
+# lite user step schema, the user is in included
+class UserStepLite(CreateStep):
+    id: int
+    accessed_at: datetime
+
+# user of included with the id of its role type
+class UserLite(BaseModel):
+    id: int
+    username: str
+    first_name: str
+    last_name: str
+    grade: Optional[int] = None
+    role_type_id: Optional[int] = None
+
+# rows referenced by the steps of a page, each listed once
+class UserStepsIncluded(BaseModel):
+    users: List[UserLite] = []
+    role_types: List[RoleType] = []
+
+# page of lite user steps
+class UserStepsLitePage(BaseModel):
+    items: List[UserStepLite]
+    total: int
+    page: int
+    size: int
+    included: UserStepsIncluded
@@ -1,9 +1,20 @@
 from datetime import datetime
+from enum import Enum
 from typing import Optional
 from pydantic import BaseModel, conint
 
 from app.schemas import Main as schemas
 
+# columns users can be sorted by (each has an index with id as tie breaker)
+class UserSortColumn(str, Enum):
+    id = 'id'
+    username = 'username'
+    first_name = 'first_name'
+    last_name = 'last_name'
+    grade = 'grade'
+    role_type_id = 'role_type_id'
+    created_at = 'created_at'
+
 # schema for creating a user
 class UserCreate(BaseModel):
     username: str
@@ -33,3 +33,9 @@ class Points(BaseModel):
     points: int
     class Conifg:
         orm_mode=True
+
+# schema used to return the points of a user with their place in the leaderboard
+class UserPoints(Points):
+    rank: int
+    total: int
+    percentile: float
@@ -0,0 +1,134 @@
+# slow query log for the app
+# statements slower than the threshold in settings are logged with the route that ran them,
+# kept in a ring buffer for admins and optionally explained in the background
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from sqlalchemy import event
+
+from .config import settings
+from .metrics import current_request
+
+logger = logging.getLogger('app.slow_query')
+
+# execution option that keeps the explain statements out of the log
+SKIP_OPTION = 'skip_slow_query_log'
+# parameter names that are never logged
+SENSITIVE_KEYS = ('password', 'secret', 'token')
+# explains waiting in the background before new ones are dropped
+MAX_PENDING_EXPLAINS = 10
+
+# most recent slow queries, oldest are dropped once full
+recent_queries = deque(maxlen=settings.slow_query_log_size)
+lock = threading.Lock()
+
+# single background worker so explains never compete with requests for more than one connection
+explain_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='slow-query-explain')
+pending_explains = 0
+
+# hides values of bound parameters. numbers/dates/booleans are kept, strings only show their length
+def redact_value(key, value):
+    if key is not None and any(word in str(key).lower() for word in SENSITIVE_KEYS):
+        return '***'
+    if isinstance(value, (bytes, str)):
+        return f'<str len={len(value)}>'
+    return value
+
+def redact_parameters(parameters):
+    if parameters is None:
+        return None
+    if isinstance(parameters, dict):
+        return {key: redact_value(key, value) for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        # executemany passes a list of parameter sets
+        if parameters and isinstance(parameters[0], (dict, list, tuple)):
+            return [redact_parameters(p) for p in parameters[:5]]
+        return [redact_value(None, value) for value in parameters]
+    return redact_value(None, parameters)
+
+# returns recorded slow queries with the newest first
+def get_recent_queries():
+    with lock:
+        return list(reversed(recent_queries))
+
+def clear_recent_queries():
+    with lock:
+        recent_queries.clear()
+
+# runs EXPLAIN (ANALYZE, BUFFERS) for a slow statement on its own connection
+def explain_query(engine, entry: dict, statement: str, parameters):
+    global pending_explains
+    try:
+        with engine.connect() as conn:
+            conn = conn.execution_options(**{SKIP_OPTION: True})
+            # analyze really runs the statement, so it is rolled back afterwards
+            trans = conn.begin()
+            try:
+                rows = conn.exec_driver_sql('EXPLAIN (ANALYZE, BUFFERS) ' + statement, parameters).fetchall()
+            finally:
+                trans.rollback()
+        entry['explain'] = '\n'.join(row[0] for row in rows)
+        logger.warning('explain for slow query on %s %s:\n%s', entry['method'], entry['route'], entry['explain'])
+    except Exception as e:
+        entry['explain'] = f'explain failed: {e}'
+    finally:
+        with lock:
+            pending_explains -= 1
+
+# records a statement that went over the threshold
+def record_slow_query(engine, statement: str, parameters, executemany: bool, elapsed: float):
+    global pending_explains
+    stats = current_request.get()
+    entry = {
+        'recorded_at': datetime.now(timezone.utc),
+        'method': stats.method if stats else None,
+        'route': stats.route if stats else None,
+        'duration_ms': round(elapsed * 1000, 3),
+        'statement': statement,
+        'parameters': repr(redact_parameters(parameters)),
+        'explain': None,
+    }
+    logger.warning('slow query (%.1f ms) on %s %s: %s params=%s', entry['duration_ms'], entry['method'], entry['route'],
+        statement, entry['parameters'])
+    with lock:
+        recent_queries.append(entry)
+        # only select statements are explained as analyze would execute writes again
+        can_explain = (settings.slow_query_explain and not executemany and pending_explains < MAX_PENDING_EXPLAINS
+            and statement.lstrip().lower().startswith('select'))
+        if can_explain:
+            pending_explains += 1
+    if can_explain:
+        explain_executor.submit(explain_query, engine, entry, statement, parameters)
+
+# times statements with cursor events and records the ones over the threshold
+def install_slow_query_log(engine):
+    threshold = settings.slow_query_threshold_ms / 1000
+    if threshold <= 0:
+        return
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('slow_query_start_time', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['slow_query_start_time'].pop()
+        if elapsed < threshold:
+            return
+        if context is not None and context.execution_options.get(SKIP_OPTION):
+            return
+        record_slow_query(engine, statement, parameters, executemany, elapsed)
+
+    # a failed statement never reaches after_cursor_execute so drop its start time
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        if context.connection is not None and context.connection.info.get('slow_query_start_time'):
+            context.connection.info['slow_query_start_time'].pop()
+
+# waits for the explains already queued (on shutdown)
+def shutdown():
+    explain_executor.shutdown(wait=True)
@@ -0,0 +1,80 @@
+# startup time regression check
+# imports app.main in a new interpreter with python -X importtime and exits with an error when the import
+# takes longer than its budget or loads a heavy dependency that should only be imported by the route using it
+# example: python -m benchmarks.import_time --runs 5
+import argparse
+import os
+import subprocess
+import sys
+
+from .run import DEFAULT_ENV, ROOT
+
+MODULE = 'app.main'
+# seconds importing the app may take (best of the runs), IMPORT_TIME_BUDGET_SECONDS sets it for a slower machine
+BUDGET_SECONDS = float(os.environ.get('IMPORT_TIME_BUDGET_SECONDS', '1.0'))
+# imported inside the routes that need them (export, chatbot)
+LAZY_MODULES = ['pandas', 'torch', 'nltk', 'numpy', 'chatbot']
+
+# settings are read when app is imported, the database isn't connected to so any values work
+IMPORT_ENV = {
+    'DATABASE_HOSTNAME': 'localhost',
+    'DATABASE_PORT': '5432',
+    'DATABASE_PASSWORD': 'postgres',
+    'DATABASE_NAME': 'postgres',
+    'DATABASE_USERNAME': 'postgres',
+    **DEFAULT_ENV,
+}
+
+# imports the module in a new interpreter, returns (module, self us, cumulative us) for every import
+def import_times(module: str):
+    env = {**IMPORT_ENV, **os.environ}
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=ROOT, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        error = '\n'.join(line for line in result.stderr.splitlines() if not line.startswith('import time:'))
+        raise RuntimeError(f'importing {module} failed:\n{error}')
+    times = []
+    for line in result.stderr.splitlines():
+        # import time:       self [us] |  cumulative | imported package
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times.append((name.strip(), int(self_us), int(cumulative_us)))
+    return times
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check the time it takes to import the app')
+    parser.add_argument('--module', default=MODULE)
+    parser.add_argument('--runs', type=int, default=3, help='imports to run, the fastest one is checked')
+    parser.add_argument('--budget', type=float, default=BUDGET_SECONDS, help='seconds the import may take')
+    parser.add_argument('--top', type=int, default=15, help='slowest top level imports to print')
+    args = parser.parse_args(argv)
+
+    # the first run also writes the bytecode caches
+    runs = [import_times(args.module) for _ in range(max(args.runs, 1))]
+    times = min(runs, key=lambda run: sum(self_us for _, self_us, _ in run))
+    total = sum(self_us for _, self_us, _ in times) / 1e6
+
+    # top level packages by the time their imports took
+    packages = {}
+    for name, self_us, _ in times:
+        package = name.split('.')[0]
+        packages[package] = packages.get(package, 0) + self_us
+    print(f'{"package":<36}{"ms":>10}')
+    for package, us in sorted(packages.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+        print(f'{package:<36}{us / 1000:>10.1f}')
+    print(f'\nimporting {args.module} took {total * 1000:.0f} ms (budget {args.budget * 1000:.0f} ms)')
+
+    failures = []
+    loaded = {name.split('.')[0] for name, _, _ in times}
+    for module in LAZY_MODULES:
+        if module in loaded:
+            failures.append(f'{module} is imported on startup')
+    if total > args.budget:
+        failures.append(f'import took {total:.2f}s, over the budget of {args.budget:.2f}s')
+    for failure in failures:
+        print(f'FAIL {failure}')
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
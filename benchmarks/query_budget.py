@@ -0,0 +1,378 @@
+# query count regression check for every route
+# sends one request to each route against a seeded database, counts the sql statements it ran
+# and exits with an error when a route runs more statements than its budget
+# example: python -m benchmarks.query_budget --temp-cluster --users 200
+import argparse
+import sys
+import threading
+from contextlib import ExitStack, contextmanager
+from datetime import datetime, timedelta, timezone
+
+from . import run
+from .scenarios import STUDENT
+from .seed import SEED_PASSWORD
+
+# highest number of sql statements each route may run, including the current user lookup
+# every statement the request causes is counted: the table version increments committed with a change, the reloads
+# of in memory caches the request finds out of date, and the work it queues on background threads (idempotency key
+# cleanup, explains of slow queries). lists paginated in the db count the total in the page query, lists paginated
+# in memory read all rows at once. a change is auth, its write, the version increment and, for routes that return
+# the row with its relationships, one joined load of it
+BUDGETS = {
+    'POST /login': 2,
+    'GET /logout': 0,
+    'GET /users/': 3,
+    'GET /users/role-types': 2,
+    'GET /users/find': 2,
+    # the username is checked by the unique index, the user is loaded with their role type after the commit
+    'POST /users/': 4,
+    'PUT /users/change-password': 4,
+    'PUT /users/{id}': 4,
+    'PUT /users/reset-password/{id}': 4,
+    # hides the user and adds the deletion job in one statement (the rows are removed by the job afterwards), the
+    # frozen standings of the closed quarter ranges the user is in are looked up to refreeze them
+    'DELETE /users/{id}': 4,
+    'GET /quarters': 2,
+    # the quarter ranges come from memory
+    'GET /quarter-ranges/current': 1,
+    'GET /quarter-ranges': 2,
+    'POST /quarter-ranges': 4,
+    'PUT /quarter-ranges/{id}': 4,
+    'DELETE /quarter-ranges/{id}': 3,
+    'GET /events/': 2,
+    # the name is checked by the unique index, the event is sent as it was inserted
+    'POST /events/': 3,
+    'PUT /events/{id}': 3,
+    'DELETE /events/{id}': 3,
+    'GET /student-points/': 2,
+    # a quarter range whose points were moved to the archive table, the list reads both tables in one query
+    'GET /student-points/ (archived)': 2,
+    # claims the Idempotency-Key, queues the cleanup of expired keys (once per interval), adds the point and returns
+    # it with its student and event time in one statement, then stores the response
+    'POST /student-points/': 6,
+    # retry with the same Idempotency-Key, answered from the stored response
+    'POST /student-points/ (replay)': 1,
+    # the student and event time are loaded as columns, the update returns the old student and quarter range
+    'PUT /student-points/{id}': 5,
+    'DELETE /student-points/{id}': 3,
+    # the quarter range and the points of every grade are one query each
+    'GET /student-points/export': 3,
+    'GET /prizes/': 2,
+    'GET /prizes/levels': 2,
+    'PUT /prizes/levels': 5,
+    'POST /prizes/': 3,
+    'PUT /prizes/{id}': 3,
+    'DELETE /prizes/{id}': 3,
+    'GET /student-winners/': 2,
+    # the existing winners (with the quarter range), the picks for the top and every grade, the prize catalog reload
+    # after the levels changed (levels and prizes), the insert of every winner, the version increment and the load
+    'POST /student-winners/': 8,
+    'PUT /student-winners/{id}': 4,
+    'DELETE /student-winners/{id}': 3,
+    'GET /event-times/': 2,
+    'GET /event-times/current': 2,
+    # the quarter ranges are reloaded into memory after the quarter range changes before it
+    'POST /event-times/': 5,
+    'PUT /event-times/{id}': 4,
+    # an event time of a closed quarter range, the guard trigger rejects the update (its only statement)
+    'PUT /event-times/{id} (closed)': 1,
+    'POST /event-times/bulk': 5,
+    'DELETE /event-times/{id}': 3,
+    'GET /past-winners': 2,
+    # the quarter ranges come from memory
+    'GET /past-quarter': 1,
+    'GET /leaderboards': 2,
+    # the first read after the close reloads the closed quarter ranges
+    'GET /leaderboards (just closed)': 3,
+    # a page of the frozen standings, the total is the participants of the close
+    'GET /leaderboards (closed)': 2,
+    # loads the standings once per quarter range, not per viewer (not exercised, the stream stays open)
+    'GET /leaderboards/stream': 1,
+    'GET /leaderboards/rollup': 3,
+    # the rank index of the quarter range is loaded by its first lookup
+    'GET /user-points': 2,
+    'GET /user-points (closed)': 2,
+    'GET /user-steps/': 2,
+    'POST /user-steps/': 5,
+    # current events come from memory, the student and point are one statement
+    'POST /check-in': 4,
+    'GET /slow-queries/': 1,
+    'DELETE /slow-queries/': 1,
+    # the watermark, the changed rows of every table and the tombstones are one statement
+    'GET /sync': 2,
+    'POST /predict': 1,
+    'GET /metrics': 0,
+    'GET /deletion-jobs/{id}': 2,
+    # the jobs of the user, event and quarter range deleted above, run after the routes: each is claimed, sets
+    # app.deleting once per transaction and runs every child delete (a batch that deleted rows adds its progress and
+    # the version increment and commits), then deletes the row. the last claim finds no job
+    'deletion jobs': 34,
+    # a failed job of the deleted user tried again: the claim, app.deleting and the six child deletes (nothing left)
+    # in one transaction with the row delete, its progress and version increment, and the claim that finds no job
+    'deletion jobs (retry)': 12,
+}
+
+# collects the sql statements the engine runs while active, on any thread
+@contextmanager
+def capture_statements(engine):
+    from sqlalchemy import event
+    statements = []
+    lock = threading.Lock()
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        with lock:
+            statements.append(statement)
+
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'after_cursor_execute', after_cursor_execute)
+
+# waits for the work a request queued on the background threads (idempotency key cleanup, explains of slow queries,
+# deletion jobs), so its statements are counted for the request. each executor has one thread and runs in order
+def drain_background():
+    from app import deletion_jobs, idempotency, slow_query
+    for executor in (idempotency.cleanup_executor, slow_query.explain_executor, deletion_jobs.deletion_executor):
+        executor.submit(lambda: None).result()
+
+# every method and path of the app as "METHOD /path"
+def app_routes(app):
+    from fastapi.routing import APIRoute
+    keys = set()
+    for route in app.routes:
+        if isinstance(route, APIRoute):
+            for method in route.methods:
+                keys.add(f'{method} {route.path}')
+    return keys
+
+# sends one request and compares its statements with the budget of the route
+class BudgetChecker:
+    def __init__(self, engines):
+        self.engines = engines
+        self.results = []
+
+    # counts the statements run in the block and by the background work it queued under key
+    @contextmanager
+    def counting(self, key: str):
+        with ExitStack() as stack:
+            captured = [stack.enter_context(capture_statements(engine)) for engine in self.engines]
+            yield
+            drain_background()
+        statements = [statement for engine_statements in captured for statement in engine_statements]
+        self.results.append((key, len(statements), statements))
+
+    def request(self, client, key: str, url: str, expected_status: int, **kwargs):
+        method = key.split(' ', 1)[0]
+        with self.counting(key):
+            response = client.request(method, url, **kwargs)
+            response.read()
+        if response.status_code != expected_status:
+            raise RuntimeError(f'{key} returned {response.status_code} instead of {expected_status}: {response.text}')
+        return response
+
+# requests for every route, creating the rows the update/delete routes need
+def exercise_routes(checker: BudgetChecker, client_factory, ctx):
+    past_range = ctx['quarter_range_ids'][0]
+    now = datetime.now(timezone.utc)
+    with client_factory() as admin, client_factory() as student, client_factory() as new_admin:
+        check = checker.request
+        # warms up the connection pool so dialect setup queries are not counted
+        admin.post('/login', data={'username': 'admin', 'password': '123qwe'})
+        check(admin, 'POST /login', '/login', 200, data={'username': 'admin', 'password': '123qwe'})
+        student_username = ctx['usernames'][STUDENT][0]
+        student.post('/login', data={'username': student_username, 'password': SEED_PASSWORD})
+
+        # reads
+        check(admin, 'GET /users/', '/users/?page=1&size=50', 200)
+        check(admin, 'GET /users/role-types', '/users/role-types', 200)
+        check(admin, 'GET /users/find', f'/users/find?username={student_username}', 200)
+        check(admin, 'GET /quarters', '/quarters', 200)
+        check(admin, 'GET /quarter-ranges/current', '/quarter-ranges/current', 200)
+        check(admin, 'GET /quarter-ranges', '/quarter-ranges?page=1&size=50', 200)
+        check(admin, 'GET /events/', '/events/?page=1&size=50', 200)
+        check(admin, 'GET /prizes/', '/prizes/?page=1&size=50', 200)
+        levels = check(admin, 'GET /prizes/levels', '/prizes/levels', 200).json()
+        check(admin, 'GET /event-times/', f'/event-times/?quarter_range_id={past_range}&page=1&size=50', 200)
+        check(admin, 'GET /event-times/current', '/event-times/current', 200)
+        check(admin, 'GET /student-points/', f'/student-points/?quarter_range_id={past_range}&page=1&size=50', 200)
+        check(student, 'GET /student-points/', f'/student-points/?quarter_range_id={past_range}&page=1&size=50', 200)
+        check(admin, 'GET /student-points/export', f'/student-points/export?quarter_range_id={past_range}', 200)
+        check(admin, 'GET /student-winners/', f'/student-winners/?quarter_range_id={past_range}&page=1&size=50', 200)
+        check(admin, 'GET /past-winners', f'/past-winners?quarter_range_id={past_range}', 200)
+        check(admin, 'GET /past-quarter', '/past-quarter', 200)
+        check(admin, 'GET /leaderboards', f'/leaderboards?quarter_range_id={past_range}&page=1&size=50', 200)
+        check(admin, 'GET /leaderboards/rollup', '/leaderboards/rollup?year_to_date=true&page=1&size=50', 200)
+        check(student, 'GET /user-points', f'/user-points?quarter_range_id={past_range}', 200)
+        check(admin, 'GET /user-steps/', '/user-steps/?page=1&size=50', 200)
+        check(admin, 'GET /user-steps/', '/user-steps/?page=1&size=50&view=lite', 200)
+        check(admin, 'GET /student-points/', f'/student-points/?quarter_range_id={past_range}&page=1&size=50&view=lite', 200)
+        check(admin, 'GET /slow-queries/', '/slow-queries/', 200)
+        check(admin, 'DELETE /slow-queries/', '/slow-queries/', 204)
+        check(student, 'POST /predict', '/predict', 200, json={'message': 'Hi'})
+        check(admin, 'GET /metrics', '/metrics', 200)
+        check(admin, 'GET /sync', '/sync', 200)
+
+        # quarter range far in the future so it never overlaps the seeded ones
+        start = now + timedelta(days=365 * 50)
+        body = {'start_range': start.isoformat(), 'end_range': (start + timedelta(days=60)).isoformat(), 'quarter_id': 1}
+        quarter_range = check(admin, 'POST /quarter-ranges', '/quarter-ranges', 201, json=body).json()
+        check(admin, 'PUT /quarter-ranges/{id}', f'/quarter-ranges/{quarter_range["id"]}', 200, json=body)
+
+        event = check(admin, 'POST /events/', '/events/', 201, json={'name': 'Budget Event', 'is_sport': False}).json()
+        check(admin, 'PUT /events/{id}', f'/events/{event["id"]}', 200, json={'name': 'Budget Event', 'is_sport': True})
+
+        body = {'start_time': (start + timedelta(days=1)).isoformat(), 'end_time': (start + timedelta(days=1, hours=2)).isoformat(),
+            'event_id': event['id']}
+        event_time = check(admin, 'POST /event-times/', '/event-times/', 201, json=body).json()
+        check(admin, 'PUT /event-times/{id}', f'/event-times/{event_time["id"]}', 200, json=body)
+        body = {'event_id': event['id'], 'recurrence': {'start_date': (start + timedelta(days=2)).date().isoformat(),
+            'end_date': (start + timedelta(days=30)).date().isoformat(), 'weekdays': [1, 3], 'start_time': '15:00:00', 'end_time': '17:00:00'}}
+        check(admin, 'POST /event-times/bulk', '/event-times/bulk', 201, json=body)
+
+        body = {'user_id': ctx['student_ids'][0], 'event_time_id': event_time['id']}
+        headers = {'Idempotency-Key': f'budget-{event_time["id"]}'}
+        point = check(admin, 'POST /student-points/', '/student-points/', 201, json=body, headers=headers).json()
+        check(admin, 'POST /student-points/ (replay)', '/student-points/', 201, json=body, headers=headers)
+        body['user_id'] = ctx['student_ids'][1]
+        check(admin, 'PUT /student-points/{id}', f'/student-points/{point["id"]}', 200, json=body)
+        check(admin, 'DELETE /student-points/{id}', f'/student-points/{point["id"]}', 204)
+
+        check(admin, 'PUT /prizes/levels', '/prizes/levels', 200, json={'levels': levels})
+        # the winners are picked before the prize is added, so only the winner moved to it has it when it is deleted
+        winners = check(admin, 'POST /student-winners/', '/student-winners/', 201, json={'quarter_range_id': past_range}).json()
+        prize = check(admin, 'POST /prizes/', '/prizes/', 201, json={'name': 'Budget Prize', 'level': 1}).json()
+        check(admin, 'PUT /prizes/{id}', f'/prizes/{prize["id"]}', 200, json={'name': 'Budget Prize', 'level': 1})
+        check(admin, 'PUT /student-winners/{id}', f'/student-winners/{winners[0]["id"]}', 200, json={'prize_id': prize['id']})
+        check(admin, 'DELETE /student-winners/{id}', f'/student-winners/{winners[0]["id"]}', 204)
+
+        # closes the past quarter range like the quarter close task does and reads its frozen standings
+        from app import models, quarter_close
+        from app.database import SessionLocal
+        db = SessionLocal()
+        try:
+            quarter_close.close_quarter_range(db, past_range)
+        finally:
+            db.close()
+        check(admin, 'GET /leaderboards (just closed)', f'/leaderboards?quarter_range_id={past_range}&page=1&size=50', 200)
+        check(student, 'GET /user-points (closed)', f'/user-points?quarter_range_id={past_range}', 200)
+        # its event times can't be moved to another quarter range
+        db = SessionLocal()
+        try:
+            closed_event_time = db.query(models.EventTime).filter(models.EventTime.quarter_range_id == past_range).first()
+        finally:
+            db.close()
+        body = {'start_time': (start + timedelta(days=3)).isoformat(), 'end_time': (start + timedelta(days=3, hours=2)).isoformat(),
+            'event_id': closed_event_time.event_id}
+        check(admin, 'PUT /event-times/{id} (closed)', f'/event-times/{closed_event_time.id}', 409, json=body)
+
+        # archives its points like python -m app archive does and reads them back through the list
+        from app import archive
+        db = SessionLocal()
+        try:
+            archive.archive_quarter_range(db, past_range)
+        finally:
+            db.close()
+        check(admin, 'GET /student-points/ (archived)', f'/student-points/?quarter_range_id={past_range}&page=1&size=50', 200)
+        check(admin, 'GET /leaderboards (closed)', f'/leaderboards?quarter_range_id={past_range}&page=1&size=50', 200)
+
+        check(admin, 'POST /user-steps/', '/user-steps/', 201, json={'user_id': ctx['student_ids'][0], 'step': 'budget'})
+        if ctx['current_event_time_ids']:
+            check(admin, 'POST /check-in', '/check-in', 201, json={'username': student_username, 'event_time_id': ctx['current_event_time_ids'][0]})
+
+        body = {'username': 'budget_admin', 'password': 'budget123', 'first_name': 'Budget', 'last_name': 'Admin', 'role_type_id': 1}
+        user = check(admin, 'POST /users/', '/users/', 201, json=body).json()
+        body.pop('password')
+        check(admin, 'PUT /users/{id}', f'/users/{user["id"]}', 200, json=body)
+        check(admin, 'PUT /users/reset-password/{id}', f'/users/reset-password/{user["id"]}', 200,
+            json={'new_password': 'budget456', 'confirm_new_password': 'budget456'})
+        new_admin.post('/login', data={'username': 'budget_admin', 'password': 'budget456'})
+        check(new_admin, 'PUT /users/change-password', '/users/change-password', 200,
+            json={'current_password': 'budget456', 'new_password': 'budget789', 'confirm_new_password': 'budget789'})
+        check(new_admin, 'GET /logout', '/logout', 204)
+
+        # removes what was created
+        job = check(admin, 'DELETE /users/{id}', f'/users/{user["id"]}', 202).json()
+        check(admin, 'DELETE /event-times/{id}', f'/event-times/{event_time["id"]}', 204)
+        check(admin, 'DELETE /events/{id}', f'/events/{event["id"]}', 202)
+        check(admin, 'DELETE /prizes/{id}', f'/prizes/{prize["id"]}', 204)
+        check(admin, 'DELETE /quarter-ranges/{id}', f'/quarter-ranges/{quarter_range["id"]}', 202)
+        # runs the deletion jobs the deletes added and checks they finished
+        from app import deletion_jobs
+        with checker.counting('deletion jobs'):
+            deletion_jobs.run_pending()
+        job = check(admin, 'GET /deletion-jobs/{id}', f'/deletion-jobs/{job["id"]}', 200).json()
+        if job['status'] != 'done':
+            raise RuntimeError(f'deletion job {job["id"]} is {job["status"]}: {job["error"]}')
+        check_job_retry(checker, job['id'])
+
+# marks a finished job failed and checks the periodic look for jobs (deletion_jobs.run_pending) leaves it alone until
+# STALE_SECONDS passed and then runs it again to the end
+def check_job_retry(checker: BudgetChecker, job_id: int):
+    from sqlalchemy import func, update
+    from app import deletion_jobs, models
+    from app.database import SessionLocal
+
+    def fail_job(failed_seconds_ago: int):
+        db = SessionLocal()
+        try:
+            db.execute(update(models.DeletionJob).where(models.DeletionJob.id == job_id).values(status='failed', error='budget check',
+                updated_at=func.now() - timedelta(seconds=failed_seconds_ago)), execution_options={'synchronize_session': False})
+            db.commit()
+        finally:
+            db.close()
+
+    def job_status():
+        db = SessionLocal()
+        try:
+            return db.query(models.DeletionJob.status).filter(models.DeletionJob.id == job_id).scalar()
+        finally:
+            db.close()
+
+    fail_job(0)
+    deletion_jobs.run_pending()
+    if job_status() != 'failed':
+        raise RuntimeError(f'deletion job {job_id} was tried again before {deletion_jobs.STALE_SECONDS} seconds passed')
+    fail_job(deletion_jobs.STALE_SECONDS + 1)
+    with checker.counting('deletion jobs (retry)'):
+        deletion_jobs.run_pending()
+    if job_status() != 'done':
+        raise RuntimeError(f'failed deletion job {job_id} was not tried again')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fail when a route runs more sql statements than its budget')
+    run.add_database_arguments(parser)
+    parser.add_argument('--verbose', action='store_true', help='print the statements of routes over budget')
+    args = parser.parse_args(argv)
+
+    with run.prepare_database(args) as ctx:
+        from app import etag
+        from app.database import engine, replica_engines
+        from app.main import app
+        # the versions are re-read every second whatever the requests do, so the reads are stopped and don't land in
+        # the count of a request at random. every change is made by this process, its copy of the versions stays current
+        etag.versions.stopping.set()
+        failures = []
+        # every route needs a budget so new routes can't skip the check
+        for key in sorted(app_routes(app) - set(BUDGETS)):
+            failures.append(f'{key} has no query budget')
+        checker = BudgetChecker([engine, *replica_engines])
+        exercise_routes(checker, run.make_client_factory(), ctx)
+        for key in sorted(set(BUDGETS) - {key for key, _, _ in checker.results}):
+            print(f'warning: {key} was not exercised')
+        for key, count, statements in checker.results:
+            budget = BUDGETS.get(key)
+            ok = budget is not None and count <= budget
+            print(f'{"ok  " if ok else "FAIL"} {key:<36} {count:>3} / {budget}')
+            if not ok and budget is not None:
+                failures.append(f'{key} ran {count} statements, budget is {budget}')
+                if args.verbose:
+                    for statement in statements:
+                        print('      ', ' '.join(statement.split())[:200])
+
+    for failure in failures:
+        print('error:', failure)
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
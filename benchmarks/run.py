@@ -0,0 +1,110 @@
+# runs the benchmark scenarios against a seeded local postgres
+# example: python -m benchmarks.run --temp-cluster --users 2000 --requests 500 --concurrency 16
+import argparse
+import json
+import os
+import sys
+from contextlib import contextmanager, nullcontext
+
+from . import postgres, seed, scenarios
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# settings the app needs that are not about the database
+DEFAULT_ENV = {
+    'SECRET_KEY': '09d25e094faa6ca2556c818166b7a9563b93f7099f6f0f4caa6cf63b88e8d3e7',
+    'ALGORITHM': 'HS256',
+    'ACCESS_TOKEN_EXPIRE_MINUTES': '60',
+    # the seeded past quarter ranges stay open (the checks that need a closed one close it themselves)
+    'QUARTER_CLOSE_CHECK_SECONDS': '0',
+    # deletion jobs are run by the checks themselves after the routes, the query budget counts them on their own
+    'DELETION_JOBS_IN_BACKGROUND': 'false',
+}
+
+# creates the tables with the alembic migrations
+def migrate():
+    from alembic import command
+    from alembic.config import Config
+    config = Config(os.path.join(ROOT, 'alembic.ini'))
+    config.set_main_option('script_location', os.path.join(ROOT, 'alembic'))
+    command.upgrade(config, 'head')
+
+# in process client unless a running server url is passed in
+def make_client_factory(base_url: str = None):
+    if base_url:
+        import httpx
+        return lambda: httpx.Client(base_url=base_url, timeout=120)
+    from fastapi.testclient import TestClient
+    from app.main import app
+    return lambda: TestClient(app)
+
+def print_results(name: str, results):
+    print(f'\n== {name}')
+    print(f'{"endpoint":<36}{"requests":>10}{"rps":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}  statuses')
+    for row in results:
+        print(f'{row["endpoint"]:<36}{row["requests"]:>10}{row["throughput_rps"]:>10}{row["p50_ms"]:>10}'
+            f'{row["p95_ms"]:>10}{row["p99_ms"]:>10}  {row["statuses"]}')
+
+# adds the database options shared by the benchmark commands
+def add_database_arguments(parser):
+    parser.add_argument('--temp-cluster', action='store_true', help='start a throwaway postgres cluster with initdb/pg_ctl')
+    parser.add_argument('--pg-bin', default=None, help='folder with initdb/pg_ctl if they are not on the path')
+    parser.add_argument('--replica', action='store_true', help='with --temp-cluster also start a streaming replica for the read routes')
+    parser.add_argument('--skip-seed', action='store_true', help='use the data already in the database')
+    parser.add_argument('--seed', type=int, default=42)
+    for key, value in seed.DEFAULTS.items():
+        parser.add_argument(f'--{key.replace("_", "-")}', type=int, default=value)
+
+# sets up the database for a benchmark command and yields the scenario context
+@contextmanager
+def prepare_database(args):
+    cluster = postgres.temp_cluster(args.pg_bin, replica=args.replica) if args.temp_cluster else nullcontext({})
+    with cluster as env:
+        # settings are read when app is imported so the environment is set first
+        os.environ.update(env)
+        for key, value in DEFAULT_ENV.items():
+            os.environ.setdefault(key, value)
+        if args.temp_cluster:
+            migrate()
+
+        from app.database import SessionLocal
+        db = SessionLocal()
+        try:
+            if not args.skip_seed:
+                summary = seed.seed(db, seed_value=args.seed, **{key: getattr(args, key) for key in seed.DEFAULTS})
+                print('seeded:', json.dumps(summary))
+            ctx = scenarios.load_context(db)
+        finally:
+            db.close()
+        yield ctx
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Seed a local postgres and benchmark the api')
+    add_database_arguments(parser)
+    parser.add_argument('--base-url', default=None, help='benchmark a running server instead of the app in process')
+    parser.add_argument('--scenarios', default=','.join(scenarios.SCENARIOS), help='comma separated scenarios to run')
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--json', default=None, help='also write the results to this file')
+    args = parser.parse_args(argv)
+
+    names = [name for name in args.scenarios.split(',') if name]
+    for name in names:
+        if name not in scenarios.SCENARIOS:
+            parser.error(f'unknown scenario: {name}')
+
+    with prepare_database(args) as ctx:
+        client_factory = make_client_factory(args.base_url)
+        report = {}
+        for name in names:
+            results = scenarios.run_scenario(name, client_factory, ctx, args.requests, args.concurrency, args.seed)
+            report[name] = results
+            print_results(name, results)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,191 @@
+# scripted load scenarios for the api
+# each scenario builds requests for a role, workers send them concurrently and every
+# request is timed per endpoint so throughput and p50/p95/p99 can be reported
+import math
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from .seed import SEED_PASSWORD, USERNAME_PREFIX
+
+ADMIN, STAFF, STUDENT, ANONYMOUS = 1, 2, 3, None
+
+CHATBOT_MESSAGES = ['Hi', 'How do I get points?', 'What prizes can I win?', 'How do I see the leaderboard?', 'Bye']
+
+# ids the scenarios pick from, loaded from the seeded database
+def load_context(db):
+    from app import models
+    usernames = {}
+    for role_type_id in (ADMIN, STAFF, STUDENT):
+        usernames[role_type_id] = [row.username for row in db.query(models.User.username).filter(
+            models.User.role_type_id == role_type_id, models.User.username.like(f'{USERNAME_PREFIX}_%')).limit(500)]
+    ranges = db.query(models.Quarter_Range).order_by(models.Quarter_Range.start_range).all()
+    now = datetime.now(timezone.utc)
+    return {
+        'current_event_time_ids': [row.id for row in db.query(models.EventTime.id).filter(
+            models.EventTime.start_time < now, models.EventTime.end_time > now)],
+        'usernames': usernames,
+        'student_ids': [row.id for row in db.query(models.User.id).filter(models.User.role_type_id == 3)],
+        'event_time_ids': [row.id for row in db.query(models.EventTime.id)],
+        'event_ids': [row.id for row in db.query(models.Events.id)],
+        'quarter_range_ids': [r.id for r in ranges],
+    }
+
+# scans retried by the point-retry scenario, requests pick one of them so most of them are retries
+RETRY_SCANS = 50
+
+# each request is (method, url, endpoint label, request kwargs)
+def login_storm(ctx, rng):
+    username = rng.choice(ctx['usernames'][STUDENT])
+    return 'POST', '/login', 'POST /login', {'data': {'username': username, 'password': SEED_PASSWORD}}
+
+def leaderboard_storm(ctx, rng):
+    quarter_range_id = rng.choice(ctx['quarter_range_ids'])
+    return rng.choice([
+        ('GET', f'/leaderboards?quarter_range_id={quarter_range_id}&page=1&size=50', 'GET /leaderboards', {}),
+        ('GET', f'/user-points?quarter_range_id={quarter_range_id}', 'GET /user-points', {}),
+        ('GET', f'/past-winners?quarter_range_id={quarter_range_id}', 'GET /past-winners', {}),
+        ('GET', '/past-quarter', 'GET /past-quarter', {}),
+        ('GET', '/leaderboards/rollup?year_to_date=true&page=1&size=50', 'GET /leaderboards/rollup', {}),
+        ('GET', '/quarter-ranges/current', 'GET /quarter-ranges/current', {}),
+    ])
+
+def point_entry_burst(ctx, rng):
+    body = {'user_id': rng.choice(ctx['student_ids']), 'event_time_id': rng.choice(ctx['event_time_ids'])}
+    return 'POST', '/student-points/', 'POST /student-points', {'json': body}
+
+# scanner on flaky wifi: every scan is sent a few times with the same Idempotency-Key, only the first one adds the point
+def point_retry_storm(ctx, rng):
+    scan = rng.randrange(RETRY_SCANS)
+    scan_rng = random.Random(scan)
+    body = {'user_id': scan_rng.choice(ctx['student_ids']), 'event_time_id': scan_rng.choice(ctx['event_time_ids'])}
+    return 'POST', '/student-points/', 'POST /student-points', {'json': body, 'headers': {'Idempotency-Key': f'bench-scan-{scan}'}}
+
+# line of students scanned at a kiosk for one of the events happening now
+def check_in_line(ctx, rng):
+    body = {'username': rng.choice(ctx['usernames'][STUDENT])}
+    if ctx['current_event_time_ids']:
+        body['event_time_id'] = rng.choice(ctx['current_event_time_ids'])
+    return 'POST', '/check-in', 'POST /check-in', {'json': body}
+
+def export(ctx, rng):
+    quarter_range_id = rng.choice(ctx['quarter_range_ids'])
+    return 'GET', f'/student-points/export?quarter_range_id={quarter_range_id}', 'GET /student-points/export', {}
+
+def winner_selection(ctx, rng):
+    quarter_range_id = rng.choice(ctx['quarter_range_ids'])
+    return 'POST', '/student-winners/', 'POST /student-winners', {'json': {'quarter_range_id': quarter_range_id}}
+
+def chatbot(ctx, rng):
+    return 'POST', '/predict', 'POST /predict', {'json': {'message': rng.choice(CHATBOT_MESSAGES)}}
+
+# list endpoints of the remaining routers
+def reference_reads(ctx, rng):
+    quarter_range_id = rng.choice(ctx['quarter_range_ids'])
+    return rng.choice([
+        ('GET', '/users/?page=1&size=50&sortColumn=last_name&sortDir=asc', 'GET /users', {}),
+        ('GET', '/users/role-types', 'GET /users/role-types', {}),
+        ('GET', f'/users/find?username={rng.choice(ctx["usernames"][STUDENT])}', 'GET /users/find', {}),
+        ('GET', '/events/?page=1&size=50', 'GET /events', {}),
+        ('GET', '/prizes/?page=1&size=50', 'GET /prizes', {}),
+        ('GET', '/quarters', 'GET /quarters', {}),
+        ('GET', '/quarter-ranges?page=1&size=50', 'GET /quarter-ranges', {}),
+        ('GET', f'/event-times/?quarter_range_id={quarter_range_id}&page=1&size=50', 'GET /event-times', {}),
+        ('GET', '/event-times/current', 'GET /event-times/current', {}),
+        ('GET', f'/student-points/?quarter_range_id={quarter_range_id}&page=1&size=50', 'GET /student-points', {}),
+        ('GET', f'/student-winners/?quarter_range_id={quarter_range_id}&page=1&size=50', 'GET /student-winners', {}),
+        ('GET', '/user-steps/?page=1&size=50', 'GET /user-steps', {}),
+        ('GET', f'/student-points/?quarter_range_id={quarter_range_id}&page=1&size=50&view=lite', 'GET /student-points lite', {}),
+        ('GET', '/user-steps/?page=1&size=50&view=lite', 'GET /user-steps lite', {}),
+        ('GET', '/sync', 'GET /sync', {}),
+    ])
+
+# name -> (role the workers log in as, request builder, max concurrency or None for the cli value)
+SCENARIOS = {
+    'login': (ANONYMOUS, login_storm, None),
+    'leaderboard': (STUDENT, leaderboard_storm, None),
+    'point-entry': (ADMIN, point_entry_burst, None),
+    'point-retry': (ADMIN, point_retry_storm, None),
+    'check-in': (ADMIN, check_in_line, None),
+    'export': (ADMIN, export, None),
+    # winners are created once per quarter range, later calls measure the "already chosen" path
+    'winners': (ADMIN, winner_selection, 1),
+    'chatbot': (STUDENT, chatbot, None),
+    'reference': (ADMIN, reference_reads, None),
+}
+
+# collects the latency and status of every request
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+
+    def record(self, label: str, elapsed: float, status_code: int):
+        with self.lock:
+            self.samples.setdefault(label, []).append((elapsed, status_code))
+
+# nearest rank percentile of sorted values
+def percentile(values, pct: float):
+    if not values:
+        return 0.0
+    rank = math.ceil(pct / 100 * len(values))
+    return values[max(0, min(len(values), rank) - 1)]
+
+# summary per endpoint with throughput over the scenario wall time
+def summarize(recorder: Recorder, wall_time: float):
+    results = []
+    for label, samples in sorted(recorder.samples.items()):
+        latencies = sorted(elapsed for elapsed, _ in samples)
+        statuses = {}
+        for _, status_code in samples:
+            statuses[status_code] = statuses.get(status_code, 0) + 1
+        results.append({
+            'endpoint': label,
+            'requests': len(samples),
+            'throughput_rps': round(len(samples) / wall_time, 2) if wall_time else 0.0,
+            'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+            'statuses': statuses,
+        })
+    return results
+
+# logs a client in as a seeded user of the role
+def login(client, ctx, role_type_id, rng):
+    if role_type_id is ANONYMOUS:
+        return
+    if role_type_id == ADMIN:
+        username, password = 'admin', '123qwe'
+    else:
+        username, password = rng.choice(ctx['usernames'][role_type_id]), SEED_PASSWORD
+    response = client.post('/login', data={'username': username, 'password': password})
+    if response.status_code != 200:
+        raise RuntimeError(f'could not log in as {username}: {response.status_code} {response.text}')
+
+# runs one scenario with workers that each have their own logged in client
+def run_scenario(name: str, client_factory, ctx, requests: int, concurrency: int, seed_value: int = 42):
+    role_type_id, build_request, max_concurrency = SCENARIOS[name]
+    if max_concurrency:
+        concurrency = min(concurrency, max_concurrency)
+    recorder = Recorder()
+    per_worker = [requests // concurrency + (1 if i < requests % concurrency else 0) for i in range(concurrency)]
+
+    def worker(index: int):
+        rng = random.Random(seed_value + index)
+        with client_factory() as client:
+            login(client, ctx, role_type_id, rng)
+            for _ in range(per_worker[index]):
+                method, url, label, kwargs = build_request(ctx, rng)
+                start = time.perf_counter()
+                response = client.request(method, url, **kwargs)
+                # reads the whole body so streamed exports are timed completely
+                response.read()
+                recorder.record(label, time.perf_counter() - start, response.status_code)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(worker, i) for i in range(concurrency)]:
+            future.result()
+    return summarize(recorder, time.perf_counter() - start)
@@ -0,0 +1,161 @@
+# generates benchmark data at ratios close to a real school year
+# the app is imported inside the functions so the database settings can be set first.
+# seeding again first removes the rows of the earlier seed, so a database can be seeded any number of times
+import random
+from datetime import datetime, timedelta, timezone
+
+# password of every seeded user (hashed once, bcrypt is too slow to hash per user)
+SEED_PASSWORD = 'bench123'
+USERNAME_PREFIX = 'bench'
+EVENT_PREFIX = 'Benchmark Event'
+
+# defaults for the ratios of the generated data
+DEFAULTS = {
+    'users': 1000,
+    'events': 30,
+    'event_times_per_quarter': 40,
+    'points_per_student_per_quarter': 8,
+    'steps_per_user': 20,
+}
+# share of each role type (admin, staff, student)
+ROLE_SHARE = ((1, 0.01), (2, 0.04), (3, 0.95))
+STEPS = ['login', 'leaderboard', 'student-points', 'events', 'prizes', 'winners', 'chatbot']
+
+# creates the seeded usernames so scenarios can log in as them
+def username(role_type_id: int, index: int):
+    return f'{USERNAME_PREFIX}_{role_type_id}_{index}'
+
+# inserts rows in chunks with a single statement per chunk
+def bulk_insert(db, table, rows, chunk_size: int = 5000):
+    for i in range(0, len(rows), chunk_size):
+        db.execute(table.insert(), rows[i:i + chunk_size])
+
+# quarter ranges that only have event times of seeded events (with everything that cascades from them)
+clear_ranges_statement = """
+    DELETE FROM "quarter-ranges" qr
+    WHERE EXISTS (SELECT 1 FROM event_times et JOIN events e ON e.id = et.event_id
+            WHERE et.quarter_range_id = qr.id AND e.name LIKE :event_names)
+        AND NOT EXISTS (SELECT 1 FROM event_times et JOIN events e ON e.id = et.event_id
+            WHERE et.quarter_range_id = qr.id AND e.name NOT LIKE :event_names)
+"""
+
+# removes the users, events and quarter ranges of an earlier seed, their points, steps, standings and winners cascade.
+# the quarter ranges may have been closed, the guard trigger of student_points skips the deletes like in deletion jobs
+def clear(db):
+    from sqlalchemy import delete, text
+    from app import models
+    db.execute(text("SET LOCAL app.deleting = 'on'"))
+    event_names = f'{EVENT_PREFIX} %'
+    db.execute(text(clear_ranges_statement), {'event_names': event_names})
+    db.execute(delete(models.Events.__table__).where(models.Events.name.like(event_names)))
+    db.execute(delete(models.User.__table__).where(models.User.username.like(f'{USERNAME_PREFIX}\\_%')))
+    db.commit()
+
+# four back to back quarter ranges with today inside the third one
+def quarter_ranges(now: datetime):
+    length = timedelta(days=70)
+    start = now - length * 2 - timedelta(days=35)
+    ranges = []
+    for quarter_id in range(1, 5):
+        end = start + length - timedelta(days=1)
+        ranges.append({'quarter_id': quarter_id, 'start_range': start, 'end_range': end})
+        start = start + length
+    return ranges
+
+# seeds users, events, quarter ranges, event times, points and steps
+# returns a summary with the ids the scenarios need
+def seed(db, users: int = DEFAULTS['users'], events: int = DEFAULTS['events'],
+    event_times_per_quarter: int = DEFAULTS['event_times_per_quarter'],
+    points_per_student_per_quarter: int = DEFAULTS['points_per_student_per_quarter'],
+    steps_per_user: int = DEFAULTS['steps_per_user'], seed_value: int = 42):
+    from app import models, utils
+
+    rng = random.Random(seed_value)
+    now = datetime.now(timezone.utc)
+    password = utils.hash(SEED_PASSWORD)
+    clear(db)
+
+    # users for each role type
+    user_rows = []
+    for role_type_id, share in ROLE_SHARE:
+        for i in range(max(1, int(users * share))):
+            user_rows.append({
+                'username': username(role_type_id, i), 'password': password,
+                'first_name': f'First{i}', 'last_name': f'Last{rng.randint(0, users)}',
+                'grade': rng.randint(9, 12) if role_type_id == 3 else None,
+                'role_type_id': role_type_id,
+            })
+    bulk_insert(db, models.User.__table__, user_rows)
+
+    # events, a third of them sports
+    event_rows = [{'name': f'{EVENT_PREFIX} {i}', 'is_sport': i % 3 == 0} for i in range(events)]
+    bulk_insert(db, models.Events.__table__, event_rows)
+
+    # quarter ranges already in the database (with event times of other events) are used where they overlap the
+    # seeded ones, quarter ranges can't overlap
+    seeded_ranges = quarter_ranges(now)
+    window_start, window_end = seeded_ranges[0]['start_range'], seeded_ranges[-1]['end_range']
+    in_window = db.query(models.Quarter_Range).filter(models.Quarter_Range.deleted_at == None,
+        models.Quarter_Range.start_range <= window_end, models.Quarter_Range.end_range >= window_start)
+    existing = in_window.all()
+    bulk_insert(db, models.Quarter_Range.__table__, [r for r in seeded_ranges if not any(
+        e.start_range <= r['end_range'] and e.end_range >= r['start_range'] for e in existing)])
+    db.commit()
+
+    seeded_users = models.User.username.like(f'{USERNAME_PREFIX}\\_%')
+    student_ids = [row.id for row in db.query(models.User.id).filter(models.User.role_type_id == 3, seeded_users)]
+    user_ids = [row.id for row in db.query(models.User.id).filter(seeded_users)]
+    event_ids = [row.id for row in db.query(models.Events.id).filter(models.Events.name.like(f'{EVENT_PREFIX} %'))]
+    # closed ones can't get points
+    ranges = in_window.filter(~models.Quarter_Range.id.in_(db.query(models.QuarterClose.quarter_range_id))).order_by(
+        models.Quarter_Range.start_range).all()
+
+    # event times spread over each quarter range, plus some happening right now
+    event_time_rows = []
+    for quarter_range in ranges:
+        span = (quarter_range.end_range - quarter_range.start_range).total_seconds()
+        for _ in range(event_times_per_quarter):
+            start = quarter_range.start_range + timedelta(seconds=rng.uniform(span * 0.05, span * 0.9))
+            event_time_rows.append({'event_id': rng.choice(event_ids), 'quarter_range_id': quarter_range.id,
+                'start_time': start, 'end_time': start + timedelta(hours=2)})
+        if quarter_range.start_range < now < quarter_range.end_range:
+            for event_id in event_ids[:3]:
+                event_time_rows.append({'event_id': event_id, 'quarter_range_id': quarter_range.id,
+                    'start_time': now - timedelta(hours=1), 'end_time': now + timedelta(hours=3)})
+    bulk_insert(db, models.EventTime.__table__, event_time_rows)
+    db.commit()
+
+    # points: each student goes to a few event times of each quarter (skewed so leaderboards have a spread)
+    event_times_by_quarter = {}
+    for row in db.query(models.EventTime.id, models.EventTime.quarter_range_id).filter(models.EventTime.event_id.in_(event_ids)):
+        event_times_by_quarter.setdefault(row.quarter_range_id, []).append(row.id)
+    point_rows = []
+    for student_id in student_ids:
+        activity = rng.random() * 2
+        for quarter_event_times in event_times_by_quarter.values():
+            count = min(len(quarter_event_times), int(rng.expovariate(1 / points_per_student_per_quarter) * activity))
+            for event_time_id in rng.sample(quarter_event_times, count):
+                point_rows.append({'user_id': student_id, 'event_time_id': event_time_id})
+    bulk_insert(db, models.StudentPoint.__table__, point_rows)
+
+    # steps of each user
+    step_rows = []
+    for user_id in user_ids:
+        for _ in range(steps_per_user):
+            step_rows.append({'user_id': user_id, 'step': rng.choice(STEPS),
+                'accessed_at': now - timedelta(minutes=rng.randint(0, 60 * 24 * 200))})
+    bulk_insert(db, models.UserStep.__table__, step_rows)
+    db.commit()
+
+    current = [r.id for r in ranges if r.start_range < now < r.end_range]
+    return {
+        'users': len(user_rows),
+        'students': len(student_ids),
+        'events': len(event_ids),
+        'event_times': len(event_time_rows),
+        'student_points': len(point_rows),
+        'user_steps': len(step_rows),
+        'quarter_range_ids': [r.id for r in ranges],
+        'current_quarter_range_id': current[0] if current else ranges[-1].id,
+        'past_quarter_range_ids': [r.id for r in ranges if r.end_range < now],
+    }
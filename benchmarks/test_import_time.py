@@ -0,0 +1,13 @@
+# runs the import time check as a test so ci fails when the app is slower to import or loads a heavy dependency
+# (pandas, torch, nltk, numpy or the chatbot) on startup
+# example: python -m pytest benchmarks
+# the check runs in a new interpreter, modules pytest or other tests already imported can't hide a regression
+import subprocess
+import sys
+
+from .run import ROOT
+
+def test_import_time():
+    result = subprocess.run([sys.executable, '-c', 'import sys; from benchmarks import import_time; sys.exit(import_time.main([]))'],
+        cwd=ROOT, capture_output=True, text=True)
+    assert result.returncode == 0, result.stdout + result.stderr
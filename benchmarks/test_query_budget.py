@@ -0,0 +1,21 @@
+# runs the query budget check as a test so ci fails when a route runs more statements than its budget
+# example: python -m pytest benchmarks
+# needs a local postgres install, the check starts a throwaway cluster with initdb/pg_ctl.
+# without initdb the test is skipped, set REQUIRE_QUERY_BUDGET=1 (as ci does) to fail instead
+import os
+import shutil
+
+import pytest
+
+from . import query_budget
+
+# whether a missing postgres install fails the test instead of skipping it
+REQUIRED = os.environ.get('REQUIRE_QUERY_BUDGET', '').lower() in ('1', 'true', 'yes')
+
+def test_query_budget():
+    if shutil.which('initdb') is None:
+        message = 'initdb was not found, install postgres to run the query budget check'
+        if REQUIRED:
+            pytest.fail(message)
+        pytest.skip(message)
+    assert query_budget.main(['--temp-cluster', '--users', '200']) == 0
@@ -1,17 +1,47 @@
-# See Credits in README.md 
-import numpy as np
+# See Credits in README.md
+import argparse
+import os
 import random
 import json
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
 import torch
 import torch.nn as nn
-from torch.utils.data import Dataset, DataLoader
 
-from nltk_utils import bag_of_words, tokenize, stem
-from model import NeuralNet
-
-def train_bot(intents, name: str):
-    all_words = []
+from .nltk_utils import tokenize, stem
+from .model import NeuralNet
+
+# paths are relative to the chatbot package so training can run from any folder
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+INTENTS_DIR = os.path.join(BASE_DIR, 'intents')
+DATA_DIR = os.path.join(BASE_DIR, 'data')
+
+# role names that have their own intents file and trained model
+ROLES = ['student', 'staff', 'admin']
+
+# Hyper-parameters
+# one optimizer step per epoch on the full batch (the minibatch version took 5 to 10 steps per epoch at lr 0.001),
+# so the learning rate is higher to reach the same loss in a few hundred steps
+MAX_EPOCHS = 5000
+LEARNING_RATE = 0.01
+HIDDEN_SIZE = 8
+# early stopping: stop once loss has not improved by min_delta for patience epochs
+PATIENCE = 200
+MIN_DELTA = 1e-4
+# loss of the minibatch models (2e-4 to 9e-4), chat.py answers when the top probability is above 0.75
+TARGET_LOSS = 5e-4
+SEED = 42
+
+# sets every random generator used in training so models are reproducible
+def set_seed(seed: int):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+# tokenizes and stems every pattern once and builds the bag of words matrix
+def build_dataset(intents):
+    ignore_words = ['?', '.', '!']
     tags = []
     xy = []
     # loop through each sentence in our intents patterns
@@ -20,122 +50,166 @@ def train_bot(intents, name: str):
         # add to tag list
         tags.append(tag)
         for pattern in intent['patterns']:
-            # tokenize each word in the sentence
-            w = tokenize(pattern)
-            # add to our words list
-            all_words.extend(w)
+            # tokenize and stem each word in the sentence a single time
+            words = [stem(w) for w in tokenize(pattern) if w not in ignore_words]
             # add to xy pair
-            xy.append((w, tag))
-
-    # stem and lower each word
-    ignore_words = ['?', '.', '!']
-    all_words = [stem(w) for w in all_words if w not in ignore_words]
+            xy.append((words, tag))
     # remove duplicates and sort
-    all_words = sorted(set(all_words))
+    all_words = sorted(set(w for (words, _) in xy for w in words))
     tags = sorted(set(tags))
 
-    print(len(xy), "patterns")
-    print(len(tags), "tags:", tags)
-    print(len(all_words), "unique stemmed words:", all_words)
-
-    # create training data
-    X_train = []
-    y_train = []
-    for (pattern_sentence, tag) in xy:
-        # X: bag of words for each pattern_sentence
-        bag = bag_of_words(pattern_sentence, all_words)
-        X_train.append(bag)
-        # y: PyTorch CrossEntropyLoss needs only class labels, not one-hot
-        label = tags.index(tag)
-        y_train.append(label)
-
-    X_train = np.array(X_train)
-    y_train = np.array(y_train)
-
-    # Hyper-parameters 
-    num_epochs = 1000
-    batch_size = 8
-    learning_rate = 0.001
-    input_size = len(X_train[0])
-    hidden_size = 8
+    # look up tables instead of list.index for each word and tag
+    word_index = {w: i for i, w in enumerate(all_words)}
+    tag_index = {t: i for i, t in enumerate(tags)}
+
+    # X: bag of words for each pattern, y: class label (CrossEntropyLoss needs no one-hot)
+    X_train = np.zeros((len(xy), len(all_words)), dtype=np.float32)
+    y_train = np.zeros(len(xy), dtype=np.int64)
+    for row, (words, tag) in enumerate(xy):
+        for w in words:
+            X_train[row, word_index[w]] = 1
+        y_train[row] = tag_index[tag]
+    return X_train, y_train, all_words, tags
+
+# loss, training set accuracy and lowest probability given to the right tag
+def evaluate(model, words, labels):
+    model.eval()
+    with torch.no_grad():
+        outputs = model(words)
+        loss = nn.functional.cross_entropy(outputs, labels).item()
+        probs = torch.softmax(outputs, dim=1)
+        accuracy = (outputs.argmax(dim=1) == labels).float().mean().item()
+        min_prob = probs.gather(1, labels.unsqueeze(1)).min().item()
+    model.train()
+    return {'loss': loss, 'accuracy': accuracy, 'min_prob': min_prob}
+
+# scores the model saved by the last training on the same patterns, None if there is none or its words or tags differ
+def evaluate_saved(file, words, labels, all_words, tags, device):
+    if not os.path.exists(file):
+        return None
+    data = torch.load(file, map_location=device)
+    if data['all_words'] != all_words or data['tags'] != tags:
+        return None
+    model = NeuralNet(data['input_size'], data['hidden_size'], data['output_size']).to(device)
+    model.load_state_dict(data['model_state'])
+    return evaluate(model, words, labels)
+
+def train_bot(intents, name: str, seed: int = SEED, max_epochs: int = MAX_EPOCHS,
+    patience: int = PATIENCE, verbose: bool = True):
+    # the report reads the loss and epoch of the last epoch
+    if max_epochs < 1:
+        raise ValueError(f'max_epochs must be at least 1, got {max_epochs}')
+    set_seed(seed)
+    # each role trains in its own process so keep torch to one thread
+    torch.set_num_threads(1)
+
+    X_train, y_train, all_words, tags = build_dataset(intents)
+
+    if verbose:
+        print(f'[{name}] {len(X_train)} patterns, {len(tags)} tags, {len(all_words)} unique stemmed words')
+
+    input_size = len(all_words)
     output_size = len(tags)
-    print(input_size, output_size)
-
-    class ChatDataset(Dataset):
-
-        def __init__(self):
-            self.n_samples = len(X_train)
-            self.x_data = X_train
-            self.y_data = y_train
-
-        # support indexing such that dataset[i] can be used to get i-th sample
-        def __getitem__(self, index):
-            return self.x_data[index], self.y_data[index]
-
-        # we can call len(dataset) to return the size
-        def __len__(self):
-            return self.n_samples
-
-    dataset = ChatDataset()
-    train_loader = DataLoader(dataset=dataset,
-                            batch_size=batch_size,
-                            shuffle=True,
-                            num_workers=0)
 
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
-    model = NeuralNet(input_size, hidden_size, output_size).to(device)
+    # the dataset is tiny, so train on the full batch as tensors instead of a DataLoader
+    words = torch.from_numpy(X_train).to(device)
+    labels = torch.from_numpy(y_train).to(device)
+
+    model = NeuralNet(input_size, HIDDEN_SIZE, output_size).to(device)
 
     # Loss and optimizer
     criterion = nn.CrossEntropyLoss()
-    optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
+    optimizer = torch.optim.Adam(model.parameters(), lr=LEARNING_RATE)
 
+    best_loss = float('inf')
+    stale_epochs = 0
     # Train the model
-    for epoch in range(num_epochs):
-        for (words, labels) in train_loader:
-            words = words.to(device)
-            labels = labels.to(dtype=torch.long).to(device)
-            
-            # Forward pass
-            outputs = model(words)
-            # if y would be one-hot, we must apply
-            # labels = torch.max(labels, 1)[1]
-            loss = criterion(outputs, labels)
-            
-            # Backward and optimize
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
-            
-        if (epoch+1) % 100 == 0:
-            print (f'Epoch [{epoch+1}/{num_epochs}], Loss: {loss.item():.4f}')
-
-
-    print(f'final loss: {loss.item():.4f}')
+    for epoch in range(max_epochs):
+        # Forward pass
+        outputs = model(words)
+        loss = criterion(outputs, labels)
+
+        # Backward and optimize
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+        # early stopping on loss
+        current_loss = loss.item()
+        if current_loss < best_loss - MIN_DELTA:
+            best_loss = current_loss
+            stale_epochs = 0
+        else:
+            stale_epochs += 1
+        if current_loss < TARGET_LOSS or stale_epochs >= patience:
+            break
+
+        if verbose and (epoch+1) % 100 == 0:
+            print(f'[{name}] Epoch [{epoch+1}/{max_epochs}], Loss: {current_loss:.4f}')
+
+    FILE = os.path.join(DATA_DIR, f'{name}_data.pth')
+    # compare against the model about to be replaced
+    report = {'name': name, 'epochs': epoch+1, 'file': FILE, **evaluate(model, words, labels),
+        'previous': evaluate_saved(FILE, words, labels, all_words, tags, device)}
 
     data = {
     "model_state": model.state_dict(),
     "input_size": input_size,
-    "hidden_size": hidden_size,
+    "hidden_size": HIDDEN_SIZE,
     "output_size": output_size,
     "all_words": all_words,
     "tags": tags
     }
 
-    FILE = f"./data/{name}_data.pth"
     torch.save(data, FILE)
 
-    print(f'training complete. file saved to {FILE}')
-
-with open('./intents/student_intents.json', 'r') as f:
-    student_intents = json.load(f)
-
-with open('./intents/staff_intents.json', 'r') as f1:
-    staff_intents = json.load(f1)
-
-with open('./intents/admin_intents.json', 'r') as f2:
-    admin_intents = json.load(f2)
-
-train_bot(student_intents, 'student')
-train_bot(staff_intents, 'staff')
-train_bot(admin_intents, 'admin')
\ No newline at end of file
+    if verbose:
+        print(f'[{name}] final loss: {report["loss"]:.4f} after {epoch+1} epochs. file saved to {FILE}')
+    return report
+
+# one line per role with the new model and the model it replaced
+def print_reports(reports):
+    def scores(result):
+        if result is None:
+            return 'n/a'
+        return f'loss {result["loss"]:.4f}, accuracy {result["accuracy"]:.3f}, min prob {result["min_prob"]:.3f}'
+    for report in reports:
+        print(f'{report["name"]}: {scores(report)} after {report["epochs"]} epochs (previous: {scores(report["previous"])})')
+
+# loads the intents of a role and trains its model
+def train_role(name: str, seed: int = SEED, max_epochs: int = MAX_EPOCHS, patience: int = PATIENCE):
+    with open(os.path.join(INTENTS_DIR, f'{name}_intents.json'), 'r') as f:
+        intents = json.load(f)
+    return train_bot(intents, name, seed=seed, max_epochs=max_epochs, patience=patience)
+
+# trains every role, each role model in a separate process
+def train_all(roles=ROLES, seed: int = SEED, max_epochs: int = MAX_EPOCHS, patience: int = PATIENCE, workers: int = None):
+    workers = workers or len(roles)
+    # single worker skips the process pool
+    if workers == 1:
+        return [train_role(role, seed, max_epochs, patience) for role in roles]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(train_role, role, seed, max_epochs, patience) for role in roles]
+        return [future.result() for future in futures]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Train the chatbot models for each role type')
+    parser.add_argument('roles', nargs='*', help=f'roles to train from {ROLES} (default: all)')
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--max-epochs', type=int, default=MAX_EPOCHS)
+    parser.add_argument('--patience', type=int, default=PATIENCE)
+    parser.add_argument('--workers', type=int, default=None, help='processes to train with (default: one per role)')
+    args = parser.parse_args(argv)
+    # checks the roles passed in have an intents file
+    for role in args.roles:
+        if role not in ROLES:
+            parser.error(f'unknown role: {role}')
+    if args.max_epochs < 1:
+        parser.error('--max-epochs must be at least 1')
+    reports = train_all(args.roles or ROLES, seed=args.seed, max_epochs=args.max_epochs, patience=args.patience, workers=args.workers)
+    print_reports(reports)
+
+if __name__ == '__main__':
+    main()